@@ -0,0 +1,445 @@
+"""Local database API of the IoT box.
+
+Stores the sensor readings written by the OPC UA server bridge in a local SQLite
+database and serves them again by sensor, information node and time.
+
+Readings are not written one by one: the endpoints only queue them and a background
+task writes the queue in one transaction per flush. The static metadata of an
+information node (bounds and units) is stored once per change instead of with every
+reading. Clients can also register the metadata of their streams once and send the
+readings as compact binary frames (see ingest_frames).
+
+Endpoints
+---------
+POST /insert/{port}
+    Queues a single reading of a port.
+POST /insert_bulk
+    Queues a list of readings of any ports.
+POST /register
+    Registers the schemas of binary streams.
+POST /insert_frames
+    Queues the readings of a binary frame.
+GET /readings
+    Returns the readings of a sensor and information node in a time range.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import sqlite3
+import struct
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel
+import uvicorn
+
+from ingest_frames import StreamSchema, decode_frame
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "readings.db")
+API_PORT = 360
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 1.0
+
+EPOCH = datetime(1970, 1, 1)
+
+_logger = logging.getLogger("Local Database API")
+
+
+class Reading(BaseModel):
+    """Values of one information node of a sensor, as sent by handle_writing."""
+
+    sensorname: str
+    informationnode: str
+    values: list[float]
+    lowerbounds: list[float] = []
+    upperbounds: list[float] = []
+    units: list[str] = []
+    timestamp: datetime = None
+
+
+class PortReading(Reading):
+    """Reading together with the port of the sensor, for bulk inserts."""
+
+    port: int
+
+
+class StreamSchemaModel(BaseModel):
+    """Schema of a binary stream, see ingest_frames.StreamSchema."""
+
+    index: int
+    port: int
+    sensorname: str
+    informationnode: str
+    lowerbounds: list[float] = []
+    upperbounds: list[float] = []
+    units: list[str] = []
+
+
+class ReadingStore:
+    """SQLite store of readings with batched writes.
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite database
+    batch_size : int
+        Number of queued readings that triggers a flush
+    flush_interval : float
+        Maximum number of seconds a reading stays in the queue
+
+    Methods
+    -------
+    open:
+        Opens the database and starts flushing the queue periodically
+    close:
+        Flushes the queue and closes the database
+    add:
+        Queues readings
+    register:
+        Registers the schemas of binary streams
+    add_frame:
+        Queues the readings of a binary frame
+    flush:
+        Writes all queued readings to the database
+    query:
+        Reads the readings of a sensor and information node in a time range
+    """
+
+    def __init__(
+        self,
+        path: str = DATABASE_PATH,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+    ) -> None:
+        """Create ReadingStore object.
+
+        :param path: Location of the SQLite database, defaults to DATABASE_PATH
+        :param batch_size: Number of queued readings that triggers a flush, defaults
+        to BATCH_SIZE
+        :param flush_interval: Maximum number of seconds a reading stays in the queue,
+        defaults to FLUSH_INTERVAL
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: list[tuple] = []
+        # metadata last stored per (sensorname, informationnode)
+        self._metadata: dict[tuple[str, str], tuple] = {}
+        self._metadata_queue: list[tuple] = []
+        self._streams: dict[int, StreamSchema] = {}
+        self._db: sqlite3.Connection = None
+        # sqlite connections must not be shared between threads, all database work
+        # is done by this single worker
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._flush_task: asyncio.Task = None
+
+    async def open(self) -> None:
+        """Open the database and start flushing the queue periodically."""
+        await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        """Flush the queue and close the database."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        await self._run(self._db.close)
+
+    async def add(self, port: int, readings: list[Reading]) -> None:
+        """Queue readings of a port.
+
+        :param port: Port of the sensor, None if the readings are PortReadings
+        :param readings: Readings to store, without timestamp they are stored as
+        received now
+        """
+        now = datetime.utcnow()
+        for reading in readings:
+            self._update_metadata(
+                reading.sensorname,
+                reading.informationnode,
+                reading.lowerbounds,
+                reading.upperbounds,
+                reading.units,
+            )
+            self._queue.append(
+                (
+                    reading.port if port is None else port,
+                    reading.sensorname,
+                    reading.informationnode,
+                    _to_us(reading.timestamp or now),
+                    _pack(reading.values),
+                )
+            )
+        if len(self._queue) >= self.batch_size:
+            await self.flush()
+
+    def register(self, schemas: list[StreamSchema]) -> None:
+        """Register the schemas of binary streams, replacing ones with the same index.
+
+        :param schemas: Schemas to register
+        """
+        for schema in schemas:
+            self._streams[schema.index] = schema
+            self._update_metadata(
+                schema.sensorname,
+                schema.informationnode,
+                schema.lowerbounds,
+                schema.upperbounds,
+                schema.units,
+            )
+
+    async def add_frame(self, data: bytes) -> int:
+        """Queue the readings of a binary frame.
+
+        :param data: Encoded frame
+        :raises KeyError: If the frame uses a stream that is not registered, nothing of
+        the frame is queued then
+        :return: Number of queued readings
+        """
+        rows = []
+        for index, timestamp, values in decode_frame(data):
+            schema = self._streams[index]
+            rows.append(
+                (
+                    schema.port,
+                    schema.sensorname,
+                    schema.informationnode,
+                    timestamp,
+                    _pack(values),
+                )
+            )
+        self._queue.extend(rows)
+        if len(self._queue) >= self.batch_size:
+            await self.flush()
+        return len(rows)
+
+    def _update_metadata(
+        self,
+        sensorname: str,
+        informationnode: str,
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        units: list[str],
+    ) -> None:
+        """Queue the metadata of an information node if it has changed."""
+        key = sensorname, informationnode
+        metadata = (lowerbounds, upperbounds, units)
+        if self._metadata.get(key) != metadata:
+            self._metadata[key] = metadata
+            self._metadata_queue.append(
+                (*key, _pack(lowerbounds), _pack(upperbounds), "\x1f".join(units))
+            )
+
+    async def flush(self) -> None:
+        """Write all queued readings and metadata in one transaction."""
+        if not self._queue and not self._metadata_queue:
+            return
+        batch, self._queue = self._queue, []
+        metadata, self._metadata_queue = self._metadata_queue, []
+        await self._run(self._insert, batch, metadata)
+
+    async def query(
+        self,
+        sensorname: str,
+        informationnode: str,
+        start: datetime,
+        end: datetime,
+        limit: int,
+    ) -> dict:
+        """Read the readings of a sensor and information node in a time range.
+
+        :param sensorname: Name of the sensor
+        :param informationnode: Name of the information node
+        :param start: Start of the time range
+        :param end: End of the time range
+        :param limit: Maximum number of readings to return
+        :return: Metadata of the information node and the readings, oldest first
+        """
+        await self.flush()
+        return await self._run(
+            self._select, sensorname, informationnode, start, end, limit
+        )
+
+    async def _flush_periodically(self) -> None:
+        """Flush the queue in the background."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                _logger.error(f"Writing readings failed: {e}")
+
+    async def _run(self, func, *args):
+        """Run a database function in the database worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _open(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS readings ("
+            " Port INTEGER,"
+            " SensorName TEXT NOT NULL,"
+            " InformationNode TEXT NOT NULL,"
+            " Timestamp INTEGER NOT NULL,"
+            " ReadingValues BLOB)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS readings_node_time"
+            " ON readings (SensorName, InformationNode, Timestamp)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " SensorName TEXT NOT NULL,"
+            " InformationNode TEXT NOT NULL,"
+            " LowerBounds BLOB,"
+            " UpperBounds BLOB,"
+            " Units TEXT,"
+            " PRIMARY KEY (SensorName, InformationNode))"
+        )
+        self._db.commit()
+
+    def _insert(self, batch: list[tuple], metadata: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)", metadata
+            )
+            self._db.executemany(
+                "INSERT INTO readings VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+
+    def _select(
+        self,
+        sensorname: str,
+        informationnode: str,
+        start: datetime,
+        end: datetime,
+        limit: int,
+    ) -> dict:
+        metadata = self._db.execute(
+            "SELECT LowerBounds, UpperBounds, Units FROM metadata"
+            " WHERE SensorName = ? AND InformationNode = ?",
+            (sensorname, informationnode),
+        ).fetchone()
+        rows = self._db.execute(
+            "SELECT Port, Timestamp, ReadingValues FROM readings"
+            " WHERE SensorName = ? AND InformationNode = ?"
+            " AND Timestamp BETWEEN ? AND ? ORDER BY Timestamp LIMIT ?",
+            (
+                sensorname,
+                informationnode,
+                _to_us(start),
+                _to_us(end),
+                limit,
+            ),
+        ).fetchall()
+        lowerbounds, upperbounds, units = metadata or (b"", b"", "")
+        return {
+            "sensorname": sensorname,
+            "informationnode": informationnode,
+            "lowerbounds": _unpack(lowerbounds),
+            "upperbounds": _unpack(upperbounds),
+            "units": units.split("\x1f") if units else [],
+            "readings": [
+                {
+                    "port": port,
+                    "timestamp": EPOCH + timedelta(microseconds=timestamp),
+                    "values": _unpack(values),
+                }
+                for port, timestamp, values in rows
+            ],
+        }
+
+
+def _to_us(dt: datetime) -> int:
+    """Convert a datetime (naive ones are UTC) to microseconds since the unix epoch."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def _pack(values: list[float]) -> bytes:
+    """Pack floats into a blob of little endian doubles."""
+    return struct.pack(f"<{len(values)}d", *values)
+
+
+def _unpack(blob: bytes) -> list[float]:
+    """Unpack a blob of little endian doubles."""
+    return list(struct.unpack(f"<{len(blob) // 8}d", blob))
+
+
+app = FastAPI(title="Local Database API")
+store = ReadingStore()
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    await store.open()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await store.close()
+
+
+@app.post("/insert/{port}")
+async def insert(port: int, reading: Reading) -> dict:
+    """Queue a single reading of a port."""
+    await store.add(port, [reading])
+    return {"queued": 1}
+
+
+@app.post("/insert_bulk")
+async def insert_bulk(readings: list[PortReading]) -> dict:
+    """Queue a list of readings of any ports."""
+    await store.add(None, readings)
+    return {"queued": len(readings)}
+
+
+@app.post("/register")
+async def register(schemas: list[StreamSchemaModel]) -> dict:
+    """Register the schemas of binary streams."""
+    store.register([StreamSchema(**schema.dict()) for schema in schemas])
+    return {"registered": len(schemas)}
+
+
+@app.post("/insert_frames")
+async def insert_frames(request: Request) -> dict:
+    """Queue the readings of a binary frame (application/octet-stream).
+
+    Answers 409 if the frame uses an unregistered stream, the client has to register
+    its schemas again then (e.g. after this service restarted).
+    """
+    try:
+        queued = await store.add_frame(await request.body())
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail=f"Unregistered stream {e}")
+    except (ValueError, struct.error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid frame: {e}")
+    return {"queued": queued}
+
+
+@app.get("/readings")
+async def readings(
+    sensorname: str,
+    informationnode: str,
+    start: datetime = None,
+    end: datetime = None,
+    limit: int = Query(10000, gt=0),
+) -> dict:
+    """Return the readings of a sensor and information node in a time range.
+
+    Without a start the last hour is returned, without an end everything up to now.
+    """
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(hours=1)
+    return await store.query(sensorname, informationnode, start, end, limit)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=API_PORT)
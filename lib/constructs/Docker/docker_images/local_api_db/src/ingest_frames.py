@@ -0,0 +1,206 @@
+# Generated by scripts/sync_shared_modules.py from
+# lib/constructs/Docker/docker_images/opcua-server/opcua_server/ingest_frames.py
+# Edit the source and run the script instead of changing this copy.
+"""Compact binary format for streaming sensor readings.
+
+A JSON reading repeats the sensor name, information node name, bounds and units with
+every sample, although they only change when a sensor is replaced. In this format they
+are sent once per stream in a schema registration, every sample after that is a small
+binary record of the stream index, the timestamp and the values.
+
+A frame holds any number of records:
+
+* header: magic b"NNEF", version, base timestamp (microseconds since the unix epoch)
+* per record: stream index (uint16), microseconds since the base timestamp (uint32),
+  number of values (uint8) and the values as little endian float64
+
+A frame can span at most 71 minutes. A reading with three values takes 31 bytes
+instead of roughly 200 bytes of JSON.
+
+This module is shared by the OPC UA server bridge, the local database API and the
+Greengrass components. Their copies are generated from this file by
+scripts/sync_shared_modules.py, only edit this file.
+
+Classes
+-------
+StreamSchema
+    Static metadata of a stream (one information node of a sensor on a port).
+StreamRegistry
+    Assigns stream indices and remembers which schemas still have to be registered.
+
+Functions
+---------
+encode_frame
+    Encodes records into a frame.
+decode_frame
+    Decodes the records of a frame.
+"""
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+import struct
+from typing import Iterator
+
+FRAME_MAGIC = b"NNEF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBq")
+RECORD_HEADER = struct.Struct("<HIB")
+MAX_FRAME_SPAN = 2**32 - 1
+
+
+@dataclass
+class StreamSchema:
+    """Static metadata of a stream of readings.
+
+    Attributes
+    ----------
+    index : int
+        Index of the stream in the frames
+    port : int
+        Port of the sensor
+    sensorname : str
+        Name of the sensor
+    informationnode : str
+        Name of the information node
+    lowerbounds : list[float]
+        Lower bounds of the values
+    upperbounds : list[float]
+        Upper bounds of the values
+    units : list[str]
+        Units of the values
+    """
+
+    index: int
+    port: int
+    sensorname: str
+    informationnode: str
+    lowerbounds: list[float] = field(default_factory=list)
+    upperbounds: list[float] = field(default_factory=list)
+    units: list[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        """Convert the schema to a JSON serializable dictionary."""
+        return asdict(self)
+
+
+class StreamRegistry:
+    """Assigns stream indices to the information nodes of the connected sensors.
+
+    Attributes
+    ----------
+    schemas : dict[int, StreamSchema]
+        Schemas of all streams by index
+
+    Methods
+    -------
+    stream:
+        Returns the index of a stream, registering a new schema if needed
+    pending:
+        Returns the schemas that have not been sent yet
+    mark_sent:
+        Marks schemas as sent
+    resend_all:
+        Marks all schemas as not sent, e.g. after the receiver restarted
+    """
+
+    def __init__(self) -> None:
+        """Create StreamRegistry object."""
+        self.schemas: dict[int, StreamSchema] = {}
+        self._by_key: dict[tuple[int, str, str], int] = {}
+        self._pending: set[int] = set()
+
+    def stream(
+        self,
+        port: int,
+        sensorname: str,
+        informationnode: str,
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        units: list[str],
+    ) -> int:
+        """Return the index of a stream.
+
+        A stream is new (or updated) whenever its metadata changes, its schema then
+        has to be sent again before the frames that use it.
+
+        :param port: Port of the sensor
+        :param sensorname: Name of the sensor
+        :param informationnode: Name of the information node
+        :param lowerbounds: Lower bounds of the values
+        :param upperbounds: Upper bounds of the values
+        :param units: Units of the values
+        :return: Index of the stream
+        """
+        key = port, sensorname, informationnode
+        index = self._by_key.get(key)
+        if index is None:
+            index = len(self._by_key)
+            if index > 0xFFFF:
+                raise OverflowError("More than 65536 streams registered")
+            self._by_key[key] = index
+        schema = StreamSchema(
+            index,
+            port,
+            sensorname,
+            informationnode,
+            list(lowerbounds),
+            list(upperbounds),
+            list(units),
+        )
+        if self.schemas.get(index) != schema:
+            self.schemas[index] = schema
+            self._pending.add(index)
+        return index
+
+    def pending(self) -> list[StreamSchema]:
+        """Return the schemas that have not been sent yet."""
+        return [self.schemas[index] for index in sorted(self._pending)]
+
+    def mark_sent(self, schemas: list[StreamSchema]) -> None:
+        """Mark schemas as sent.
+
+        :param schemas: Schemas that the receiver has acknowledged
+        """
+        for schema in schemas:
+            if self.schemas.get(schema.index) == schema:
+                self._pending.discard(schema.index)
+
+    def resend_all(self) -> None:
+        """Mark all schemas as not sent."""
+        self._pending = set(self.schemas)
+
+
+def encode_frame(records: list[tuple[int, int, list[float]]]) -> bytes:
+    """Encode records into a frame.
+
+    :param records: Stream index, timestamp in microseconds since the unix epoch and
+    values of every record
+    :return: Encoded frame
+    """
+    base = min((timestamp for _, timestamp, _ in records), default=0)
+    parts = [FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, base)]
+    for index, timestamp, values in records:
+        if timestamp - base > MAX_FRAME_SPAN:
+            raise ValueError("Records of a frame must be within 71 minutes")
+        parts.append(RECORD_HEADER.pack(index, timestamp - base, len(values)))
+        parts.append(struct.pack(f"<{len(values)}d", *values))
+    return b"".join(parts)
+
+
+def decode_frame(data: bytes) -> Iterator[tuple[int, int, list[float]]]:
+    """Decode the records of a frame.
+
+    :param data: Encoded frame
+    :return: Iterator of the stream index, timestamp in microseconds since the unix
+    epoch and values of every record
+    """
+    magic, version, base = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"Not a version {FRAME_VERSION} frame")
+    offset = FRAME_HEADER.size
+    while offset < len(data):
+        index, delta, count = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        values = list(struct.unpack_from(f"<{count}d", data, offset))
+        offset += 8 * count
+        yield index, base + delta, values
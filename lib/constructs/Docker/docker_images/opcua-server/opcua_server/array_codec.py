@@ -0,0 +1,160 @@
+"""Opt-in fast path for numeric array Variants.
+
+asyncua encodes numeric arrays with struct.pack(fmt, *values) and decodes them into a
+tuple that is converted to a list, so every element of a PDI byte array, a Values array
+or a waveform is a Python object on both ends. After install(), arrays of the numeric
+variant types (SByte to UInt64, Float and Double) are decoded into an array.array (or a
+read-only NumPy array) with frombytes/frombuffer, and array.array objects, NumPy arrays
+and bytes-like objects are encoded with tobytes, without per-element objects. Lists are
+still encoded as before, so nothing changes for code that passes lists.
+
+The NumPy mode is meant for clients: asyncua compares old and new Variant values when
+a value is written, which is ambiguous for NumPy arrays, so servers use the array mode.
+Server code that checks for lists or guesses the variant type from the Python type,
+like the method callbacks of the NNE MI server, converts the decoded arguments of
+Call requests with to_list() first.
+
+Functions
+---------
+install
+    Makes asyncua encode and decode numeric arrays as buffers.
+to_list
+    Returns a decoded numeric array as a list.
+"""
+from array import array
+import functools
+import sys
+
+from asyncua import ua
+from asyncua.ua import ua_binary
+from asyncua.ua.ua_binary import Primitives, Primitives1, _Primitive1
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ARRAY_MODES = ("array", "numpy")
+# typecodes of 32 bit integers, "i" is 16 bit on some platforms
+_INT32, _UINT32 = ("i", "I") if array("i").itemsize == 4 else ("l", "L")
+# variant type: (format of asyncua, array typecode, NumPy dtype)
+NUMERIC_TYPES = {
+    "SByte": ("<{:d}b", "b", "<i1"),
+    "Byte": ("<{:d}B", "B", "<u1"),
+    "Int16": ("<{:d}h", "h", "<i2"),
+    "UInt16": ("<{:d}H", "H", "<u2"),
+    "Int32": ("<{:d}i", _INT32, "<i4"),
+    "UInt32": ("<{:d}I", _UINT32, "<u4"),
+    "Int64": ("<{:d}q", "q", "<i8"),
+    "UInt64": ("<{:d}Q", "Q", "<u8"),
+    "Float": ("<{:d}f", "f", "<f4"),
+    "Double": ("<{:d}d", "d", "<f8"),
+}
+# OPC UA encodes little endian, array.array uses the native byte order
+_SWAP = sys.byteorder != "little"
+
+_original_array_deserializer = ua_binary._create_uatype_array_deserializer
+_original_variant_to_binary = ua_binary.variant_to_binary
+
+
+class _BufferPrimitive(_Primitive1):
+    """Numeric primitive whose arrays are encoded and decoded as buffers."""
+
+    def __init__(self, fmt: str, typecode: str, dtype: str, mode: str) -> None:
+        super().__init__(fmt)
+        self.typecode = typecode
+        self.dtype = dtype
+        self.mode = mode
+
+    def pack_array(self, data) -> bytes:
+        if data is None or isinstance(data, list):
+            return super().pack_array(data)
+        if isinstance(data, (bytes, bytearray, memoryview)) and self.size == 1:
+            data = bytes(data)
+            return Primitives.Int32.pack(len(data)) + data
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            data = numpy.ascontiguousarray(data, dtype=self.dtype).reshape(-1)
+            return Primitives.Int32.pack(data.size) + data.tobytes()
+        if isinstance(data, array):
+            if data.typecode != self.typecode or _SWAP:
+                data = array(self.typecode, data)
+            if _SWAP:
+                data.byteswap()
+            return Primitives.Int32.pack(len(data)) + data.tobytes()
+        if isinstance(data, tuple):
+            return super().pack_array(list(data))
+        return super().pack_array(data)
+
+    def unpack_array(self, data, length: int):
+        if length == -1:
+            return None
+        raw = data.read(self.size * length) if length else b""
+        if self.mode == "numpy":
+            return numpy.frombuffer(raw, dtype=self.dtype)
+        values = array(self.typecode)
+        values.frombytes(raw)
+        if _SWAP:
+            values.byteswap()
+        return values
+
+
+@functools.lru_cache(maxsize=None)
+def _create_uatype_array_deserializer(vtype):
+    primitive = getattr(Primitives1, vtype.name, None)
+    if not isinstance(primitive, _BufferPrimitive):
+        return _original_array_deserializer(vtype)
+
+    def deserialize(data):
+        return primitive.unpack_array(data, Primitives.Int32.unpack(data))
+
+    return deserialize
+
+
+def _variant_to_binary(var: ua.Variant) -> bytes:
+    if not var.is_array and isinstance(var.Value, (array, memoryview)):
+        var = ua.Variant(var.Value, var.VariantType, var.Dimensions, is_array=True)
+    elif (
+        not var.is_array and numpy is not None and isinstance(var.Value, numpy.ndarray)
+    ):
+        var = ua.Variant(var.Value, var.VariantType, var.Dimensions, is_array=True)
+    return _original_variant_to_binary(var)
+
+
+def to_list(value):
+    """Return a decoded numeric array as a list, other values unchanged.
+
+    :param value: Value of a Variant, e.g. a method argument
+    :return: Elements of an array.array or NumPy array as a list, else the value
+    """
+    if isinstance(value, array):
+        return value.tolist()
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.tolist()
+    return value
+
+
+def install(mode: str = "array") -> None:
+    """Make asyncua encode and decode numeric arrays as buffers.
+
+    Must be called before the first message is encoded or decoded, the serializers
+    asyncua already created are discarded.
+
+    :param mode: Type of the decoded arrays, "array" for array.array or "numpy" for
+    read-only NumPy arrays, defaults to "array"
+    :raises ValueError: If the mode is unknown or NumPy is not installed
+    """
+    if mode not in ARRAY_MODES:
+        raise ValueError(f"Array mode must be one of {ARRAY_MODES}")
+    if mode == "numpy" and numpy is None:
+        raise ValueError("The numpy array mode needs NumPy to be installed")
+    for name, (fmt, typecode, dtype) in NUMERIC_TYPES.items():
+        setattr(Primitives1, name, _BufferPrimitive(fmt, typecode, dtype, mode))
+    # Primitives inherits the scalar (un)packing from Primitives1
+    for name in NUMERIC_TYPES:
+        if name in vars(Primitives):
+            setattr(Primitives, name, getattr(Primitives1, name))
+    ua_binary._create_uatype_array_deserializer = _create_uatype_array_deserializer
+    ua_binary.variant_to_binary = _variant_to_binary
+    for value in list(vars(ua_binary).values()):
+        if hasattr(value, "cache_clear"):
+            value.cache_clear()
@@ -0,0 +1,162 @@
+"""Snapshots of the fully populated NNE MI OPC UA server address space.
+
+Building the address space (standard namespace, port tree and method nodes) takes a
+few hundred awaited node additions on every boot. Instead, the populated address space
+can be dumped once at build time and loaded back in a single step on start-up. Method
+nodes can't keep their callables in a snapshot, so they have to be re-bound after
+loading.
+
+asyncua's own lazy shelf loader (AddressSpace.load_aspace_shelf) is disabled in the
+pinned asyncua version, which is why the snapshot uses AddressSpace.dump/load.
+
+The nodes created at runtime for connected sensors live below the port nodes. They can
+be saved separately and restored on the next start, so that a restart neither has to
+recreate them nor changes their NodeIds.
+
+Functions
+---------
+bind_method_callbacks
+    Re-binds the Python callables to the method nodes of a loaded snapshot.
+dump_snapshot
+    Dumps the address space of a fully set up server to a snapshot file.
+dump_subtrees
+    Saves the given nodes and all of their descendants to a file.
+load_snapshot
+    Initializes a server from a snapshot file instead of the standard address space.
+restore_subtrees
+    Puts nodes saved with dump_subtrees back into the address space.
+"""
+import asyncio
+import logging
+import os
+import pickle
+from typing import Callable
+
+from asyncua import Server, ua
+from asyncua.server.address_space import AttributeValue, NodeData
+from asyncua.ua import NodeId
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+
+def bind_method_callbacks(server: Server, callbacks: dict[NodeId, Callable]) -> None:
+    """Bind callables to the method nodes of the servers address space.
+
+    :param server: OPC UA server whose address space was loaded from a snapshot
+    :param callbacks: Dictionary of method NodeIds and the callables to bind to them
+    """
+    for nodeid, callback in callbacks.items():
+        server.iserver.aspace.add_method_callback(nodeid, callback)
+        _logger.debug(f"Bound {callback.__name__} to method node {nodeid.to_string()}")
+
+
+async def dump_snapshot(server: Server, path: str) -> None:
+    """Dump the address space of the server to a snapshot file.
+
+    The method callables are removed from the address space in the process, so the
+    server should not be used afterwards.
+
+    :param server: Fully set up OPC UA server, must not be running
+    :param path: Location of the snapshot file
+    """
+    await asyncio.get_running_loop().run_in_executor(
+        None, server.iserver.dump_address_space, path
+    )
+    _logger.info(f"Dumped address space snapshot to {path}")
+
+
+async def dump_subtrees(server: Server, path: str, root_nodeids: list[NodeId]) -> int:
+    """Save the given nodes and all nodes below them to a file.
+
+    Callbacks (method callables, subscriptions) are not saved. The nodes are copied on
+    the event loop and written to a temporary file that replaces the old one, so a
+    crash while writing never leaves a broken file behind.
+
+    :param server: OPC UA server that contains the nodes
+    :param path: Location of the file
+    :param root_nodeids: NodeIds of the top nodes of the subtrees to save
+    :return: Number of saved nodes
+    """
+    aspace = server.iserver.aspace
+    nodes: list[NodeData] = []
+    to_visit = [nid for nid in root_nodeids if nid in aspace]
+    visited = set()
+    while to_visit:
+        nodeid = to_visit.pop()
+        if nodeid in visited:
+            continue
+        visited.add(nodeid)
+        ndata = aspace[nodeid]
+        nodes.append(_detached_copy(ndata))
+        for ref in ndata.references:
+            if (
+                ref.IsForward
+                and ref.ReferenceTypeId != NodeId(ua.ObjectIds.HasTypeDefinition)
+                and ref.NodeId.NamespaceIndex == nodeid.NamespaceIndex
+                and ref.NodeId in aspace
+            ):
+                to_visit.append(ref.NodeId)
+
+    def write() -> None:
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(nodes, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    await asyncio.get_running_loop().run_in_executor(None, write)
+    _logger.debug(f"Saved {len(nodes)} nodes to {path}")
+    return len(nodes)
+
+
+async def load_snapshot(server: Server, path: str) -> None:
+    """Initialize the server with the address space from a snapshot file.
+
+    This replaces server.init() - the standard address space is not built, everything
+    else of the initialization (namespace array, build info, history) runs as usual.
+
+    :param server: Freshly created OPC UA server
+    :param path: Location of the snapshot file
+    """
+
+    async def load_address_space(shelf_file: str = None) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, server.iserver.load_address_space, path
+        )
+
+    server.iserver.load_standard_address_space = load_address_space
+    await server.init()
+    _logger.info(f"Loaded address space snapshot from {path}")
+
+
+async def restore_subtrees(server: Server, path: str) -> list[NodeId]:
+    """Put nodes saved with dump_subtrees back into the address space.
+
+    Nodes that already exist are replaced, so the saved references of the subtree roots
+    to their (dynamically created) children are restored as well.
+
+    :param server: Initialized OPC UA server that is not running yet
+    :param path: Location of the file
+    :return: NodeIds of the restored nodes
+    """
+
+    def read() -> list[NodeData]:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    nodes = await asyncio.get_running_loop().run_in_executor(None, read)
+    for ndata in nodes:
+        server.iserver.aspace[ndata.nodeid] = ndata
+    _logger.info(f"Restored {len(nodes)} nodes from {path}")
+    return [ndata.nodeid for ndata in nodes]
+
+
+def _detached_copy(ndata: NodeData) -> NodeData:
+    """Copy node data without any callbacks attached to it.
+
+    :param ndata: Node data from the address space
+    :return: Copy that can be pickled
+    """
+    copied = NodeData(ndata.nodeid)
+    copied.references = list(ndata.references)
+    for attr, attval in ndata.attributes.items():
+        copied.attributes[attr] = AttributeValue(attval.value)
+    return copied
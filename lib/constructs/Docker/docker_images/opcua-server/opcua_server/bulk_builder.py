@@ -0,0 +1,355 @@
+"""Construction of many address space nodes in one pass.
+
+Node.add_object() and Node.add_variable() read the type definition of the parent, send
+one AddNodesItem through NodeManagementService._add_node(), which checks the user, the
+node id, the parent and the property names of the parent before it inserts the node
+and its references, and the NNE MI server then writes the Description and sets the
+AccessLevel of every node with further awaited service calls.
+
+An AddressSpaceBuilder collects the nodes of a whole tree with all their attributes
+preset. build() checks all node ids and parents against the batch and the address
+space first and raises before anything is inserted, then creates the attributes
+asyncua would create (NodeManagementService._add_node_attributes, without testing every
+attribute of the mask) with one timestamp and inserts every node with its parent and
+type definition references in one pass. Parents are looked up in the
+batch before the address space, so a tree can be described top down without awaiting
+anything in between.
+
+Classes
+-------
+AddressSpaceBuilder
+    Collects nodes and inserts them into the address space in one pass.
+"""
+from datetime import datetime
+import logging
+
+from asyncua import Server, ua
+from asyncua.common.manage_nodes import _guess_datatype, _parse_nodeid_qname
+from asyncua.server.address_space import AttributeValue, NodeData
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+FOLDER_TYPE = ua.NodeId(ua.ObjectIds.FolderType)
+HAS_TYPE_DEFINITION = ua.NodeId(ua.ObjectIds.HasTypeDefinition)
+# attributes of the ObjectAttributes and VariableAttributes masks with their variant
+# types and array flags, in the order of NodeManagementService._add_nodeattributes
+NODE_ATTRIBUTES = tuple(
+    (getattr(ua.NodeAttributesMask, name), getattr(ua.AttributeIds, name), name, *spec)
+    for name, *spec in (
+        ("AccessLevel", ua.VariantType.Byte, False),
+        ("ArrayDimensions", ua.VariantType.UInt32, True),
+        ("DataType", ua.VariantType.NodeId, False),
+        ("Description", ua.VariantType.LocalizedText, False),
+        ("DisplayName", ua.VariantType.LocalizedText, False),
+        ("EventNotifier", ua.VariantType.Byte, False),
+        ("Historizing", ua.VariantType.Boolean, False),
+        ("MinimumSamplingInterval", ua.VariantType.Double, False),
+        ("UserAccessLevel", ua.VariantType.Byte, False),
+        ("UserWriteMask", ua.VariantType.UInt32, False),
+        ("ValueRank", ua.VariantType.Int32, False),
+        ("WriteMask", ua.VariantType.UInt32, False),
+    )
+)
+
+
+def _attributes(item: ua.AddNodesItem, now: datetime, shared: dict) -> dict:
+    """Return the attribute values of a new node.
+
+    DataValues are immutable and writes replace them, so nodes of one build share the
+    DataValues of equal attributes (WriteMask, DataType, ...) through shared.
+    """
+    attrs = item.NodeAttributes
+    mask = attrs.SpecifiedAttributes
+    attributes = {
+        ua.AttributeIds.NodeId: AttributeValue(
+            ua.DataValue(ua.Variant(item.RequestedNewNodeId, ua.VariantType.NodeId))
+        ),
+        ua.AttributeIds.BrowseName: AttributeValue(
+            ua.DataValue(ua.Variant(item.BrowseName, ua.VariantType.QualifiedName))
+        ),
+        ua.AttributeIds.NodeClass: AttributeValue(
+            ua.DataValue(ua.Variant(item.NodeClass, ua.VariantType.Int32))
+        ),
+    }
+    for bit, attr, name, vtype, is_array in NODE_ATTRIBUTES:
+        if mask & bit:
+            value = getattr(attrs, name)
+            key = (attr, value if not isinstance(value, list) else tuple(value))
+            datavalue = shared.get(key)
+            if datavalue is None:
+                variant = ua.Variant(value, vtype, None, is_array)
+                datavalue = shared[key] = ua.DataValue(variant)
+            attributes[attr] = AttributeValue(datavalue)
+    if mask & ua.NodeAttributesMask.Value:
+        # like asyncua, which passes is_array=False for the value as well
+        variant = ua.Variant(attrs.Value, None, None, False)
+        attributes[ua.AttributeIds.Value] = AttributeValue(
+            ua.DataValue(variant, SourceTimestamp=now)
+        )
+    return attributes
+
+
+class AddressSpaceBuilder:
+    """Collects nodes and inserts them into the address space in one pass.
+
+    The add methods take the same node id and browse name arguments as the methods of
+    asyncua.Node and return the node id of the node that build() will create. A parent
+    can be a node of the address space or a node added to the builder before.
+
+    Attributes
+    ----------
+    server : Server
+        Server whose address space the nodes are inserted into
+    items : list[ua.AddNodesItem]
+        Nodes to insert, in the order they were added
+
+    Methods
+    -------
+    add_folder:
+        Adds a folder node
+    add_object:
+        Adds an object node
+    add_variable:
+        Adds a variable node
+    build:
+        Inserts all added nodes into the address space
+    """
+
+    def __init__(self, server: Server) -> None:
+        """Create AddressSpaceBuilder object.
+
+        :param server: Initialized server the nodes are inserted into
+        """
+        self.server = server
+        self.items: list[ua.AddNodesItem] = []
+        self._index: dict[ua.NodeId, ua.AddNodesItem] = {}
+
+    def _add(
+        self,
+        parent,
+        nodeid,
+        bname,
+        node_class: ua.NodeClass,
+        type_definition: ua.NodeId,
+        attrs,
+        descr: str | None,
+    ) -> ua.NodeId:
+        nodeid, qname = _parse_nodeid_qname(nodeid, bname)
+        if nodeid.has_null_identifier():
+            nodeid = self.server.iserver.aspace.generate_nodeid(nodeid.NamespaceIndex)
+        if isinstance(parent, str):
+            parent = ua.NodeId.from_string(parent)
+        parent = getattr(parent, "nodeid", parent)
+        attrs.DisplayName = ua.LocalizedText(qname.Name)
+        if descr is None:
+            attrs.Description = ua.LocalizedText(qname.Name)
+        else:
+            attrs.Description = ua.LocalizedText(descr, "en")
+        attrs.WriteMask = 0
+        attrs.UserWriteMask = 0
+        item = ua.AddNodesItem(
+            ParentNodeId=parent,
+            RequestedNewNodeId=nodeid,
+            BrowseName=qname,
+            NodeClass_=node_class,
+            NodeAttributes=attrs,
+            TypeDefinition=type_definition,
+        )
+        self.items.append(item)
+        self._index[nodeid] = item
+        return nodeid
+
+    def add_folder(self, parent, nodeid, bname, descr: str = None) -> ua.NodeId:
+        """Add a folder node.
+
+        :param parent: Parent Node, NodeId or node id string
+        :param nodeid: Node id (string) or namespace index of the new node
+        :param bname: Browse name of the new node
+        :param descr: Description, defaults to the browse name
+        :return: NodeId of the new node
+        """
+        attrs = ua.ObjectAttributes(EventNotifier=0)
+        return self._add(
+            parent, nodeid, bname, ua.NodeClass.Object, FOLDER_TYPE, attrs, descr
+        )
+
+    def add_object(self, parent, nodeid, bname, descr: str = None) -> ua.NodeId:
+        """Add an object node of the BaseObjectType.
+
+        :param parent: Parent Node, NodeId or node id string
+        :param nodeid: Node id (string) or namespace index of the new node
+        :param bname: Browse name of the new node
+        :param descr: Description, defaults to the browse name
+        :return: NodeId of the new node
+        """
+        attrs = ua.ObjectAttributes(EventNotifier=0)
+        return self._add(
+            parent,
+            nodeid,
+            bname,
+            ua.NodeClass.Object,
+            ua.NodeId(ua.ObjectIds.BaseObjectType),
+            attrs,
+            descr,
+        )
+
+    def add_variable(
+        self,
+        parent,
+        nodeid,
+        bname,
+        val,
+        descr: str = None,
+        varianttype: ua.VariantType = None,
+        datatype: ua.NodeId = None,
+        writable: bool = False,
+    ) -> ua.NodeId:
+        """Add a variable node of the BaseDataVariableType.
+
+        :param parent: Parent Node, NodeId or node id string
+        :param nodeid: Node id (string) or namespace index of the new node
+        :param bname: Browse name of the new node
+        :param val: Initial value
+        :param descr: Description, defaults to the browse name
+        :param varianttype: Variant type of the value, guessed if not given
+        :param datatype: DataType of the node, guessed from the value if not given
+        :param writable: Whether clients may write the value, defaults to False
+        :return: NodeId of the new node
+        """
+        var = val if isinstance(val, ua.Variant) else ua.Variant(val, varianttype)
+        access = ua.AccessLevel.CurrentRead.mask
+        if writable:
+            access |= ua.AccessLevel.CurrentWrite.mask
+        attrs = ua.VariableAttributes(
+            Value=var,
+            DataType=datatype or _guess_datatype(var),
+            Historizing=False,
+            AccessLevel=access,
+            UserAccessLevel=access,
+        )
+        if not isinstance(var.Value, (list, tuple)):
+            attrs.ValueRank = ua.ValueRank.Scalar
+            attrs.ArrayDimensions = None
+        elif var.Dimensions:
+            attrs.ValueRank = len(var.Dimensions)
+            attrs.ArrayDimensions = var.Dimensions
+        return self._add(
+            parent,
+            nodeid,
+            bname,
+            ua.NodeClass.Variable,
+            ua.NodeId(ua.ObjectIds.BaseDataVariableType),
+            attrs,
+            descr,
+        )
+
+    def _check(self) -> None:
+        """Raise if a node exists already or its parent is unknown."""
+        aspace = self.server.iserver.aspace
+        if len(self._index) != len(self.items):
+            seen = set()
+            for item in self.items:
+                if item.RequestedNewNodeId in seen:
+                    raise ua.uaerrors.BadNodeIdExists(item.RequestedNewNodeId)
+                seen.add(item.RequestedNewNodeId)
+        for item in self.items:
+            if item.RequestedNewNodeId in aspace:
+                raise ua.uaerrors.BadNodeIdExists(item.RequestedNewNodeId)
+            if item.ParentNodeId not in self._index and item.ParentNodeId not in aspace:
+                raise ua.uaerrors.BadParentNodeIdInvalid(item.ParentNodeId)
+
+    def _parent_info(self, nodeid: ua.NodeId, cache: dict) -> tuple:
+        """Return node class, browse name, display name and type of a parent."""
+        info = cache.get(nodeid)
+        if info is None:
+            item = self._index.get(nodeid)
+            if item is not None:
+                info = (
+                    item.NodeClass,
+                    item.BrowseName,
+                    item.NodeAttributes.DisplayName,
+                    item.TypeDefinition,
+                )
+            else:
+                attributes = self.server.iserver.aspace[nodeid].attributes
+                type_definition = ua.NodeId()
+                for ref in self.server.iserver.aspace[nodeid].references:
+                    if ref.IsForward and ref.ReferenceTypeId == HAS_TYPE_DEFINITION:
+                        type_definition = ref.NodeId
+                info = (
+                    attributes[ua.AttributeIds.NodeClass].value.Value.Value,
+                    attributes[ua.AttributeIds.BrowseName].value.Value.Value,
+                    attributes[ua.AttributeIds.DisplayName].value.Value.Value,
+                    type_definition,
+                )
+            cache[nodeid] = info
+        return info
+
+    def build(self) -> list[ua.NodeId]:
+        """Insert all added nodes into the address space.
+
+        Nothing is inserted if a node id exists already or a parent is unknown. The
+        builder is empty afterwards.
+
+        :return: NodeIds of the inserted nodes
+        :raises ua.uaerrors.BadNodeIdExists: If a node id is used twice
+        :raises ua.uaerrors.BadParentNodeIdInvalid: If a parent is neither in the batch
+        nor in the address space
+        """
+        self._check()
+        aspace = self.server.iserver.aspace
+        now = datetime.utcnow()
+        shared: dict[tuple, ua.DataValue] = {}
+        parents: dict[ua.NodeId, tuple] = {}
+        targets: dict[ua.NodeId, tuple] = {}
+        for item in self.items:
+            nodeid = item.RequestedNewNodeId
+            nodedata = NodeData(nodeid)
+            nodedata.attributes = _attributes(item, now, shared)
+            aspace[nodeid] = nodedata
+            parent_class, parent_bname, parent_dname, parent_type = self._parent_info(
+                item.ParentNodeId, parents
+            )
+            if item.NodeClass == ua.NodeClass.Object and parent_type == FOLDER_TYPE:
+                reftype = ua.NodeId(ua.ObjectIds.Organizes)
+            else:
+                reftype = ua.NodeId(ua.ObjectIds.HasComponent)
+            aspace[item.ParentNodeId].references.append(
+                ua.ReferenceDescription(
+                    ReferenceTypeId=reftype,
+                    IsForward=True,
+                    NodeId=nodeid,
+                    BrowseName=item.BrowseName,
+                    DisplayName=item.NodeAttributes.DisplayName,
+                    NodeClass_=item.NodeClass,
+                    TypeDefinition=item.TypeDefinition,
+                )
+            )
+            nodedata.references.append(
+                ua.ReferenceDescription(
+                    ReferenceTypeId=reftype,
+                    IsForward=False,
+                    NodeId=item.ParentNodeId,
+                    BrowseName=parent_bname,
+                    DisplayName=parent_dname,
+                    NodeClass_=parent_class,
+                )
+            )
+            _, type_bname, type_dname, _ = self._parent_info(
+                item.TypeDefinition, targets
+            )
+            nodedata.references.append(
+                ua.ReferenceDescription(
+                    ReferenceTypeId=HAS_TYPE_DEFINITION,
+                    IsForward=True,
+                    NodeId=item.TypeDefinition,
+                    BrowseName=type_bname,
+                    DisplayName=type_dname,
+                    NodeClass_=ua.NodeClass.DataType,
+                )
+            )
+        nodeids = [item.RequestedNewNodeId for item in self.items]
+        self.items = []
+        self._index = {}
+        _logger.debug(f"Built {len(nodeids)} nodes")
+        return nodeids
@@ -0,0 +1,284 @@
+"""Symmetric secure channel crypto of large messages in a worker pool.
+
+With a Sign or SignAndEncrypt security policy, asyncua signs and encrypts every chunk
+of a response (SecureConnection.message_to_binary, MessageChunk.to_binary) and
+decrypts and verifies every received chunk (receive_from_header_and_body) on the event
+loop, so a big history read or browse result stalls all other sessions while it is
+encrypted. cryptography releases the GIL while it hashes and ciphers, so the work can
+run in threads.
+
+After install(), the server connections use OffloadingUaProcessor:
+* Responses of at least min_size bytes are split into chunks and numbered on the event
+  loop as before, then every chunk is signed and encrypted in the pool, the chunks of a
+  message in parallel. The connection writes its responses in order, a response sent
+  while a large one is sealed waits for it.
+* Received chunks of at least min_size bytes are decrypted and verified in the pool. The
+  messages of a connection are still processed one after another, other connections
+  and the event loop continue meanwhile.
+The keys are taken on the event loop when the work is submitted, so a token renewal
+doesn't change the keys of chunks that are already sealed or opened. Small messages
+and OpenSecureChannel messages (asymmetric crypto) stay on the event loop.
+
+Classes
+-------
+OffloadingSecureConnection
+    SecureConnection that seals and opens chunks in a worker pool.
+OffloadingUaProcessor
+    UaProcessor that offloads the crypto of large messages.
+
+Functions
+---------
+install
+    Makes asyncua servers use OffloadingUaProcessor.
+"""
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+import logging
+
+from asyncua import ua
+from asyncua.common.connection import InvalidSignature, MessageChunk, SecureConnection
+from asyncua.crypto.security_policies import Cryptography
+from asyncua.server import binary_server_asyncio
+from asyncua.server.uaprocessor import UaProcessor
+from asyncua.ua.ua_binary import header_to_binary, struct_from_binary, struct_to_binary
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+# smaller messages are cheaper to secure than to hand over to a thread
+MIN_OFFLOAD_SIZE = 32 * 1024
+SYMMETRIC_MESSAGE_TYPES = (ua.MessageType.SecureMessage, ua.MessageType.SecureClose)
+
+_executor: Executor | None = None
+_min_size = MIN_OFFLOAD_SIZE
+
+
+def _seal(prefix: bytes, plain: bytes, signer, encryptor) -> bytes:
+    """Sign and encrypt a chunk, runs in the pool."""
+    plain += signer.signature(prefix + plain)
+    if encryptor is not None:
+        plain = encryptor.encrypt(plain)
+    return prefix + plain
+
+
+def _open(
+    crypto: Cryptography,
+    header: ua.Header,
+    security_header: ua.SymmetricAlgorithmHeader,
+    data: bytes,
+    keys: list,
+) -> MessageChunk:
+    """Decrypt and verify a chunk with the first matching keys, runs in the pool."""
+    prefix = header_to_binary(header) + struct_to_binary(security_header)
+    for position, (decryptor, verifier) in enumerate(keys, 1):
+        decrypted = decryptor.decrypt(data) if crypto.is_encrypted else data
+        signature_size = verifier.signature_size()
+        signature = decrypted[-signature_size:]
+        decrypted = decrypted[:-signature_size]
+        try:
+            verifier.verify(prefix + decrypted, signature)
+            break
+        except InvalidSignature:
+            # the peer may still use the keys before the last token renewal
+            if position == len(keys):
+                raise
+    if crypto.is_encrypted:
+        if decryptor.encrypted_block_size() > 256:
+            pad_size = int.from_bytes(decrypted[-2:], "little", signed=True) + 2
+        else:
+            pad_size = decrypted[-1] + 1
+        decrypted = decrypted[:-pad_size]
+    chunk = MessageChunk(crypto, msg_type=header.MessageType)
+    chunk.MessageHeader = header
+    chunk.SecurityHeader = security_header
+    body = ua.utils.Buffer(decrypted)
+    chunk.SequenceHeader = struct_from_binary(ua.SequenceHeader, body)
+    chunk.Body = body.read(len(body))
+    return chunk
+
+
+class OffloadingSecureConnection(SecureConnection):
+    """SecureConnection that seals and opens chunks in a worker pool.
+
+    Methods
+    -------
+    offloads:
+        Returns if a message of a size is secured in the pool
+    message_to_binary_async:
+        Converts a message to binary, securing its chunks in the pool
+    receive_async:
+        Opens a received chunk in the pool and returns the complete message
+    """
+
+    def offloads(self, size: int) -> bool:
+        """Return if a message of a size is secured in the pool.
+
+        :param size: Size of the message body or received chunk in bytes
+        """
+        return (
+            _executor is not None
+            and size >= _min_size
+            and isinstance(self.security_policy.symmetric_cryptography, Cryptography)
+        )
+
+    def message_to_binary_async(
+        self, message: bytes, request_id: int = 0
+    ) -> asyncio.Future:
+        """Convert a SecureMessage to binary, securing its chunks in the pool.
+
+        The chunks are numbered before the method returns, like message_to_binary().
+
+        :param message: Encoded message body
+        :param request_id: Request id of the message, defaults to 0
+        :return: Future of the binary message
+        """
+        crypto = self.security_policy.symmetric_cryptography
+        loop = asyncio.get_running_loop()
+        chunks = MessageChunk.message_to_chunks(
+            self.security_policy,
+            message,
+            self._max_chunk_size,
+            channel_id=self.security_token.ChannelId,
+            request_id=request_id,
+            token_id=self.security_token.TokenId,
+        )
+        sealed = []
+        for chunk in chunks:
+            self._sequence_number += 1
+            if self._sequence_number >= (1 << 32):
+                self._sequence_number = 1
+            chunk.SequenceHeader.SequenceNumber = self._sequence_number
+            security = struct_to_binary(chunk.SecurityHeader)
+            plain = struct_to_binary(chunk.SequenceHeader) + chunk.Body
+            plain += crypto.padding(len(plain))
+            chunk.MessageHeader.body_size = len(security) + chunk.encrypted_size(
+                len(plain)
+            )
+            prefix = header_to_binary(chunk.MessageHeader) + security
+            encryptor = crypto.Encryptor if crypto.is_encrypted else None
+            sealed.append(
+                loop.run_in_executor(
+                    _executor, _seal, prefix, plain, crypto.Signer, encryptor
+                )
+            )
+
+        async def join() -> bytes:
+            return b"".join([await future for future in sealed])
+
+        return asyncio.ensure_future(join())
+
+    async def receive_async(self, header: ua.Header, body: ua.utils.Buffer):
+        """Open a received SecureMessage or SecureClose chunk in the pool.
+
+        :param header: Message header of the chunk
+        :param body: Buffer positioned at the body of the chunk
+        :return: The complete message, None for intermediate and aborted chunks
+        :raises InvalidSignature: If the chunk verifies with none of the keys
+        """
+        data = body.copy(header.body_size)
+        body.skip(header.body_size)
+        security_header = struct_from_binary(ua.SymmetricAlgorithmHeader, data)
+        self._check_sym_header(security_header)
+        crypto = self.security_policy.symmetric_cryptography
+        crypto.revolved_expired_key()
+        keys = [(crypto.Decryptor, crypto.Verifier)]
+        if crypto.Prev_Decryptor and crypto.Prev_Verifier:
+            keys.append((crypto.Prev_Decryptor, crypto.Prev_Verifier))
+        chunk = await asyncio.get_running_loop().run_in_executor(
+            _executor,
+            _open,
+            crypto,
+            header,
+            security_header,
+            data.read(len(data)),
+            keys,
+        )
+        return self._receive(chunk)
+
+
+class OffloadingUaProcessor(UaProcessor):
+    """UaProcessor that offloads the crypto of large messages.
+
+    Methods
+    -------
+    send_response:
+        Sends a response, large responses are sealed in the pool
+    process:
+        Processes a received chunk, large chunks are opened in the pool
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._connection = OffloadingSecureConnection(ua.SecurityPolicy())
+        # last write that waits for a response sealed in the pool
+        self._pending_write: asyncio.Future | None = None
+
+    def send_response(
+        self, requesthandle, seqhdr, response, msgtype=ua.MessageType.SecureMessage
+    ) -> None:
+        response.ResponseHeader.RequestHandle = requesthandle
+        message = struct_to_binary(response)
+        if self._pending_write is not None and self._pending_write.done():
+            self._pending_write = None
+        if msgtype == ua.MessageType.SecureMessage and self._connection.offloads(
+            len(message)
+        ):
+            data = self._connection.message_to_binary_async(message, seqhdr.RequestId)
+        else:
+            data = self._connection.message_to_binary(
+                message, message_type=msgtype, request_id=seqhdr.RequestId
+            )
+            if self._pending_write is None:
+                self._transport.write(data)
+                return
+        self._pending_write = asyncio.ensure_future(
+            self._write_after(self._pending_write, data)
+        )
+
+    async def _write_after(self, previous: asyncio.Future | None, data) -> None:
+        if previous is not None:
+            await previous
+        try:
+            if isinstance(data, asyncio.Future):
+                data = await data
+        except Exception:
+            _logger.exception("Securing a response failed, closing connection")
+            self._transport.close()
+            return
+        if not self._transport.is_closing():
+            self._transport.write(data)
+
+    async def process(self, header, body) -> bool:
+        if header.MessageType not in SYMMETRIC_MESSAGE_TYPES or not (
+            self._connection.offloads(header.body_size)
+        ):
+            return await super().process(header, body)
+        msg = await self._connection.receive_async(header, body)
+        if msg is None:
+            # intermediate or aborted chunk
+            return True
+        if header.MessageType == ua.MessageType.SecureClose:
+            self._connection.close()
+            return False
+        return await self.process_message(msg.SequenceHeader(), msg.body())
+
+    async def close(self) -> None:
+        if self._pending_write is not None:
+            await asyncio.gather(self._pending_write, return_exceptions=True)
+        await super().close()
+
+
+def install(max_workers: int | None = None, min_size: int = MIN_OFFLOAD_SIZE) -> None:
+    """Make asyncua servers use OffloadingUaProcessor.
+
+    Affects connections made after the call.
+
+    :param max_workers: Number of crypto threads, defaults to the default of
+    ThreadPoolExecutor
+    :param min_size: Size in bytes from which messages and chunks are secured in the
+    pool, defaults to MIN_OFFLOAD_SIZE
+    """
+    global _executor, _min_size
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers, thread_name_prefix="opcua-crypto")
+    _min_size = min_size
+    binary_server_asyncio.UaProcessor = OffloadingUaProcessor
@@ -0,0 +1,191 @@
+"""Per-interval statistics for aggregated history reads.
+
+The Values nodes hold arrays (one element per unit), so all statistics are kept per
+array element. The aggregates (Average, Minimum, Maximum, Count and RMS) are computed
+from the count, sum, sum of squares, minimum and maximum of an interval, which can be
+accumulated value by value and merged across intervals.
+
+Classes
+-------
+BucketStats
+    Running count, sum, sum of squares, minimum and maximum of the values in an interval.
+
+Functions
+---------
+bucket_count
+    Number of processing intervals in a time range.
+bucketize_columns
+    Computes the statistics of every interval from columnar values.
+"""
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+import math
+
+from asyncua import ua
+
+
+@dataclass
+class BucketStats:
+    """Statistics of the values in one processing interval.
+
+    The statistics are kept per array element, scalar values are treated as arrays with
+    one element.
+
+    Attributes
+    ----------
+    count : int
+        Number of values
+    sums : list[float]
+        Sum of the values
+    squares : list[float]
+        Sum of the squared values
+    minimums : list[float]
+        Smallest value
+    maximums : list[float]
+        Largest value
+    is_array : bool
+        Whether the values are arrays
+
+    Methods
+    -------
+    add:
+        Adds a value to the statistics
+    merge:
+        Adds the statistics of another interval
+    aggregate:
+        Computes an aggregate from the statistics
+    """
+
+    count: int = 0
+    sums: list[float] = field(default_factory=list)
+    squares: list[float] = field(default_factory=list)
+    minimums: list[float] = field(default_factory=list)
+    maximums: list[float] = field(default_factory=list)
+    is_array: bool = True
+
+    def add(self, value: list[float] | float) -> None:
+        """Add a value to the statistics.
+
+        :param value: Array or scalar value
+        """
+        if not isinstance(value, (list, array)):
+            self.is_array = False
+            value = [value]
+        if not self.count:
+            self.sums = [0.0] * len(value)
+            self.squares = [0.0] * len(value)
+            self.minimums = list(value)
+            self.maximums = list(value)
+        for i, element in enumerate(value[: len(self.sums)]):
+            self.sums[i] += element
+            self.squares[i] += element * element
+            if element < self.minimums[i]:
+                self.minimums[i] = element
+            elif element > self.maximums[i]:
+                self.maximums[i] = element
+        self.count += 1
+
+    def merge(self, other: "BucketStats") -> None:
+        """Add the statistics of another interval, e.g. of a sub-interval.
+
+        :param other: Statistics to add
+        """
+        if not other.count:
+            return
+        if not self.count:
+            self.sums = list(other.sums)
+            self.squares = list(other.squares)
+            self.minimums = list(other.minimums)
+            self.maximums = list(other.maximums)
+            self.is_array = other.is_array
+        else:
+            for i in range(min(len(self.sums), len(other.sums))):
+                self.sums[i] += other.sums[i]
+                self.squares[i] += other.squares[i]
+                self.minimums[i] = min(self.minimums[i], other.minimums[i])
+                self.maximums[i] = max(self.maximums[i], other.maximums[i])
+        self.count += other.count
+
+    def aggregate(self, name: str) -> ua.Variant:
+        """Compute an aggregate from the statistics.
+
+        :param name: One of "average", "minimum", "maximum", "count" or "rms"
+        :return: Aggregated value, None if there were no values in the interval
+        """
+        if name == "count":
+            return ua.Variant(self.count, ua.VariantType.UInt32)
+        if not self.count:
+            return None
+        if name == "average":
+            value = [total / self.count for total in self.sums]
+        elif name == "rms":
+            value = [math.sqrt(total / self.count) for total in self.squares]
+        elif name == "minimum":
+            value = self.minimums
+        else:
+            value = self.maximums
+        return ua.Variant(value if self.is_array else value[0], ua.VariantType.Double)
+
+
+def bucket_count(start: int, end: int, interval: int) -> int:
+    """Count the processing intervals of a time range, the last one may be shorter.
+
+    :param start: Start of the time range in microseconds
+    :param end: End of the time range in microseconds (exclusive)
+    :param interval: Length of the intervals in microseconds
+    :return: Number of intervals
+    """
+    return max(0, -(-(end - start) // interval))
+
+
+def bucketize_columns(
+    timestamps: list[int],
+    columns: list[list[float]],
+    is_array: bool,
+    start: int,
+    end: int,
+    interval: int,
+    buckets: list[BucketStats],
+) -> None:
+    """Add columnar values to the statistics of the intervals they belong to.
+
+    If the timestamps are sorted, every interval is reduced with min/max/sum over a
+    slice of each column instead of value by value.
+
+    :param timestamps: Timestamps of the values in microseconds
+    :param columns: One list of values per array element
+    :param is_array: Whether the values are arrays
+    :param start: Start of the first interval in microseconds
+    :param end: End of the last interval in microseconds (exclusive)
+    :param interval: Length of the intervals in microseconds
+    :param buckets: Statistics of the intervals, updated in place
+    """
+    if not timestamps or not columns:
+        return
+    if any(a > b for a, b in zip(timestamps, timestamps[1:])):
+        for i, timestamp in enumerate(timestamps):
+            if start <= timestamp < end:
+                values = [column[i] for column in columns]
+                buckets[(timestamp - start) // interval].add(
+                    values if is_array else values[0]
+                )
+        return
+    first = max(0, (timestamps[0] - start) // interval)
+    last = min(len(buckets) - 1, (timestamps[-1] - start) // interval)
+    for idx in range(first, last + 1):
+        lo = bisect_left(timestamps, start + idx * interval)
+        hi = bisect_left(timestamps, min(start + (idx + 1) * interval, end))
+        if lo >= hi:
+            continue
+        slices = [column[lo:hi] for column in columns]
+        buckets[idx].merge(
+            BucketStats(
+                count=hi - lo,
+                sums=[math.fsum(s) for s in slices],
+                squares=[math.fsum(x * x for x in s) for s in slices],
+                minimums=[min(s) for s in slices],
+                maximums=[max(s) for s in slices],
+                is_array=is_array,
+            )
+        )
@@ -0,0 +1,697 @@
+"""Compact columnar history backend for decoded sensor values.
+
+SQLite stores every sample as a row with text, type name and a binary Variant, which is
+many times larger than the floats themselves. This backend keeps the history of every
+historized node as append-only segment files in a directory per node. A segment holds
+up to segment_size samples as columns:
+
+* timestamps (microseconds since the unix epoch), delta-of-delta encoded as zigzag
+  varints
+* one float64 column per value (unit), XOR encoded like in Facebook's Gorilla paper
+
+Every segment starts with a fixed size header that contains the time range of the
+segment, so range queries only decode the segments they need. Segment files are read
+through mmap. The segment that is currently being filled is kept in memory and written
+when it is full, when the number of values changes or when the server stops. Every
+flush_interval seconds it is also saved to a checkpoint file of its node, which init()
+loads back, so a killed process loses at most the samples of the last interval.
+Segments are encoded, written, read and decoded by a worker thread, not in the event
+loop.
+
+Only numeric values (and arrays of them) can be stored. Status codes are not stored,
+read values are always Good and their server timestamp equals the source timestamp.
+
+Classes
+-------
+ColumnarHistory
+    History storage for data changes of numeric variable nodes.
+"""
+from array import array
+import asyncio
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import logging
+import mmap
+import os
+import struct
+from urllib.parse import quote, unquote
+
+from asyncua import ua
+from asyncua.server.history import HistoryStorageInterface
+
+from opcua_server.history_aggregates import (
+    BucketStats,
+    bucket_count,
+    bucketize_columns,
+)
+from opcua_server.history_manager import history_bounds
+from opcua_server.history_sqlite import datetime_to_us, us_to_datetime
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+SEGMENT_MAGIC = b"NNEC"
+SEGMENT_VERSION = 1
+# magic, version, is_array, number of columns, number of samples, first and last
+# timestamp, length of the timestamp block
+SEGMENT_HEADER = struct.Struct("<4sBBHIqqI")
+FLAG_ARRAY = 1
+# checkpoint of the in-memory segment, in the format of a segment file
+OPEN_SEGMENT = "open.part"
+
+
+class _BitWriter:
+    """Writes values of arbitrary bit length to a byte array."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self._acc = 0
+        self._nacc = 0
+
+    def write(self, bits: int, length: int) -> None:
+        self._acc = (self._acc << length) | bits
+        self._nacc += length
+        while self._nacc >= 8:
+            self._nacc -= 8
+            self.buffer.append((self._acc >> self._nacc) & 0xFF)
+        self._acc &= (1 << self._nacc) - 1
+
+    def to_bytes(self) -> bytes:
+        if self._nacc:
+            return bytes(self.buffer) + bytes([(self._acc << (8 - self._nacc)) & 0xFF])
+        return bytes(self.buffer)
+
+
+class _BitReader:
+    """Reads values of arbitrary bit length from bytes."""
+
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+        self._pos = 0
+
+    def read(self, length: int) -> int:
+        byte_pos = self._pos >> 3
+        shift = self._pos & 7
+        nbytes = (shift + length + 7) >> 3
+        chunk = int.from_bytes(self._data[byte_pos : byte_pos + nbytes], "big")
+        self._pos += length
+        return (chunk >> (nbytes * 8 - shift - length)) & ((1 << length) - 1)
+
+
+def _float_to_bits(value: float) -> int:
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def _bits_to_float(bits: int) -> float:
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+
+def encode_floats(values: list[float]) -> bytes:
+    """XOR encode a column of floats.
+
+    :param values: Floats to encode, at least one
+    :return: Encoded bytes
+    """
+    writer = _BitWriter()
+    prev = _float_to_bits(values[0])
+    writer.write(prev, 64)
+    prev_lz, prev_tz = 65, 65
+    for value in values[1:]:
+        bits = _float_to_bits(value)
+        xor = bits ^ prev
+        prev = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        lz = min(64 - xor.bit_length(), 31)
+        tz = (xor & -xor).bit_length() - 1
+        if lz >= prev_lz and tz >= prev_tz:
+            # meaningful bits fit into the window of the previous value
+            writer.write(0b10, 2)
+            writer.write(xor >> prev_tz, 64 - prev_lz - prev_tz)
+        else:
+            significant = 64 - lz - tz
+            writer.write(0b11, 2)
+            writer.write(lz, 5)
+            writer.write(significant - 1, 6)
+            writer.write(xor >> tz, significant)
+            prev_lz, prev_tz = lz, tz
+    return writer.to_bytes()
+
+
+def decode_floats(data: bytes, count: int) -> list[float]:
+    """Decode a column of floats encoded with encode_floats.
+
+    :param data: Encoded bytes
+    :param count: Number of encoded floats
+    :return: Decoded floats
+    """
+    reader = _BitReader(data)
+    prev = reader.read(64)
+    values = [_bits_to_float(prev)]
+    prev_lz, prev_tz = 0, 0
+    for _ in range(count - 1):
+        if reader.read(1) == 0:
+            values.append(values[-1])
+            continue
+        if reader.read(1) == 1:
+            prev_lz = reader.read(5)
+            significant = reader.read(6) + 1
+            prev_tz = 64 - prev_lz - significant
+        prev ^= reader.read(64 - prev_lz - prev_tz) << prev_tz
+        values.append(_bits_to_float(prev))
+    return values
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    # zigzag encoding keeps small negative numbers small
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), pos
+
+
+def encode_timestamps(timestamps: list[int]) -> bytes:
+    """Delta-of-delta encode timestamps, the first one is stored in the header.
+
+    :param timestamps: Timestamps in microseconds, at least one
+    :return: Encoded bytes
+    """
+    buffer = bytearray()
+    prev_delta = 0
+    for prev, current in zip(timestamps, timestamps[1:]):
+        delta = current - prev
+        _write_varint(buffer, delta - prev_delta)
+        prev_delta = delta
+    return bytes(buffer)
+
+
+def decode_timestamps(data: bytes, first: int, count: int) -> list[int]:
+    """Decode timestamps encoded with encode_timestamps.
+
+    :param data: Encoded bytes
+    :param first: First timestamp
+    :param count: Number of timestamps
+    :return: Timestamps in microseconds
+    """
+    timestamps = [first]
+    delta = 0
+    pos = 0
+    for _ in range(count - 1):
+        delta_of_delta, pos = _read_varint(data, pos)
+        delta += delta_of_delta
+        timestamps.append(timestamps[-1] + delta)
+    return timestamps
+
+
+@dataclass
+class _Segment:
+    """Header information of a segment file."""
+
+    path: str
+    t_first: int
+    t_last: int
+    count: int
+
+
+@dataclass
+class _NodeHistory:
+    """Segments and the in-memory segment of one historized node."""
+
+    directory: str
+    period: timedelta = None
+    count: int = 0
+    segments: list[_Segment] = field(default_factory=list)
+    is_array: bool = False
+    timestamps: list[int] = field(default_factory=list)
+    columns: list[list[float]] = field(default_factory=list)
+    # number of in-memory samples in the checkpoint file
+    checkpointed: int = 0
+    # detached in-memory segments (timestamps, columns, is_array) being written
+    pending: list[tuple] = field(default_factory=list)
+
+
+class ColumnarHistory(HistoryStorageInterface):
+    """History storage that keeps numeric values in compressed columnar segments.
+
+    Attributes
+    ----------
+    path : str
+        Directory that holds one directory of segments per historized node
+    segment_size : int
+        Maximum number of samples per segment
+    flush_interval : float
+        Number of seconds between two checkpoints of the in-memory segments
+
+    Methods
+    -------
+    flush:
+        Writes the in-memory segments of all nodes to disk
+    checkpoint:
+        Saves the in-memory segments of all nodes to their checkpoint files
+    read_node_buckets:
+        Computes the statistics of the values of a node per processing interval
+    """
+
+    def __init__(
+        self,
+        path: str = "history",
+        segment_size: int = 4096,
+        flush_interval: float = 5.0,
+        max_history_data_response_size: int = 10000,
+    ) -> None:
+        """Create ColumnarHistory object.
+
+        :param path: Directory of the history, defaults to "history"
+        :param segment_size: Maximum number of samples per segment, defaults to 4096
+        :param flush_interval: Number of seconds between two checkpoints of the
+        in-memory segments, defaults to 5.0
+        :param max_history_data_response_size: Maximum number of values returned per
+        history read, defaults to 10000
+        """
+        super().__init__(max_history_data_response_size)
+        self.path = path
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self._nodes: dict[ua.NodeId, _NodeHistory] = {}
+        # a single worker keeps the file operations of a node in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._flush_task: asyncio.Task = None
+
+    async def init(self) -> None:
+        """Build the segment index from the headers of the existing segment files.
+
+        The checkpoints of the in-memory segments are loaded back into memory, and
+        checkpointing starts.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for directory in os.listdir(self.path):
+            nodeid = ua.NodeId.from_string(unquote(directory))
+            history = _NodeHistory(directory=os.path.join(self.path, directory))
+            for filename in sorted(os.listdir(history.directory)):
+                if not filename.endswith(".seg"):
+                    continue
+                seg_path = os.path.join(history.directory, filename)
+                with open(seg_path, "rb") as f:
+                    header = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+                if header[0] != SEGMENT_MAGIC:
+                    _logger.warning(f"Skipping invalid history segment {seg_path}")
+                    continue
+                history.segments.append(
+                    _Segment(
+                        seg_path, t_first=header[5], t_last=header[6], count=header[4]
+                    )
+                )
+            history.segments.sort(key=lambda segment: segment.t_first)
+            self._load_checkpoint(history)
+            self._nodes[nodeid] = history
+        _logger.info(f"Loaded history index of {len(self._nodes)} nodes")
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Write the in-memory segments to disk."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        self._executor.shutdown()
+
+    async def flush(self) -> None:
+        """Write the in-memory segments of all nodes to disk."""
+        for history in list(self._nodes.values()):
+            await self._write_segment(history)
+
+    async def checkpoint(self) -> None:
+        """Save the in-memory segments of all nodes to their checkpoint files.
+
+        Only segments with samples added since their last checkpoint are saved.
+        """
+        for history in list(self._nodes.values()):
+            count = len(history.timestamps)
+            if not count or count == history.checkpointed:
+                continue
+            history.checkpointed = count
+            await self._run(
+                self._write_file,
+                os.path.join(history.directory, OPEN_SEGMENT),
+                list(history.timestamps),
+                [list(column) for column in history.columns],
+                history.is_array,
+            )
+
+    async def _flush_periodically(self) -> None:
+        """Checkpoint the in-memory segments in the background."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.checkpoint()
+            except OSError as e:
+                _logger.error(f"Writing history failed: {e}")
+
+    async def _run(self, func, *args):
+        """Run a function in the file worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _load_checkpoint(self, history: _NodeHistory) -> None:
+        """Load the checkpoint of the in-memory segment of a node, if there is one."""
+        path = os.path.join(history.directory, OPEN_SEGMENT)
+        if not os.path.exists(path):
+            return
+        timestamps, columns, is_array = self._read_segment(path)
+        if any(segment.t_first == timestamps[0] for segment in history.segments):
+            # the segment was written, but the process stopped before the checkpoint
+            # was removed
+            os.remove(path)
+            return
+        history.timestamps, history.columns = timestamps, columns
+        history.is_array = is_array
+        history.checkpointed = len(timestamps)
+
+    async def new_historized_node(
+        self, node_id: ua.NodeId, period: timedelta, count: int = 0
+    ) -> None:
+        """Register a node for historizing, existing history of the node is kept.
+
+        :param node_id: NodeId of the historized node
+        :param period: How long data changes are kept, None to keep them forever
+        :param count: Maximum number of data changes kept, 0 for no limit
+        """
+        history = self._nodes.get(node_id)
+        if history is None:
+            directory = os.path.join(self.path, quote(node_id.to_string(), safe=""))
+            os.makedirs(directory, exist_ok=True)
+            history = self._nodes[node_id] = _NodeHistory(directory=directory)
+        history.period = period
+        history.count = count
+
+    async def save_node_value(
+        self, node_id: ua.NodeId, datavalue: ua.DataValue
+    ) -> None:
+        """Append a data change of a historized node to its in-memory segment.
+
+        :param node_id: NodeId of the historized node
+        :param datavalue: New value of the node
+        """
+        history = self._nodes[node_id]
+        value = datavalue.Value.Value
+        is_array = isinstance(value, (list, tuple, array))
+        try:
+            values = [float(v) for v in value] if is_array else [float(value)]
+        except (TypeError, ValueError):
+            _logger.error(f"Can't historize non numeric value {value} of {node_id}")
+            return
+        if history.timestamps and (
+            len(values) != len(history.columns) or is_array != history.is_array
+        ):
+            await self._write_segment(history)
+        if not history.timestamps:
+            history.is_array = is_array
+            history.columns = [[] for _ in values]
+        timestamp = datavalue.SourceTimestamp or datavalue.ServerTimestamp
+        history.timestamps.append(datetime_to_us(timestamp or datetime.utcnow()))
+        for column, v in zip(history.columns, values):
+            column.append(v)
+        if len(history.timestamps) >= self.segment_size:
+            await self._write_segment(history)
+
+    async def read_node_history(
+        self, node_id: ua.NodeId, start: datetime, end: datetime, nb_values: int
+    ) -> tuple[list[ua.DataValue], datetime | None]:
+        """Read the history of a node.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the time range, newest values first if missing
+        :param end: End of the time range
+        :param nb_values: Maximum number of values to return, 0 for no limit
+        :return: List of data values and the continuation point
+        """
+        history = self._nodes.get(node_id)
+        if history is None:
+            _logger.warning(
+                f"Attempt to read history of {node_id}, which is not historized"
+            )
+            return [], None
+        lo, hi, reverse = history_bounds(start, end)
+        limit = self.max_history_data_response_size + 1
+        if nb_values:
+            limit = min(limit, nb_values)
+
+        results: list[ua.DataValue] = []
+        async for timestamps, columns, is_array in self._iter_blocks(
+            history, lo, hi, reverse
+        ):
+            rows = range(len(timestamps))
+            for i in reversed(rows) if reverse else rows:
+                if not lo <= timestamps[i] <= hi:
+                    continue
+                values = [column[i] for column in columns]
+                timestamp = us_to_datetime(timestamps[i])
+                results.append(
+                    ua.DataValue(
+                        ua.Variant(
+                            values if is_array else values[0], ua.VariantType.Double
+                        ),
+                        SourceTimestamp=timestamp,
+                        ServerTimestamp=timestamp,
+                    )
+                )
+                if len(results) >= limit:
+                    break
+            if len(results) >= limit:
+                break
+
+        cont = None
+        if len(results) > self.max_history_data_response_size:
+            cont = results[self.max_history_data_response_size].SourceTimestamp
+            results = results[: self.max_history_data_response_size]
+        return results, cont
+
+    async def read_node_buckets(
+        self, node_id: ua.NodeId, start: int, end: int, interval: int
+    ) -> list[BucketStats]:
+        """Compute the statistics of the values of a node per processing interval.
+
+        The columns of every segment are reduced per interval, without building data
+        values. Segment files are decoded and reduced in the worker thread.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the first interval in microseconds
+        :param end: End of the last interval in microseconds (exclusive)
+        :param interval: Length of the intervals in microseconds
+        :return: Statistics of every interval
+        """
+        buckets = [BucketStats() for _ in range(bucket_count(start, end, interval))]
+        history = self._nodes.get(node_id)
+        if history is None:
+            _logger.warning(
+                f"Attempt to read history of {node_id}, which is not historized"
+            )
+            return buckets
+        for kind, block in self._blocks(history, start, end - 1, False):
+            if kind == "memory":
+                bucketize_columns(*block, start, end, interval, buckets)
+                continue
+            try:
+                await self._run(
+                    self._bucketize_segment, block.path, start, end, interval, buckets
+                )
+            except FileNotFoundError:
+                # deleted by the retention since the read started
+                continue
+        return buckets
+
+    async def _iter_blocks(
+        self, history: _NodeHistory, lo: int, hi: int, reverse: bool
+    ):
+        """Yield the decoded segments (and the in-memory one) overlapping [lo, hi].
+
+        Segment files are decoded in the worker thread.
+
+        :return: Asynchronous generator of timestamps, value columns and the array
+        flag
+        """
+        for kind, block in self._blocks(history, lo, hi, reverse):
+            if kind == "memory":
+                yield block
+                continue
+            try:
+                decoded = await self._run(self._read_segment, block.path)
+            except FileNotFoundError:
+                # deleted by the retention since the read started
+                continue
+            yield decoded
+
+    def _blocks(
+        self, history: _NodeHistory, lo: int, hi: int, reverse: bool
+    ) -> list[tuple[str, object]]:
+        """Return the segments (and the in-memory ones) overlapping [lo, hi] in order.
+
+        :return: List of ("file", segment) and ("memory", (timestamps, columns,
+        is_array)) tuples
+        """
+        firsts = [segment.t_first for segment in history.segments]
+        candidates = [
+            segment
+            for segment in history.segments[: bisect_right(firsts, hi)]
+            if segment.t_last >= lo
+        ]
+        blocks = [("file", segment) for segment in candidates]
+        # segments that are still being written are read from memory
+        blocks.extend(("memory", block) for block in history.pending)
+        if history.timestamps:
+            blocks.append(
+                ("memory", (history.timestamps, history.columns, history.is_array))
+            )
+        return blocks[::-1] if reverse else blocks
+
+    def _bucketize_segment(
+        self, path: str, start: int, end: int, interval: int, buckets: list
+    ) -> None:
+        """Decode a segment file and add its values to the interval statistics."""
+        timestamps, columns, is_array = self._read_segment(path)
+        bucketize_columns(timestamps, columns, is_array, start, end, interval, buckets)
+
+    def _read_segment(self, path: str) -> tuple[list[int], list[list[float]], bool]:
+        """Decode a segment file.
+
+        :param path: Location of the segment file
+        :return: Timestamps, value columns and whether the values are arrays
+        """
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            _, _, flags, ncols, count, t_first, _, ts_len = SEGMENT_HEADER.unpack_from(
+                mm
+            )
+            pos = SEGMENT_HEADER.size
+            col_lens = struct.unpack_from(f"<{ncols}I", mm, pos)
+            pos += 4 * ncols
+            timestamps = decode_timestamps(mm[pos : pos + ts_len], t_first, count)
+            pos += ts_len
+            columns = []
+            for col_len in col_lens:
+                columns.append(decode_floats(mm[pos : pos + col_len], count))
+                pos += col_len
+        return timestamps, columns, bool(flags & FLAG_ARRAY)
+
+    async def _write_segment(self, history: _NodeHistory) -> None:
+        """Write the in-memory segment of a node to a new segment file."""
+        if not history.timestamps:
+            return
+        block = (history.timestamps, history.columns, history.is_array)
+        history.timestamps = []
+        history.columns = []
+        history.checkpointed = 0
+        history.pending.append(block)
+        try:
+            segment = await self._run(self._write_segment_file, history, *block)
+        finally:
+            history.pending = [other for other in history.pending if other is not block]
+        history.segments.append(segment)
+        history.segments.sort(key=lambda segment: segment.t_first)
+        expired = self._apply_retention(history)
+        if expired:
+            await self._run(self._remove_files, expired)
+
+    def _write_segment_file(
+        self,
+        history: _NodeHistory,
+        timestamps: list[int],
+        columns: list[list[float]],
+        is_array: bool,
+    ) -> _Segment:
+        """Write a segment file and remove the checkpoint it replaces, in the worker.
+
+        :return: Header information of the new segment
+        """
+        path = os.path.join(history.directory, f"{timestamps[0]}.seg")
+        # a segment starting at the same microsecond would otherwise be overwritten
+        suffix = 0
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(history.directory, f"{timestamps[0]}-{suffix}.seg")
+        self._write_file(path, timestamps, columns, is_array)
+        checkpoint = os.path.join(history.directory, OPEN_SEGMENT)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return _Segment(
+            path,
+            t_first=timestamps[0],
+            t_last=max(timestamps),
+            count=len(timestamps),
+        )
+
+    @staticmethod
+    def _write_file(
+        path: str, timestamps: list[int], columns: list[list[float]], is_array: bool
+    ) -> None:
+        """Encode samples and write them to a file in the segment format."""
+        ts_block = encode_timestamps(timestamps)
+        col_blocks = [encode_floats(column) for column in columns]
+        header = SEGMENT_HEADER.pack(
+            SEGMENT_MAGIC,
+            SEGMENT_VERSION,
+            FLAG_ARRAY if is_array else 0,
+            len(col_blocks),
+            len(timestamps),
+            timestamps[0],
+            max(timestamps),
+            len(ts_block),
+        )
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(header)
+            f.write(struct.pack(f"<{len(col_blocks)}I", *map(len, col_blocks)))
+            f.write(ts_block)
+            for block in col_blocks:
+                f.write(block)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def _remove_files(paths: list[str]) -> None:
+        for path in paths:
+            os.remove(path)
+
+    def _apply_retention(self, history: _NodeHistory) -> list[str]:
+        """Drop segments that are outside of the period or count of a node.
+
+        Only whole segments are dropped, so up to one segment more than the period or
+        count is kept.
+
+        :return: Locations of the segment files to delete
+        """
+        keep = len(history.segments)
+        if history.period:
+            oldest = datetime_to_us(datetime.utcnow() - history.period)
+            while keep and history.segments[-keep].t_last < oldest:
+                keep -= 1
+        if history.count:
+            total = len(history.timestamps)
+            for i, segment in enumerate(
+                reversed(history.segments[-keep:] if keep else [])
+            ):
+                if total >= history.count:
+                    keep = i
+                    break
+                total += segment.count
+        expired = [
+            segment.path for segment in history.segments[: len(history.segments) - keep]
+        ]
+        history.segments = history.segments[len(history.segments) - keep :]
+        return expired
@@ -0,0 +1,192 @@
+"""History manager of the NNE MI OPC UA server with aggregated history reads.
+
+asyncua's HistoryManager only answers raw history reads, every other kind of read is
+rejected with BadNotImplemented. Dashboards that show a week of a sensor value had to
+download every sample and aggregate them on the client.
+
+AggregatingHistoryManager answers ReadProcessedDetails requests with the Average,
+Minimum, Maximum, Count and RMS of the values in every processing interval, so only one
+value per interval is sent to the client. RMS is not a standard aggregate, its
+AggregateType is the NodeId "AggregateFunction_RootMeanSquare" in the NNE MI namespace.
+
+Storages can compute the per-interval statistics themselves by implementing
+read_node_buckets(node_id, start, end, interval) - BatchedHistorySQLite and
+ColumnarHistory do. For other storages the raw history is read and aggregated here.
+
+Classes
+-------
+AggregatingHistoryManager
+    HistoryManager that also answers aggregated history reads.
+
+Functions
+---------
+read_node_buckets
+    Reads the per-interval statistics of a node from any history storage.
+history_bounds
+    Translates the time range of a raw history read to microseconds and an order.
+"""
+from datetime import datetime
+
+from asyncua import ua
+from asyncua.server.history import HistoryManager, HistoryStorageInterface
+from asyncua.server.internal_server import InternalServer
+
+from opcua_server.history_aggregates import BucketStats, bucket_count
+from opcua_server.history_sqlite import datetime_to_us, us_to_datetime
+
+RMS_AGGREGATE_NAME = "AggregateFunction_RootMeanSquare"
+STANDARD_AGGREGATES = {
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Average): "average",
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Minimum): "minimum",
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Maximum): "maximum",
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Count): "count",
+}
+
+
+async def read_node_buckets(
+    storage: HistoryStorageInterface,
+    node_id: ua.NodeId,
+    start: int,
+    end: int,
+    interval: int,
+) -> list[BucketStats]:
+    """Read the statistics of the values of a node per processing interval.
+
+    Storages without their own read_node_buckets are read raw and aggregated here.
+
+    :param storage: History storage of the node
+    :param node_id: NodeId of the historized node
+    :param start: Start of the first interval in microseconds
+    :param end: End of the last interval in microseconds (exclusive)
+    :param interval: Length of the intervals in microseconds
+    :return: Statistics of every interval
+    """
+    if hasattr(storage, "read_node_buckets"):
+        return await storage.read_node_buckets(node_id, start, end, interval)
+    buckets = [BucketStats() for _ in range(bucket_count(start, end, interval))]
+    read_from = us_to_datetime(start)
+    while read_from is not None:
+        datavalues, read_from = await storage.read_node_history(
+            node_id, read_from, us_to_datetime(end), 0
+        )
+        for datavalue in datavalues:
+            timestamp = datetime_to_us(datavalue.SourceTimestamp)
+            if start <= timestamp < end and datavalue.Value is not None:
+                buckets[(timestamp - start) // interval].add(datavalue.Value.Value)
+    return buckets
+
+
+def history_bounds(start: datetime, end: datetime) -> tuple[int, int, bool]:
+    """Translate the time range of a raw history read to microseconds and an order.
+
+    A missing start returns the newest values first, a missing end reads up to the
+    newest value, and a start after the end reads the range backwards.
+
+    :param start: Start of the time range, None or the Windows epoch if missing
+    :param end: End of the time range, None or the Windows epoch if missing
+    :return: Lower and upper bound in microseconds, whether to return the newest
+    values first
+    """
+    epoch = ua.get_win_epoch()
+    if start is None or start == epoch:
+        hi = datetime_to_us(end) if end is not None and end != epoch else 2**63 - 1
+        return -(2**63), hi, True
+    if end is None or end == epoch:
+        return datetime_to_us(start), 2**63 - 1, False
+    if start > end:
+        return datetime_to_us(end), datetime_to_us(start), True
+    return datetime_to_us(start), datetime_to_us(end), False
+
+
+class AggregatingHistoryManager(HistoryManager):
+    """HistoryManager that also answers aggregated history reads.
+
+    Attributes
+    ----------
+    aggregates : dict[ua.NodeId, str]
+        Supported AggregateTypes and the names of their aggregates
+
+    Methods
+    -------
+    read_history:
+        Reads the raw, event or aggregated history of nodes
+    """
+
+    def __init__(self, iserver: InternalServer, nsidx: int = 6) -> None:
+        """Create AggregatingHistoryManager object.
+
+        :param iserver: Internal server the manager belongs to
+        :param nsidx: Namespace index of the RMS AggregateType, defaults to 6
+        """
+        super().__init__(iserver)
+        self.aggregates = dict(STANDARD_AGGREGATES)
+        self.aggregates[ua.NodeId(RMS_AGGREGATE_NAME, nsidx)] = "rms"
+
+    async def read_history(
+        self, params: ua.HistoryReadParameters
+    ) -> list[ua.HistoryReadResult]:
+        """Read the history of nodes.
+
+        :param params: History read parameters of the request
+        :return: One result per node to read
+        """
+        details = params.HistoryReadDetails
+        if not isinstance(details, ua.ReadProcessedDetails):
+            return await super().read_history(params)
+        return [
+            await self._read_processed(details, idx, rv)
+            for idx, rv in enumerate(params.NodesToRead)
+        ]
+
+    async def _read_processed(
+        self, details: ua.ReadProcessedDetails, idx: int, rv: ua.HistoryReadValueId
+    ) -> ua.HistoryReadResult:
+        """Compute the aggregate of a node for every processing interval.
+
+        The AggregateType is taken from the same position as the node to read, as the
+        specification requires.
+        """
+        result = ua.HistoryReadResult()
+        aggregate = None
+        if idx < len(details.AggregateType):
+            aggregate = self.aggregates.get(details.AggregateType[idx])
+        if aggregate is None:
+            result.StatusCode = ua.StatusCode(ua.StatusCodes.BadAggregateNotSupported)
+            return result
+
+        lo, hi = datetime_to_us(details.StartTime), datetime_to_us(details.EndTime)
+        reverse = lo > hi
+        if reverse:
+            lo, hi = hi, lo
+        interval = int(details.ProcessingInterval * 1000) or hi - lo
+        if interval <= 0 or (hi - lo) // interval >= (
+            self.storage.max_history_data_response_size
+        ):
+            result.StatusCode = ua.StatusCode(ua.StatusCodes.BadAggregateInvalidInputs)
+            return result
+
+        buckets = await read_node_buckets(self.storage, rv.NodeId, lo, hi, interval)
+
+        datavalues = []
+        for idx, bucket in enumerate(buckets):
+            value = bucket.aggregate(aggregate)
+            timestamp = us_to_datetime(lo + idx * interval)
+            if value is None:
+                datavalues.append(
+                    ua.DataValue(
+                        StatusCode_=ua.StatusCode(ua.StatusCodes.BadNoData),
+                        SourceTimestamp=timestamp,
+                        ServerTimestamp=timestamp,
+                    )
+                )
+            else:
+                datavalues.append(
+                    ua.DataValue(
+                        value, SourceTimestamp=timestamp, ServerTimestamp=timestamp
+                    )
+                )
+        if reverse:
+            datavalues.reverse()
+        result.HistoryData = ua.HistoryData()
+        result.HistoryData.DataValues = datavalues
+        return result
@@ -0,0 +1,184 @@
+"""Bounded in-memory history backend for the NNE MI OPC UA server.
+
+asyncua's HistoryDict keeps an unbounded list per node, pops its oldest values one by
+one on every save and scans the whole list on every read. This backend keeps a fixed
+capacity ring buffer per node instead: an array of source timestamps next to a list of
+data values of the same size, both allocated when the node is historized. Saving
+overwrites the oldest slot and range reads find their bounds with a binary search, so
+memory use is fixed per node and recent-history reads stay O(log n) at any write rate.
+
+The history is lost when the server stops.
+
+Classes
+-------
+RingBufferHistory
+    History storage for data changes of variable nodes. Events are not supported.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+import dataclasses
+from datetime import datetime, timedelta
+import logging
+
+from asyncua import ua
+from asyncua.server.history import HistoryStorageInterface
+
+from opcua_server.history_manager import history_bounds
+from opcua_server.history_sqlite import datetime_to_us
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+
+class _Ring:
+    """Fixed capacity ring buffer of data values sorted by source timestamp.
+
+    Indexing the ring with a logical index (0 is the oldest value) returns the
+    timestamp at that position, so the ring can be searched with bisect directly.
+    """
+
+    def __init__(self, capacity: int, period: timedelta) -> None:
+        self.capacity = capacity
+        self.period = period
+        self.timestamps = array("q", bytes(8 * capacity))
+        self.values: list[ua.DataValue] = [None] * capacity
+        self.head = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, idx: int) -> int:
+        return self.timestamps[(self.head + idx) % self.capacity]
+
+    def value(self, idx: int) -> ua.DataValue:
+        return self.values[(self.head + idx) % self.capacity]
+
+    def append(self, timestamp: int, datavalue: ua.DataValue) -> None:
+        """Add a value, overwriting the oldest one if the ring is full.
+
+        Values that are older than the newest one are moved into place, which costs
+        O(n) but only happens if a source clock jumps back.
+        """
+        idx = self.size
+        if self.size and timestamp < self[self.size - 1]:
+            idx = bisect_right(self, timestamp)
+        if self.size == self.capacity:
+            if idx == 0:
+                return
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+            idx -= 1
+        for pos in range(self.size, idx, -1):
+            src = (self.head + pos - 1) % self.capacity
+            dst = (self.head + pos) % self.capacity
+            self.timestamps[dst] = self.timestamps[src]
+            self.values[dst] = self.values[src]
+        slot = (self.head + idx) % self.capacity
+        self.timestamps[slot] = timestamp
+        self.values[slot] = datavalue
+        self.size += 1
+
+
+class RingBufferHistory(HistoryStorageInterface):
+    """History storage that keeps the latest values of every node in a ring buffer.
+
+    Attributes
+    ----------
+    capacity : int
+        Number of values kept per node if historize was not given a count
+    """
+
+    def __init__(
+        self, capacity: int = 36000, max_history_data_response_size: int = 10000
+    ) -> None:
+        """Create RingBufferHistory object.
+
+        :param capacity: Number of values kept per node if historize was not given a
+        count, defaults to 36000 (one hour at 100 ms)
+        :param max_history_data_response_size: Maximum number of values returned per
+        history read, defaults to 10000
+        """
+        super().__init__(max_history_data_response_size)
+        self.capacity = capacity
+        self._rings: dict[ua.NodeId, _Ring] = {}
+
+    async def init(self) -> None:
+        """Nothing to set up for an in-memory storage."""
+
+    async def stop(self) -> None:
+        """Nothing to clean up for an in-memory storage."""
+
+    async def new_historized_node(
+        self, node_id: ua.NodeId, period: timedelta, count: int = 0
+    ) -> None:
+        """Allocate the ring buffer of a node.
+
+        History that is already kept for the node is kept, so a sensor that gets
+        reconnected continues its history.
+
+        :param node_id: NodeId of the historized node
+        :param period: How long data changes are kept, None to keep them until they
+        are overwritten
+        :param count: Capacity of the ring buffer, 0 for the default capacity
+        """
+        if node_id not in self._rings:
+            self._rings[node_id] = _Ring(count or self.capacity, period)
+        else:
+            self._rings[node_id].period = period
+
+    async def save_node_value(
+        self, node_id: ua.NodeId, datavalue: ua.DataValue
+    ) -> None:
+        """Save a data change of a historized node.
+
+        :param node_id: NodeId of the historized node
+        :param datavalue: New value of the node
+        """
+        ring = self._rings.get(node_id)
+        if ring is None:
+            return
+        if datavalue.SourceTimestamp is None:
+            datavalue = dataclasses.replace(
+                datavalue,
+                SourceTimestamp=datavalue.ServerTimestamp or datetime.utcnow(),
+            )
+        ring.append(datetime_to_us(datavalue.SourceTimestamp), datavalue)
+
+    async def read_node_history(
+        self, node_id: ua.NodeId, start: datetime, end: datetime, nb_values: int
+    ) -> tuple[list[ua.DataValue], datetime | None]:
+        """Read the history of a node.
+
+        Values older than the period of the node are not returned, even if they have
+        not been overwritten yet.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the time range, newest values first if missing
+        :param end: End of the time range
+        :param nb_values: Maximum number of values to return, 0 for no limit
+        :return: List of data values and the continuation point
+        """
+        ring = self._rings.get(node_id)
+        if ring is None:
+            _logger.warning(
+                f"Attempt to read history of {node_id}, which is not historized"
+            )
+            return [], None
+        lo, hi, reverse = history_bounds(start, end)
+        if ring.period:
+            lo = max(lo, datetime_to_us(datetime.utcnow() - ring.period))
+        first, last = bisect_left(ring, lo), bisect_right(ring, hi)
+        limit = self.max_history_data_response_size + 1
+        if nb_values:
+            limit = min(limit, nb_values)
+        if reverse:
+            indices = range(last - 1, max(first, last - limit) - 1, -1)
+        else:
+            indices = range(first, min(last, first + limit))
+        results = [ring.value(idx) for idx in indices]
+
+        cont = None
+        if len(results) > self.max_history_data_response_size:
+            cont = results[self.max_history_data_response_size].SourceTimestamp
+            results = results[: self.max_history_data_response_size]
+        return results, cont
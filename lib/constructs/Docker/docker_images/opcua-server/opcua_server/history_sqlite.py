@@ -0,0 +1,332 @@
+"""Batched SQLite history backend for the NNE MI OPC UA server.
+
+asyncua's HistorySQLite commits every single data change and runs its retention
+DELETEs (with unindexed MIN(SourceTimestamp) subqueries) after every insert. With all
+information nodes historized at poll rate, that saturates the SD card of the IoT box.
+
+This backend queues data changes and writes them in one transaction per flush. It uses a
+single table indexed by (NodeId, SourceTimestamp), runs the database in WAL mode and
+applies the period/count retention with periodic bulk deletes instead of per insert.
+Timestamps are stored as integer microseconds since the unix epoch. Aggregated reads
+assign the rows to their processing interval in SQL, so only the per-interval
+statistics leave the database worker.
+
+Classes
+-------
+BatchedHistorySQLite
+    History storage for data changes of variable nodes. Events are not supported.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+import time
+
+from asyncua import ua
+from asyncua.common.utils import Buffer
+from asyncua.server.history import HistoryStorageInterface
+from asyncua.ua.ua_binary import variant_from_binary, variant_to_binary
+
+from opcua_server.history_aggregates import BucketStats, bucket_count
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_us(dt: datetime) -> int:
+    """Convert a naive UTC datetime to microseconds since the unix epoch.
+
+    :param dt: Datetime to convert
+    :return: Microseconds since 1970-01-01
+    """
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def us_to_datetime(us: int) -> datetime:
+    """Convert microseconds since the unix epoch to a naive UTC datetime.
+
+    :param us: Microseconds since 1970-01-01
+    :return: Datetime
+    """
+    return EPOCH + timedelta(microseconds=us)
+
+
+class BatchedHistorySQLite(HistoryStorageInterface):
+    """History storage that writes data changes to SQLite in batches.
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite database
+    batch_size : int
+        Number of queued data changes that triggers a flush
+    flush_interval : float
+        Maximum number of seconds a data change stays in the queue
+    retention_interval : float
+        Number of seconds between two runs of the period/count retention
+
+    Methods
+    -------
+    flush:
+        Writes all queued data changes to the database
+    apply_retention:
+        Deletes data changes that are older than the period or exceed the count of
+        their node
+    read_node_buckets:
+        Computes the statistics of the values of a node per processing interval
+    """
+
+    def __init__(
+        self,
+        path: str = "history.db",
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        retention_interval: float = 60.0,
+        max_history_data_response_size: int = 10000,
+    ) -> None:
+        """Create BatchedHistorySQLite object.
+
+        :param path: Location of the SQLite database, defaults to "history.db"
+        :param batch_size: Number of queued data changes that triggers a flush,
+        defaults to 500
+        :param flush_interval: Maximum number of seconds a data change stays in the
+        queue, defaults to 1.0
+        :param retention_interval: Number of seconds between two runs of the
+        retention, defaults to 60.0
+        :param max_history_data_response_size: Maximum number of values returned per
+        history read, defaults to 10000
+        """
+        super().__init__(max_history_data_response_size)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_interval = retention_interval
+        self._datachanges_period: dict[str, tuple[timedelta, int]] = {}
+        self._queue: list[tuple] = []
+        self._db: sqlite3.Connection = None
+        # sqlite connections must not be shared between threads, all database work
+        # is done by this single worker
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._flush_task: asyncio.Task = None
+        self._last_retention = time.monotonic()
+
+    async def init(self) -> None:
+        """Open the database and start flushing the queue periodically."""
+        await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Flush the queue and close the database."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        await self._run(self._db.close)
+        self._executor.shutdown()
+        _logger.info("Closed history database")
+
+    async def new_historized_node(
+        self, node_id: ua.NodeId, period: timedelta, count: int = 0
+    ) -> None:
+        """Register a node for historizing.
+
+        History that is already in the database for the node is kept, so a sensor that
+        gets reconnected continues its history.
+
+        :param node_id: NodeId of the historized node
+        :param period: How long data changes are kept, None to keep them forever
+        :param count: Maximum number of data changes kept, 0 for no limit
+        """
+        self._datachanges_period[node_id.to_string()] = period, count
+
+    async def save_node_value(
+        self, node_id: ua.NodeId, datavalue: ua.DataValue
+    ) -> None:
+        """Queue a data change of a historized node.
+
+        :param node_id: NodeId of the historized node
+        :param datavalue: New value of the node
+        """
+        source_timestamp = (
+            datavalue.SourceTimestamp or datavalue.ServerTimestamp or datetime.utcnow()
+        )
+        self._queue.append(
+            (
+                node_id.to_string(),
+                datetime_to_us(source_timestamp),
+                datetime_to_us(datavalue.ServerTimestamp or source_timestamp),
+                datavalue.StatusCode.value,
+                variant_to_binary(datavalue.Value),
+            )
+        )
+        if len(self._queue) >= self.batch_size:
+            await self.flush()
+
+    async def read_node_history(
+        self, node_id: ua.NodeId, start: datetime, end: datetime, nb_values: int
+    ) -> tuple[list[ua.DataValue], datetime | None]:
+        """Read the history of a node.
+
+        Queued data changes are flushed first, so the result is always up to date.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the time range, newest values first if missing
+        :param end: End of the time range
+        :param nb_values: Maximum number of values to return, 0 for no limit
+        :return: List of data values and the continuation point
+        """
+        await self.flush()
+        start_us, end_us, order, limit = self._get_bounds(start, end, nb_values)
+        rows = await self._run(
+            self._select, node_id.to_string(), start_us, end_us, order, limit
+        )
+        results = [
+            ua.DataValue(
+                variant_from_binary(Buffer(row[3])),
+                SourceTimestamp=us_to_datetime(row[0]),
+                ServerTimestamp=us_to_datetime(row[1]),
+                StatusCode_=ua.StatusCode(row[2]),
+            )
+            for row in rows
+        ]
+        cont = None
+        if len(results) > self.max_history_data_response_size:
+            cont = results[self.max_history_data_response_size].SourceTimestamp
+            results = results[: self.max_history_data_response_size]
+        return results, cont
+
+    async def read_node_buckets(
+        self, node_id: ua.NodeId, start: int, end: int, interval: int
+    ) -> list[BucketStats]:
+        """Compute the statistics of the values of a node per processing interval.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the first interval in microseconds
+        :param end: End of the last interval in microseconds (exclusive)
+        :param interval: Length of the intervals in microseconds
+        :return: Statistics of every interval
+        """
+        await self.flush()
+        return await self._run(
+            self._select_buckets, node_id.to_string(), start, end, interval
+        )
+
+    async def flush(self) -> None:
+        """Write all queued data changes to the database in one transaction."""
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        await self._run(self._insert, batch)
+
+    async def apply_retention(self) -> None:
+        """Delete data changes exceeding the period or count of their node."""
+        now = datetime.utcnow()
+        limits = [
+            (
+                nodeid,
+                datetime_to_us(now - period) if period else None,
+                count,
+            )
+            for nodeid, (period, count) in self._datachanges_period.items()
+        ]
+        await self._run(self._delete_old, limits)
+        self._last_retention = time.monotonic()
+
+    async def _flush_periodically(self) -> None:
+        """Flush the queue and apply the retention in the background."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_retention >= self.retention_interval:
+                    await self.apply_retention()
+            except sqlite3.Error as e:
+                _logger.error(f"Writing history failed: {e}")
+
+    async def _run(self, func, *args):
+        """Run a database function in the database worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _open(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL only syncs on checkpoints, not on every commit
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " NodeId TEXT NOT NULL,"
+            " SourceTimestamp INTEGER NOT NULL,"
+            " ServerTimestamp INTEGER,"
+            " StatusCode INTEGER,"
+            " VariantBinary BLOB)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS history_node_time"
+            " ON history (NodeId, SourceTimestamp)"
+        )
+        self._db.commit()
+
+    def _insert(self, batch: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?)", batch)
+
+    def _select(
+        self, nodeid: str, start_us: int, end_us: int, order: str, limit: int
+    ) -> list[tuple]:
+        return self._db.execute(
+            "SELECT SourceTimestamp, ServerTimestamp, StatusCode, VariantBinary"
+            " FROM history WHERE NodeId = ? AND SourceTimestamp BETWEEN ? AND ?"
+            f" ORDER BY SourceTimestamp {order} LIMIT ?",
+            (nodeid, start_us, end_us, limit),
+        ).fetchall()
+
+    def _select_buckets(
+        self, nodeid: str, start: int, end: int, interval: int
+    ) -> list[BucketStats]:
+        buckets = [BucketStats() for _ in range(bucket_count(start, end, interval))]
+        rows = self._db.execute(
+            "SELECT (SourceTimestamp - ?) / ?, VariantBinary FROM history"
+            " WHERE NodeId = ? AND SourceTimestamp >= ? AND SourceTimestamp < ?",
+            (start, interval, nodeid, start, end),
+        )
+        for idx, blob in rows:
+            buckets[idx].add(variant_from_binary(Buffer(blob)).Value)
+        return buckets
+
+    def _delete_old(self, limits: list[tuple[str, int | None, int]]) -> None:
+        with self._db:
+            for nodeid, oldest_us, count in limits:
+                if oldest_us is not None:
+                    self._db.execute(
+                        "DELETE FROM history WHERE NodeId = ? AND SourceTimestamp < ?",
+                        (nodeid, oldest_us),
+                    )
+                if count:
+                    self._db.execute(
+                        "DELETE FROM history WHERE rowid IN ("
+                        " SELECT rowid FROM history WHERE NodeId = ?"
+                        " ORDER BY SourceTimestamp DESC LIMIT -1 OFFSET ?)",
+                        (nodeid, count),
+                    )
+
+    @staticmethod
+    def _get_bounds(
+        start: datetime, end: datetime, nb_values: int
+    ) -> tuple[int, int, str, int]:
+        """Translate the history read arguments to SQL bounds, as HistorySQLite does."""
+        order = "ASC"
+        if start is None or start == ua.get_win_epoch():
+            order = "DESC"
+            start = ua.get_win_epoch()
+        if end is None or end == ua.get_win_epoch():
+            end = datetime.utcnow() + timedelta(days=1)
+        if start < end:
+            start_us, end_us = datetime_to_us(start), datetime_to_us(end)
+        else:
+            order = "DESC"
+            start_us, end_us = datetime_to_us(end), datetime_to_us(start)
+        limit = nb_values if nb_values else -1
+        return start_us, end_us, order, limit
@@ -0,0 +1,374 @@
+"""Tiered history retention for the NNE MI OPC UA server.
+
+Months of full-rate Values history are neither needed nor affordable on the IoT box,
+but the period/count limits of a storage can only keep the raw values or delete them.
+TieredHistory wraps any other history storage and keeps:
+
+* the raw values in the wrapped storage, for raw_period
+* per minute count/sum/sum of squares/minimum/maximum, for the first tier period
+* per hour rollups of the same statistics, for the second tier period
+
+The rollups are maintained incrementally: every saved value is added to the open minute
+and hour bucket of its node, and a bucket is written to a small SQLite database once a
+value of a later bucket arrives (or the server stops). Values that arrive for an
+already written bucket are only kept raw.
+
+Aggregated reads use the coarsest tier whose buckets fit the processing interval and
+that still covers the start of the read. Reads that start before raw_period use a tier
+even if their start isn't aligned to its buckets: every bucket is added to the interval
+its start is in. Raw reads older than raw_period are answered with the per-bucket
+averages of the finest tier that still covers them.
+
+Classes
+-------
+TieredHistory
+    History storage that adds minute and hour rollups to another storage.
+"""
+from array import array
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+import struct
+import time
+
+from asyncua import ua
+from asyncua.server.history import HistoryStorageInterface
+
+from opcua_server.history_aggregates import BucketStats, bucket_count
+from opcua_server.history_manager import read_node_buckets
+from opcua_server.history_sqlite import datetime_to_us, us_to_datetime
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+# name and bucket width in microseconds of the rollup tiers, finest first
+TIERS = (("minute", 60 * 10**6), ("hour", 3600 * 10**6))
+
+
+class TieredHistory(HistoryStorageInterface):
+    """History storage that keeps raw values short and minute/hour rollups long.
+
+    Attributes
+    ----------
+    raw : HistoryStorageInterface
+        Storage of the raw values
+    path : str
+        Location of the SQLite database of the rollups
+    raw_period : timedelta
+        How long the raw values are kept
+    tier_periods : tuple[timedelta, timedelta]
+        How long the minute and the hour rollups are kept
+
+    Methods
+    -------
+    read_node_buckets:
+        Computes the statistics of the values of a node per processing interval
+    apply_retention:
+        Deletes rollups that are older than the period of their tier
+    """
+
+    def __init__(
+        self,
+        raw: HistoryStorageInterface,
+        path: str = "history_tiers.db",
+        raw_period: timedelta = timedelta(hours=24),
+        tier_periods: tuple[timedelta, timedelta] = (
+            timedelta(days=30),
+            timedelta(days=365),
+        ),
+        retention_interval: float = 3600.0,
+    ) -> None:
+        """Create TieredHistory object.
+
+        :param raw: Storage of the raw values
+        :param path: Location of the SQLite database of the rollups, defaults to
+        "history_tiers.db"
+        :param raw_period: How long the raw values are kept, defaults to 24 hours
+        :param tier_periods: How long the minute and the hour rollups are kept,
+        defaults to 30 and 365 days
+        :param retention_interval: Minimum number of seconds between two runs of the
+        rollup retention, defaults to 3600.0
+        """
+        super().__init__(raw.max_history_data_response_size)
+        self.raw = raw
+        self.path = path
+        self.raw_period = raw_period
+        self.tier_periods = tier_periods
+        self.retention_interval = retention_interval
+        # open bucket (start, statistics) of every tier per node
+        self._open: dict[ua.NodeId, list[tuple[int, BucketStats] | None]] = {}
+        self._db: sqlite3.Connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._last_retention = time.monotonic()
+
+    async def init(self) -> None:
+        """Set up the raw storage and open the rollup database."""
+        await self.raw.init()
+        await self._run(self._open_db)
+
+    async def stop(self) -> None:
+        """Write the open buckets, close the rollup database and the raw storage."""
+        rows = [
+            self._row(node_id, tier, *bucket)
+            for node_id, buckets in self._open.items()
+            for tier, bucket in enumerate(buckets)
+            if bucket is not None
+        ]
+        self._open = {}
+        await self._run(self._insert, rows)
+        await self._run(self._db.close)
+        self._executor.shutdown()
+        await self.raw.stop()
+
+    async def new_historized_node(
+        self, node_id: ua.NodeId, period: timedelta, count: int = 0
+    ) -> None:
+        """Register a node for historizing.
+
+        The raw values are kept for raw_period instead of the given period, the rollups
+        for the periods of their tiers.
+
+        :param node_id: NodeId of the historized node
+        :param period: Ignored, see raw_period and tier_periods
+        :param count: Maximum number of raw values kept, 0 for no limit
+        """
+        await self.raw.new_historized_node(node_id, self.raw_period, count)
+        self._open.setdefault(node_id, [None] * len(TIERS))
+
+    async def save_node_value(
+        self, node_id: ua.NodeId, datavalue: ua.DataValue
+    ) -> None:
+        """Save a data change raw and add it to the open buckets of its node.
+
+        :param node_id: NodeId of the historized node
+        :param datavalue: New value of the node
+        """
+        await self.raw.save_node_value(node_id, datavalue)
+        buckets = self._open.get(node_id)
+        value = datavalue.Value.Value if datavalue.Value is not None else None
+        if buckets is None or not _is_numeric(value):
+            return
+        timestamp = datetime_to_us(
+            datavalue.SourceTimestamp or datavalue.ServerTimestamp or datetime.utcnow()
+        )
+        closed = []
+        for tier, (_, width) in enumerate(TIERS):
+            start = timestamp - timestamp % width
+            bucket = buckets[tier]
+            if bucket is None or start > bucket[0]:
+                if bucket is not None:
+                    closed.append(self._row(node_id, tier, *bucket))
+                bucket = buckets[tier] = start, BucketStats()
+            if start == bucket[0]:
+                bucket[1].add(value)
+        if closed:
+            await self._run(self._insert, closed)
+            if time.monotonic() - self._last_retention >= self.retention_interval:
+                await self.apply_retention()
+
+    async def read_node_history(
+        self, node_id: ua.NodeId, start: datetime, end: datetime, nb_values: int
+    ) -> tuple[list[ua.DataValue], datetime | None]:
+        """Read the history of a node.
+
+        Reads that start within raw_period (or have no start) return the raw values,
+        older reads the averages of the finest tier that covers the start.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the time range, newest values first if missing
+        :param end: End of the time range
+        :param nb_values: Maximum number of values to return, 0 for no limit
+        :return: List of data values and the continuation point
+        """
+        epoch = ua.get_win_epoch()
+        if start is None or start == epoch:
+            return await self.raw.read_node_history(node_id, start, end, nb_values)
+        if end is None or end == epoch:
+            end = datetime.utcnow() + timedelta(days=1)
+        reverse = start > end
+        lo, hi = sorted((datetime_to_us(start), datetime_to_us(end)))
+        now = datetime.utcnow()
+        if lo >= datetime_to_us(now - self.raw_period):
+            return await self.raw.read_node_history(node_id, start, end, nb_values)
+        tier = next(
+            (
+                tier
+                for tier, period in enumerate(self.tier_periods)
+                if lo >= datetime_to_us(now - period)
+            ),
+            len(TIERS) - 1,
+        )
+
+        rows = await self._run(self._select, node_id.to_string(), tier, lo, hi + 1)
+        stats = self._merge_rows(rows)
+        bucket = self._open.get(node_id, [None] * len(TIERS))[tier]
+        if bucket is not None and lo <= bucket[0] <= hi:
+            stats.setdefault(bucket[0], BucketStats()).merge(bucket[1])
+        starts = sorted(stats, reverse=reverse)
+        limit = self.max_history_data_response_size + 1
+        if nb_values:
+            limit = min(limit, nb_values)
+        results = []
+        for bucket_start in starts[:limit]:
+            timestamp = us_to_datetime(bucket_start)
+            results.append(
+                ua.DataValue(
+                    stats[bucket_start].aggregate("average"),
+                    SourceTimestamp=timestamp,
+                    ServerTimestamp=timestamp,
+                )
+            )
+        cont = None
+        if len(results) > self.max_history_data_response_size:
+            cont = results[self.max_history_data_response_size].SourceTimestamp
+            results = results[: self.max_history_data_response_size]
+        return results, cont
+
+    async def read_node_buckets(
+        self, node_id: ua.NodeId, start: int, end: int, interval: int
+    ) -> list[BucketStats]:
+        """Compute the statistics of the values of a node per processing interval.
+
+        :param node_id: NodeId of the historized node
+        :param start: Start of the first interval in microseconds
+        :param end: End of the last interval in microseconds (exclusive)
+        :param interval: Length of the intervals in microseconds
+        :return: Statistics of every interval
+        """
+        tier = self._pick_tier(start, interval)
+        if tier is None:
+            return await read_node_buckets(self.raw, node_id, start, end, interval)
+
+        buckets = [BucketStats() for _ in range(bucket_count(start, end, interval))]
+        # floor an unaligned start to the bucket that contains it
+        lo = start - start % TIERS[tier][1]
+        rows = await self._run(self._select, node_id.to_string(), tier, lo, end)
+        open_bucket = self._open.get(node_id, [None] * len(TIERS))[tier]
+        if open_bucket is not None:
+            rows.append((open_bucket[0], *self._row(node_id, tier, *open_bucket)[3:]))
+        for bucket_start, stats in self._merge_rows(rows).items():
+            if lo <= bucket_start < end:
+                buckets[max(bucket_start - start, 0) // interval].merge(stats)
+        return buckets
+
+    async def apply_retention(self) -> None:
+        """Delete rollups that are older than the period of their tier."""
+        now = datetime.utcnow()
+        oldest = [datetime_to_us(now - period) for period in self.tier_periods]
+        await self._run(self._delete_old, oldest)
+        self._last_retention = time.monotonic()
+
+    def _pick_tier(self, start: int, interval: int) -> int | None:
+        """Find the coarsest tier whose buckets fit the intervals and cover the start.
+
+        Within raw_period the buckets must also be aligned to the start, otherwise the
+        exact raw values are read. Older starts are floored to the buckets, and if no
+        tier fits the interval, the finest tier that covers the start is used.
+
+        :return: Index of the tier, None for the raw values
+        """
+        now = datetime.utcnow()
+        covered = start >= datetime_to_us(now - self.raw_period)
+        oldest = [datetime_to_us(now - period) for period in self.tier_periods]
+        fitting = [
+            tier
+            for tier, (_, width) in enumerate(TIERS)
+            if interval % width == 0 and (not covered or start % width == 0)
+        ]
+        if covered and not fitting:
+            return None
+        for tier in reversed(fitting):
+            if start >= oldest[tier]:
+                return tier
+        if fitting:
+            return fitting[-1]
+        return next(
+            (tier for tier in range(len(TIERS)) if start >= oldest[tier]),
+            len(TIERS) - 1,
+        )
+
+    async def _run(self, func, *args):
+        """Run a database function in the database worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    @staticmethod
+    def _row(node_id: ua.NodeId, tier: int, start: int, stats: BucketStats) -> tuple:
+        """Serialize a bucket to a database row."""
+        values = stats.sums + stats.squares + stats.minimums + stats.maximums
+        return (
+            node_id.to_string(),
+            tier,
+            start,
+            stats.count,
+            int(stats.is_array),
+            struct.pack(f"<{len(values)}d", *values),
+        )
+
+    @staticmethod
+    def _merge_rows(rows: list[tuple]) -> dict[int, BucketStats]:
+        """Deserialize rows and merge the ones of the same bucket (e.g. after a
+        restart)."""
+        merged: dict[int, BucketStats] = {}
+        for start, count, is_array, blob in rows:
+            values = struct.unpack(f"<{len(blob) // 8}d", blob)
+            n = len(values) // 4
+            stats = BucketStats(
+                count=count,
+                sums=list(values[:n]),
+                squares=list(values[n : 2 * n]),
+                minimums=list(values[2 * n : 3 * n]),
+                maximums=list(values[3 * n :]),
+                is_array=bool(is_array),
+            )
+            merged.setdefault(start, BucketStats()).merge(stats)
+        return merged
+
+    def _open_db(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            " NodeId TEXT NOT NULL,"
+            " Tier INTEGER NOT NULL,"
+            " BucketStart INTEGER NOT NULL,"
+            " Count INTEGER,"
+            " IsArray INTEGER,"
+            " Stats BLOB)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS rollups_node_tier_time"
+            " ON rollups (NodeId, Tier, BucketStart)"
+        )
+        self._db.commit()
+
+    def _insert(self, rows: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _select(self, nodeid: str, tier: int, start: int, end: int) -> list[tuple]:
+        return self._db.execute(
+            "SELECT BucketStart, Count, IsArray, Stats FROM rollups"
+            " WHERE NodeId = ? AND Tier = ? AND BucketStart >= ? AND BucketStart < ?",
+            (nodeid, tier, start, end),
+        ).fetchall()
+
+    def _delete_old(self, oldest: list[int]) -> None:
+        with self._db:
+            for tier, oldest_us in enumerate(oldest):
+                self._db.execute(
+                    "DELETE FROM rollups WHERE Tier = ? AND BucketStart < ?",
+                    (tier, oldest_us),
+                )
+
+
+def _is_numeric(value) -> bool:
+    """Check whether a value can be rolled up (a number or a list of numbers)."""
+    if isinstance(value, (list, array)):
+        return bool(value) and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in value
+        )
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
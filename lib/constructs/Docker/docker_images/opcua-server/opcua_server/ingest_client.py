@@ -0,0 +1,206 @@
+"""Bulk ingest of sensor readings into the local database API.
+
+Posting every reading separately to /insert/<port> costs one HTTP round trip per
+information node and poll, which caps the sample rate of the bridge. The client queues
+the readings and posts them in batches, in a background task, so the polling loop never
+waits for the database API.
+
+Batches are posted as JSON to /insert_bulk or, in binary mode, as compact frames to
+/insert_frames (see ingest_frames). In binary mode the static metadata of every
+information node is registered once at /register instead of being sent with every
+reading.
+
+Classes
+-------
+BulkIngestClient
+    Queues readings and posts them to the local database API in batches.
+"""
+import asyncio
+from datetime import datetime
+import logging
+
+import requests
+
+from opcua_server.history_sqlite import datetime_to_us
+from opcua_server.ingest_frames import MAX_FRAME_SPAN, StreamRegistry, encode_frame
+from settings import DB_API_ADDRESS, DB_API_PORT
+
+_logger = logging.getLogger("OPC UA Server Bridge")
+
+
+class BulkIngestClient:
+    """Client that posts queued readings to the local database API in batches.
+
+    Attributes
+    ----------
+    url : str
+        Base URL of the local database API
+    batch_size : int
+        Maximum number of readings per request
+    flush_interval : float
+        Maximum number of seconds a reading stays in the queue
+    max_queued : int
+        Maximum number of queued readings, the oldest ones are dropped beyond that
+    binary : bool
+        Whether readings are sent as binary frames instead of JSON
+
+    Methods
+    -------
+    start:
+        Starts posting the queue in the background
+    stop:
+        Posts the remaining readings and stops the background task
+    add:
+        Queues a reading
+    flush:
+        Posts all queued readings
+    """
+
+    def __init__(
+        self,
+        url: str = f"http://{DB_API_ADDRESS}:{DB_API_PORT}",
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queued: int = 100000,
+        binary: bool = False,
+    ) -> None:
+        """Create BulkIngestClient object.
+
+        :param url: Base URL of the local database API, defaults to the address in
+        settings
+        :param batch_size: Maximum number of readings per request, defaults to 500
+        :param flush_interval: Maximum number of seconds a reading stays in the queue,
+        defaults to 1.0
+        :param max_queued: Maximum number of queued readings, defaults to 100000
+        :param binary: Whether to send binary frames instead of JSON, defaults to False
+        """
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.binary = binary
+        self._queue: list[dict | tuple[int, int, list[float]]] = []
+        self._registry = StreamRegistry()
+        self._session = requests.Session()
+        self._flush_task: asyncio.Task = None
+
+    def start(self) -> None:
+        """Start posting the queue in the background."""
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Post the remaining readings and stop the background task."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        self._session.close()
+
+    def add(
+        self,
+        port: int,
+        sensorname: str,
+        informationnode: str,
+        values: list[float],
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        units: list[str],
+        timestamp: datetime = None,
+    ) -> None:
+        """Queue a reading.
+
+        :param port: Port of the sensor (1-based, as in the /insert/<port> URL)
+        :param sensorname: Name of the sensor
+        :param informationnode: Name of the information node
+        :param values: Real values of the information node
+        :param lowerbounds: Lower bounds of the values
+        :param upperbounds: Upper bounds of the values
+        :param units: Units of the values
+        :param timestamp: UTC time of the reading, defaults to now
+        """
+        timestamp = timestamp or datetime.utcnow()
+        if self.binary:
+            index = self._registry.stream(
+                port, sensorname, informationnode, lowerbounds, upperbounds, units
+            )
+            self._queue.append((index, datetime_to_us(timestamp), values))
+        else:
+            self._queue.append(
+                {
+                    "port": port,
+                    "sensorname": sensorname,
+                    "informationnode": informationnode,
+                    "values": values,
+                    "lowerbounds": lowerbounds,
+                    "upperbounds": upperbounds,
+                    "units": units,
+                    "timestamp": timestamp.isoformat(),
+                }
+            )
+        if len(self._queue) > self.max_queued:
+            dropped = len(self._queue) - self.max_queued
+            del self._queue[:dropped]
+            _logger.warning(f"Ingest queue full, dropped {dropped} readings")
+
+    async def flush(self) -> None:
+        """Post all queued readings in batches of at most batch_size.
+
+        Readings of a batch that could not be posted are put back into the queue.
+        """
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            batch = self._next_batch()
+            try:
+                if self.binary:
+                    await loop.run_in_executor(None, self._post_frame, batch)
+                else:
+                    await loop.run_in_executor(
+                        None, self._post, "/insert_bulk", {"json": batch}
+                    )
+            except requests.RequestException as e:
+                self._queue[:0] = batch
+                if e.response is not None and e.response.status_code == 409:
+                    # the database API lost the schemas, e.g. after a restart
+                    self._registry.resend_all()
+                _logger.error(f"Posting {len(batch)} readings failed: {e}")
+                return
+
+    def _next_batch(self) -> list:
+        """Take the next batch off the queue.
+
+        Binary batches also end before they would span more than one frame can.
+        """
+        size = min(self.batch_size, len(self._queue))
+        if self.binary:
+            lo = hi = self._queue[0][1]
+            for i, (_, timestamp, _) in enumerate(self._queue[:size]):
+                lo, hi = min(lo, timestamp), max(hi, timestamp)
+                if hi - lo > MAX_FRAME_SPAN:
+                    size = i
+                    break
+        batch = self._queue[:size]
+        del self._queue[:size]
+        return batch
+
+    async def _flush_periodically(self) -> None:
+        """Post the queue in the background."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _post_frame(self, batch: list[tuple[int, int, list[float]]]) -> None:
+        """Register pending schemas and post a batch as a binary frame."""
+        pending = self._registry.pending()
+        if pending:
+            self._post("/register", {"json": [s.to_dict() for s in pending]})
+            self._registry.mark_sent(pending)
+        self._post(
+            "/insert_frames",
+            {
+                "data": encode_frame(batch),
+                "headers": {"Content-Type": "application/octet-stream"},
+            },
+        )
+
+    def _post(self, path: str, kwargs: dict) -> None:
+        resp = self._session.post(f"{self.url}{path}", timeout=10, **kwargs)
+        resp.raise_for_status()
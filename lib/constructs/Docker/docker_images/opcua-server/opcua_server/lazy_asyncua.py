@@ -0,0 +1,385 @@
+"""Faster start-up of asyncua with a compact node id index and lazy modules.
+
+Every process that imports asyncua (asyncua/__init__ imports the client and the
+server) executes ua/object_ids.py, a class with an attribute for each of the ~14500
+standard node ids plus a dictionary mapping the ids back to their names, and the
+200000 lines of standard_address_space_services.py, which are only needed to build the
+standard address space of a server that doesn't load it from a snapshot.
+
+install() puts a finder on sys.meta_path that replaces
+* asyncua.ua.object_ids by ObjectIds and ObjectIdNames backed by an IdIndex file. The
+  sorted names are kept in one bytes object and looked up by binary search on first
+  access, so only the ids that are used become Python objects.
+* the functions of standard_address_space_services by stand-ins that import the real
+  module on their first call.
+
+The index is written when the Docker image is built (python -m
+opcua_server.lazy_asyncua --write-index), like the address space snapshot. Without an
+index for the installed asyncua version, object_ids is imported as usual. uaprotocol_auto
+can't be deferred, ua/__init__ star-imports it and every message needs it.
+
+python -m opcua_server.lazy_asyncua --benchmark compares the import time and memory of
+asyncua with and without install() in fresh interpreters.
+
+Classes
+-------
+IdIndex
+    Sorted name <-> id index of the standard node ids in a single file.
+
+Functions
+---------
+install
+    Makes asyncua use the index and the lazy modules, must be called before importing
+    asyncua.
+write_index
+    Writes the index of the installed asyncua version.
+benchmark
+    Measures importing asyncua with and without install().
+"""
+import argparse
+from array import array
+from collections.abc import Mapping
+import importlib.abc
+import importlib.machinery
+import importlib.metadata
+import importlib.util
+import logging
+import os
+import struct
+import subprocess
+import sys
+import types
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "ua_object_ids.idx")
+OBJECT_IDS_MODULE = "asyncua.ua.object_ids"
+# module: functions replaced by stand-ins importing the module on their first call
+LAZY_FUNCTIONS = {
+    "asyncua.server.standard_address_space.standard_address_space_services": (
+        "create_standard_address_space_Services",
+    ),
+}
+# magic, length of the asyncua version, number of ids
+INDEX_HEADER = struct.Struct("<4sHI")
+INDEX_MAGIC = b"UAID"
+
+
+class IdIndex:
+    """Sorted name <-> id index of the standard node ids in a single file.
+
+    The file holds the ids ordered by name, the offsets of the names in the name blob,
+    the positions ordered by id and the utf-8 encoded, sorted names.
+
+    Attributes
+    ----------
+    version : str
+        asyncua version the index was written for
+
+    Methods
+    -------
+    id_of:
+        Returns the id of a name
+    name_of:
+        Returns the name of an id
+    ids:
+        Returns the ids in ascending order
+    """
+
+    def __init__(self, path: str) -> None:
+        """Load IdIndex object from a file.
+
+        :param path: Location of the index file
+        :raises ValueError: If the file is no index
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version_size, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is no node id index")
+        position = INDEX_HEADER.size
+        self.version = data[position : position + version_size].decode("utf-8")
+        position += version_size
+        view = memoryview(data)
+        self._count = count
+        self._ids = view[position : position + 4 * count].cast("I")
+        position += 4 * count
+        self._offsets = view[position : position + 4 * (count + 1)].cast("I")
+        position += 4 * (count + 1)
+        self._by_id = view[position : position + 4 * count].cast("I")
+        position += 4 * count
+        self._names = data[position:]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _name(self, position: int) -> bytes:
+        return self._names[self._offsets[position] : self._offsets[position + 1]]
+
+    def id_of(self, name: str) -> int | None:
+        """Return the id of a name.
+
+        :param name: Name of the node id, e.g. "Server_NamespaceArray"
+        :return: Numeric id, None if there is no such name
+        """
+        key = name.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._name(low) == key:
+            return self._ids[low]
+        return None
+
+    def name_of(self, identifier: int) -> str | None:
+        """Return the name of an id.
+
+        :param identifier: Numeric id
+        :return: Name of the id, None if there is no such id
+        """
+        if not isinstance(identifier, int):
+            return None
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._ids[self._by_id[middle]] < identifier:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._ids[self._by_id[low]] == identifier:
+            return self._name(self._by_id[low]).decode("utf-8")
+        return None
+
+    def ids(self) -> list[int]:
+        """Return the ids in ascending order."""
+        return [self._ids[position] for position in self._by_id]
+
+
+class _ObjectIdsType(type):
+    """Resolves the attributes of ObjectIds from the index and caches them."""
+
+    def __getattr__(cls, name: str) -> int:
+        identifier = None if name.startswith("__") else cls._index.id_of(name)
+        if identifier is None:
+            raise AttributeError(f"type object 'ObjectIds' has no attribute '{name}'")
+        setattr(cls, name, identifier)
+        return identifier
+
+
+class _ObjectIdNames(Mapping):
+    """Read-only mapping of ids to names backed by the index."""
+
+    def __init__(self, index: IdIndex) -> None:
+        self._index = index
+
+    def __getitem__(self, identifier: int) -> str:
+        name = self._index.name_of(identifier)
+        if name is None:
+            raise KeyError(identifier)
+        return name
+
+    def __contains__(self, identifier) -> bool:
+        return self._index.name_of(identifier) is not None
+
+    def __iter__(self):
+        return iter(self._index.ids())
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class _ObjectIdsLoader(importlib.abc.Loader):
+    """Creates asyncua.ua.object_ids from the index."""
+
+    def __init__(self, index: IdIndex) -> None:
+        self.index = index
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module: types.ModuleType) -> None:
+        module.ObjectIds = _ObjectIdsType(
+            "ObjectIds", (), {"_index": self.index, "__module__": module.__name__}
+        )
+        module.ObjectIdNames = _ObjectIdNames(self.index)
+
+
+class _StandInLoader(importlib.abc.Loader):
+    """Creates a module of functions that import the real module on their first
+    call."""
+
+    def __init__(self, names: tuple[str, ...]) -> None:
+        self.names = names
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module: types.ModuleType) -> None:
+        for name in self.names:
+            setattr(module, name, _stand_in(module.__name__, name))
+
+
+def _stand_in(module_name: str, name: str):
+    def call(*args, **kwargs):
+        return getattr(_import_real(module_name), name)(*args, **kwargs)
+
+    call.__name__ = name
+    return call
+
+
+def _import_real(module_name: str) -> types.ModuleType:
+    """Import a module replaced by stand-ins, bypassing the finder of install()."""
+    module = sys.modules.get(module_name)
+    if module is not None and not isinstance(module.__loader__, _StandInLoader):
+        return module
+    package = sys.modules[module_name.rpartition(".")[0]]
+    spec = importlib.machinery.PathFinder.find_spec(module_name, package.__path__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[module_name] = module
+    _logger.debug(f"Imported {module_name} on first use")
+    return module
+
+
+class _LazyFinder(importlib.abc.MetaPathFinder):
+    """Finds the index backed object_ids module and the stand-in modules."""
+
+    def __init__(self, index: IdIndex = None) -> None:
+        self.index = index
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname == OBJECT_IDS_MODULE and self.index is not None:
+            return importlib.util.spec_from_loader(
+                fullname, _ObjectIdsLoader(self.index)
+            )
+        if fullname in LAZY_FUNCTIONS:
+            return importlib.util.spec_from_loader(
+                fullname, _StandInLoader(LAZY_FUNCTIONS[fullname])
+            )
+        return None
+
+
+def install(index_path: str = INDEX_PATH) -> None:
+    """Make asyncua use the index and the lazy modules.
+
+    Must be called before asyncua is imported, does nothing afterwards.
+
+    :param index_path: Location of the index file, defaults to INDEX_PATH
+    """
+    if "asyncua" in sys.modules:
+        _logger.warning("asyncua is already imported, lazy imports not installed")
+        return
+    if any(isinstance(finder, _LazyFinder) for finder in sys.meta_path):
+        return
+    index = None
+    version = importlib.metadata.version("asyncua")
+    try:
+        index = IdIndex(index_path)
+    except (OSError, ValueError) as e:
+        _logger.debug(f"Not using a node id index: {e}")
+    if index is not None and index.version != version:
+        _logger.info(f"{index_path} is for asyncua {index.version}, not {version}")
+        index = None
+    sys.meta_path.insert(0, _LazyFinder(index))
+
+
+def write_index(path: str = INDEX_PATH) -> None:
+    """Write the index of the installed asyncua version.
+
+    :param path: Location of the index file, defaults to INDEX_PATH
+    :raises ValueError: If ObjectIdNames isn't the inverse of ObjectIds
+    """
+    from asyncua.ua import object_ids
+
+    if isinstance(object_ids.ObjectIds, _ObjectIdsType):
+        raise ValueError("The index must be written from the asyncua module")
+    names = {
+        name: value
+        for name, value in vars(object_ids.ObjectIds).items()
+        if not name.startswith("__")
+    }
+    if {value: name for name, value in names.items()} != object_ids.ObjectIdNames:
+        raise ValueError("ObjectIdNames is not the inverse of ObjectIds")
+    ordered = sorted((name.encode("utf-8"), value) for name, value in names.items())
+    ids = array("I", (value for _, value in ordered))
+    offsets = array("I", [0])
+    for name, _ in ordered:
+        offsets.append(offsets[-1] + len(name))
+    by_id = array("I", sorted(range(len(ids)), key=ids.__getitem__))
+    version = importlib.metadata.version("asyncua").encode("utf-8")
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(version), len(ids)))
+        f.write(version)
+        for values in (ids, offsets, by_id):
+            f.write(values.tobytes())
+        f.write(b"".join(name for name, _ in ordered))
+    os.replace(f"{path}.tmp", path)
+
+
+# ru_maxrss would include the memory of the benchmarking process before the exec
+_BENCHMARK = """
+import sys, time
+start = time.perf_counter()
+if sys.argv[1] == "lazy":
+    from opcua_server import lazy_asyncua
+    lazy_asyncua.install(sys.argv[2])
+import asyncua
+from asyncua import ua
+ua.ObjectIds.Server_NamespaceArray
+with open("/proc/self/status") as f:
+    peak = next(line.split()[1] for line in f if line.startswith("VmHWM:"))
+print(time.perf_counter() - start, peak)
+"""
+
+
+def benchmark(index_path: str = INDEX_PATH, runs: int = 5) -> dict[str, tuple]:
+    """Measure importing asyncua with and without install() in fresh interpreters.
+
+    :param index_path: Location of the index file, defaults to INDEX_PATH
+    :param runs: Number of imports per variant, defaults to 5
+    :return: Best import time in seconds and peak resident memory in KiB per variant
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root] + sys.path)))
+    results = {}
+    for variant in ("asyncua", "lazy"):
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", _BENCHMARK, variant, index_path],
+                capture_output=True,
+                check=True,
+                env=env,
+                text=True,
+            ).stdout.split()
+            samples.append((float(output[0]), int(output[1])))
+        results[variant] = min(samples)
+        _logger.info(
+            f"{variant}: import {results[variant][0] * 1e3:.0f} ms,"
+            f" peak memory {results[variant][1] / 1024:.1f} MiB"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lazy imports of asyncua")
+    parser.add_argument(
+        "--index", default=INDEX_PATH, help="Location of the node id index"
+    )
+    parser.add_argument(
+        "--write-index", action="store_true", help="Write the node id index"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare importing asyncua with and without lazy imports",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.write_index:
+        write_index(args.index)
+    if args.benchmark:
+        benchmark(args.index)
@@ -1,19 +1,54 @@
+import argparse
 import asyncio
+from datetime import timedelta
 import logging
+import os
+
+from opcua_server import lazy_asyncua
+
+# before asyncua is imported
+lazy_asyncua.install()
 
 from asyncua import Server, ua
 from asyncua.common.methods import uamethod
-
+from asyncua.server.history import HistoryStorageInterface
+from asyncua.ua import NodeId
+
+from opcua_server.aspace_snapshot import (
+    bind_method_callbacks,
+    dump_snapshot,
+    dump_subtrees,
+    load_snapshot,
+    restore_subtrees,
+)
+from opcua_server.bulk_builder import AddressSpaceBuilder
+from opcua_server.history_columnar import ColumnarHistory
+from opcua_server.history_manager import AggregatingHistoryManager
+from opcua_server.history_ring import RingBufferHistory
+from opcua_server.history_sqlite import BatchedHistorySQLite
+from opcua_server.history_tiers import TieredHistory
+from opcua_server import (
+    array_codec,
+    crypto_offload,
+    publish_batching,
+    shared_monitoring,
+    static_codec,
+    zero_copy_transport,
+)
 from opcua_server.opcua_methods import (
     add_folder_,
     add_object_,
     add_variable_,
     delete_node_,
+    historize_node_,
     write_value_to_node_,
 )
 from settings import INTERNAL_OPCUA_ADDRESS, INTERNAL_OPCUA_PORT
 
 server = None
+# Values nodes of information nodes are historized if main() was given a history storage
+historize_values = False
+history_period = timedelta(days=7)
 
 
 @uamethod
@@ -67,7 +102,9 @@ async def add_variable(
         nodeid=nodeid,
         bname=bname,
         descr=descr,
-        val=val,
+        val=array_codec.to_list(val),
+        historize=historize_values and bname == "Values",
+        period=history_period,
     )
 
 
@@ -88,7 +125,28 @@ async def write_value_to_node(parent: ua.NodeId, nodeid: str, val) -> None:
     For full documentation on this function check opcua_methods.write_value_to_node_()
     """
     global server
-    return await write_value_to_node_(server=server, nodeid=nodeid, val=val)
+    return await write_value_to_node_(
+        server=server, nodeid=nodeid, val=array_codec.to_list(val)
+    )
+
+
+HISTORY_STORAGES = {
+    "sqlite": BatchedHistorySQLite,
+    "columnar": ColumnarHistory,
+    "memory": RingBufferHistory,
+}
+
+# Identifiers of the method nodes and the functions they call, used to re-bind the
+# methods after loading an address space snapshot
+METHOD_CALLBACKS = {
+    90001: add_folder,
+    90002: add_object,
+    90003: delete_node,
+    90101: add_variable,
+    90102: add_variable,
+    90103: add_variable,
+    90200: write_value_to_node,
+}
 
 
 async def main(
@@ -96,16 +154,92 @@ async def main(
     num_connections: int = 16,
     host: str = INTERNAL_OPCUA_ADDRESS,
     port: str = INTERNAL_OPCUA_PORT,
+    snapshot: str = None,
+    state: str = None,
+    history: HistoryStorageInterface = None,
+    period: timedelta = timedelta(days=7),
+    array_mode: str = None,
+    crypto_workers: int = None,
 ) -> None:
-    """Set up an OPC-UA server with preconfigured nodes."""
-    global server
+    """Set up an OPC-UA server with preconfigured nodes.
+
+    If a snapshot is given and exists, the address space is loaded from it instead of
+    being built node by node. If a state file is given and exists, the sensor nodes
+    saved by run_server() are restored on top of it. If a history storage is given, the
+    Values nodes of all information nodes are historized in it for the given period.
+    History can be read raw or aggregated per processing interval. Connections use the
+    zero-copy receive path of zero_copy_transport and messages are encoded and decoded
+    by the generated functions of static_codec. Identical monitored items of all
+    subscriptions share one data change callback (shared_monitoring), keep bounded
+    queues and publish in size-limited batches (publish_batching). If an array mode
+    is given, numeric arrays are encoded and decoded as buffers by array_codec. If a
+    number of crypto workers is given, secured connections sign and encrypt large
+    messages in a pool of that many threads (crypto_offload).
+    """
+    global server, historize_values, history_period
     _logger = logging.getLogger("NNE-OPC-UA-Server")
 
+    zero_copy_transport.install()
+    static_codec.install()
+    shared_monitoring.install()
+    publish_batching.install()
+    if array_mode is not None:
+        array_codec.install(array_mode)
+    if crypto_workers is not None:
+        crypto_offload.install(crypto_workers)
     server = Server()
-    await server.init()
+    server.iserver.history_manager = AggregatingHistoryManager(server.iserver, nsidx)
+    if history is not None:
+        server.iserver.history_manager.set_storage(history)
+        historize_values = True
+        history_period = period
+    if snapshot is not None and os.path.isfile(snapshot):
+        await load_snapshot(server, snapshot)
+        bind_method_callbacks(
+            server,
+            {NodeId(i, nsidx): callback for i, callback in METHOD_CALLBACKS.items()},
+        )
+    else:
+        await server.init()
+        await populate_address_space(server, nsidx, num_connections)
+    if state is not None and os.path.isfile(state):
+        restored = await restore_subtrees(server, state)
+        if historize_values:
+            for nodeid in restored:
+                node = server.get_node(nodeid)
+                if (await node.read_browse_name()).Name == "Values":
+                    await historize_node_(server, node, period=period)
     server.set_endpoint(f"opc.tcp://{host}:{port}/nne/server/")
     server.set_server_name("NNE Unibio OPC-UA Server")
 
+    _logger.info("Starting server!")
+    return server
+
+
+async def build_snapshot(path: str, nsidx: int, num_connections: int = 16) -> None:
+    """Build the NNE MI address space and dump it to a snapshot file.
+
+    :param path: Location of the snapshot file
+    :param nsidx: Namespace index of the NNE MI nodes
+    :param num_connections: Number of ports of the IoT box, defaults to 16
+    """
+    snapshot_server = Server()
+    await snapshot_server.init()
+    await populate_address_space(snapshot_server, nsidx, num_connections)
+    await dump_snapshot(snapshot_server, path)
+
+
+async def populate_address_space(
+    server: Server, nsidx: int, num_connections: int = 16
+) -> None:
+    """Add the port tree and the method nodes of the NNE MI server.
+
+    :param server: Initialized OPC UA server
+    :param nsidx: Namespace index of the NNE MI nodes
+    :param num_connections: Number of ports of the IoT box, defaults to 16
+    """
+    _logger = logging.getLogger("NNE-OPC-UA-Server")
+
     # setup our own namespace, not really necessary but should as spec
     # Left in for now until we figure out if this is actually necessary
     # uri = "http://examples.freeopcua.github.io"
@@ -114,19 +248,22 @@ async def main(
     devices = await server.nodes.objects.add_object(idx, "Devices")
     functions = await server.nodes.objects.add_object(idx, "Functions")
 
+    # the port trees are inserted in one pass
+    builder = AddressSpaceBuilder(server)
     for i in range(1, num_connections + 1):
         # Adding Port object, which will host the name of the sensor connected to the
         # port as well as all its information points
-        port = await devices.add_object(
-            f"ns={nsidx};i=1{i:0>2}000", bname=f"{nsidx}:Port{i:0>2}"
+        port = builder.add_object(
+            devices, f"ns={nsidx};i=1{i:0>2}000", bname=f"{nsidx}:Port{i:0>2}"
         )
-        await port.add_variable(
-            f"ns={nsidx};i=1{i:0>2}100", bname=f"{nsidx}:SensorName", val=f"Sensor{i:0>2}"
+        builder.add_variable(
+            port, f"ns={nsidx};i=1{i:0>2}100", f"{nsidx}:SensorName", f"Sensor{i:0>2}"
         )  # Sensor name
-        await port.add_object(
-            f"ns={nsidx};i=1{i:0>2}200", bname=f"{nsidx}:InformationNodes"
+        builder.add_object(
+            port, f"ns={nsidx};i=1{i:0>2}200", bname=f"{nsidx}:InformationNodes"
         )  # Information points
-        _logger.debug(f"Added node tree Port{i:0>2} with all child nodes")
+    builder.build()
+    _logger.debug(f"Added node trees of {num_connections} ports with all child nodes")
 
     _logger.debug("Registering add_folder method")
     await functions.add_method(
@@ -327,20 +464,130 @@ async def main(
         [],
     )
 
-    _logger.info("Starting server!")
-    return server
 
+def port_nodeids(nsidx: int, num_connections: int = 16) -> list[NodeId]:
+    """Get the NodeIds of the port nodes, which hold all sensor specific nodes.
 
-async def run_server(server: Server) -> None:
+    :param nsidx: Namespace index of the NNE MI nodes
+    :param num_connections: Number of ports of the IoT box, defaults to 16
+    :return: List of port NodeIds
+    """
+    return [NodeId(int(f"1{i:0>2}000"), nsidx) for i in range(1, num_connections + 1)]
+
+
+async def run_server(
+    server: Server,
+    state: str = None,
+    nsidx: int = 6,
+    num_connections: int = 16,
+    save_interval: float = 30,
+) -> None:
     """Run the OPC UA server.
 
+    If a state file is given, the port subtrees (including the information nodes
+    created for connected sensors) are saved to it periodically and on shutdown, so
+    that main() can restore them after a restart.
+
     :param server: Server object with completed setup
+    :param state: Location of the state file, defaults to None
+    :param nsidx: Namespace index of the NNE MI nodes, defaults to 6
+    :param num_connections: Number of ports of the IoT box, defaults to 16
+    :param save_interval: Seconds between saves of the state file, defaults to 30
     """
     async with server:
-        while True:
-            await asyncio.sleep(1)
+        try:
+            while True:
+                await asyncio.sleep(save_interval if state is not None else 1)
+                if state is not None:
+                    await dump_subtrees(
+                        server, state, port_nodeids(nsidx, num_connections)
+                    )
+        finally:
+            if state is not None:
+                await dump_subtrees(server, state, port_nodeids(nsidx, num_connections))
+
+
+async def serve(nsidx: int, state: str = None, **kwargs) -> None:
+    """Set up the OPC UA server with main() and run it with run_server().
+
+    Both run in one event loop: the history storage starts its periodic flush and the
+    restored Values nodes are historized in the loop of main(), so they would stop with
+    it.
+
+    :param nsidx: Namespace index of the NNE MI nodes
+    :param state: Location of the state file, defaults to None
+    :param kwargs: Further arguments of main()
+    """
+    server = await main(nsidx=nsidx, state=state, **kwargs)
+    await run_server(server, state=state, nsidx=nsidx)
 
 
 if __name__ == "__main__":
-    server = asyncio.run(main(nsidx=6, host="0.0.0.0", port="4840"), debug=True)
-    asyncio.run(run_server(server))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="NNE MI OPC UA server")
+    parser.add_argument(
+        "--snapshot", help="Address space snapshot to start the server from"
+    )
+    parser.add_argument(
+        "--build-snapshot",
+        metavar="PATH",
+        help="Build the address space snapshot at PATH and exit",
+    )
+    parser.add_argument(
+        "--state", help="File to save and restore the sensor nodes across restarts"
+    )
+    parser.add_argument(
+        "--history",
+        help="SQLite database or columnar directory to historize the sensor values in",
+    )
+    parser.add_argument(
+        "--history-capacity",
+        type=int,
+        default=36000,
+        help="Number of values kept per node in memory, defaults to 36000",
+    )
+    parser.add_argument(
+        "--history-tiers",
+        metavar="PATH",
+        help="Keep raw values for 24 hours and minute/hour rollups in the database at"
+        " PATH for 30/365 days",
+    )
+    parser.add_argument(
+        "--history-format",
+        choices=HISTORY_STORAGES.keys(),
+        default="sqlite",
+        help="Storage format of the history, defaults to sqlite",
+    )
+    parser.add_argument(
+        "--array-mode",
+        choices=["array"],
+        help="Decode numeric arrays into array.array objects instead of lists",
+    )
+    parser.add_argument(
+        "--crypto-workers",
+        type=int,
+        help="Number of threads that secure large messages of secured connections",
+    )
+    args = parser.parse_args()
+    history = None
+    if args.history_format == "memory":
+        history = RingBufferHistory(args.history_capacity)
+    elif args.history:
+        history = HISTORY_STORAGES[args.history_format](args.history)
+    if history is not None and args.history_tiers:
+        history = TieredHistory(history, args.history_tiers)
+    if args.build_snapshot:
+        asyncio.run(build_snapshot(args.build_snapshot, nsidx=6))
+    else:
+        asyncio.run(
+            serve(
+                nsidx=6,
+                host="0.0.0.0",
+                port="4840",
+                snapshot=args.snapshot,
+                state=args.state,
+                history=history,
+                array_mode=args.array_mode,
+                crypto_workers=args.crypto_workers,
+            ),
+            debug=True,
+        )
\ No newline at end of file
@@ -0,0 +1,426 @@
+"""XML nodeset import with batched node additions and a cache of the parsed nodeset.
+
+Server.import_xml() parses the whole XML file on every start, sorts the nodes by parent
+with repeated passes over the remaining list (_sort_nodes_by_parentid, quadratic in the
+number of nodes) and awaits one AddNodes and one AddReferences call per node. Afterwards
+it browses every new node and every target of its references through the service
+layer to add the missing reverse references. For companion specifications with
+thousands of nodes this makes up most of the start-up time.
+
+CachedXmlImporter imports the same nodes and references, but:
+* the nodes are sorted parent first in one pass over the list,
+* all nodes are added with one AddNodes call and all references with one
+  AddReferences call (nodes whose import reads the address space, data types with a
+  definition and variables with extension object values, flush the batch first),
+* the missing reverse references are found and added in the address space directly,
+  with an index of the existing references of each target.
+The parsed and namespace-migrated nodes are pickled next to the XML file (or into
+cache_dir), keyed by the SHA-256 of the XML and the asyncua version. The next import of
+the same file into a server that maps its namespaces to the same indices skips parsing
+the XML. If a node can't be added, the nodes after it in the batch have been added
+already, unlike with the importer of asyncua.
+
+python -m opcua_server.nodeset_import --benchmark FILE compares both importers.
+
+Classes
+-------
+CachedXmlImporter
+    XmlImporter that adds nodes in batches and caches the parsed nodeset.
+
+Functions
+---------
+import_xml
+    Imports a nodeset XML file into a server with CachedXmlImporter.
+benchmark
+    Measures importing a nodeset with asyncua and with CachedXmlImporter.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+import asyncua
+from asyncua import Server, ua
+from asyncua.common.xmlimporter import XmlImporter
+from asyncua.common.xmlparser import XMLParser
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+# bump when the pickled content changes
+CACHE_FORMAT = 1
+# checked by XmlImporter._add_missing_reverse_references, which compares them with the
+# reference type NodeIds and thus never excludes a reference, neither does this module
+UNIDIRECTIONAL_TYPES = {
+    ua.ObjectIds.GuardVariableType,
+    ua.ObjectIds.HasGuard,
+    ua.ObjectIds.TransitionVariableType,
+    ua.ObjectIds.StateMachineType,
+    ua.ObjectIds.StateVariableType,
+    ua.ObjectIds.TwoStateVariableType,
+    ua.ObjectIds.StateType,
+    ua.ObjectIds.TransitionType,
+    ua.ObjectIds.FiniteTransitionVariableType,
+    ua.ObjectIds.HasInterface,
+}
+
+
+class _Nodeset:
+    """Parsed nodeset, in place of the XMLParser of the importer."""
+
+    def __init__(self, required_models, used_namespaces, aliases) -> None:
+        self.required_models = required_models
+        self.used_namespaces = used_namespaces
+        self.aliases = aliases
+        # namespace map the nodes were migrated with and the sorted, migrated nodes
+        self.namespaces: dict[int, int] | None = None
+        self.nodes: list | None = None
+
+    def list_required_models(self, xmlpath=None, xmlstring=None) -> list[dict]:
+        # XmlImporter._check_required_models removes the satisfied models
+        return [dict(model) for model in self.required_models]
+
+    def get_used_namespaces(self) -> list[str]:
+        return list(self.used_namespaces)
+
+    def get_aliases(self) -> dict:
+        return dict(self.aliases)
+
+
+class _Batch:
+    """Collects AddNodes and AddReferences items instead of sending them."""
+
+    def __init__(self) -> None:
+        self.nodes: list[ua.AddNodesItem] = []
+        self.refs: list[ua.AddReferencesItem] = []
+
+    async def add_nodes(self, items: list) -> list[ua.AddNodesResult]:
+        self.nodes.extend(items)
+        return [
+            ua.AddNodesResult(AddedNodeId=item.RequestedNewNodeId) for item in items
+        ]
+
+    async def add_references(self, refs: list) -> list[ua.StatusCode]:
+        self.refs.extend(refs)
+        return [ua.StatusCode() for _ in refs]
+
+
+class CachedXmlImporter(XmlImporter):
+    """XmlImporter that adds nodes in batches and caches the parsed nodeset.
+
+    Only works with a Server, not with a Client.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory of the cache files, None for the directory of the XML file
+    cache_hit : bool
+        Whether the last import used a cached nodeset
+
+    Methods
+    -------
+    import_xml:
+        Imports the nodes of an XML file or string and returns their NodeIds
+    """
+
+    def __init__(self, server: Server, cache_dir: str = None) -> None:
+        """Create CachedXmlImporter object.
+
+        :param server: Server to import the nodes into
+        :param cache_dir: Directory of the cache files, defaults to the directory of
+        the XML file. Imports of XML strings are only cached with a cache_dir.
+        """
+        super().__init__(server)
+        self.cache_dir = cache_dir
+        self.cache_hit = False
+        self._batch: _Batch | None = None
+
+    def _cache_path(self, xmlpath: str | None, data: bytes) -> str | None:
+        if xmlpath is None and self.cache_dir is None:
+            return None
+        digest = hashlib.sha256(
+            f"{CACHE_FORMAT}:{asyncua.__version__}:".encode() + data
+        ).hexdigest()
+        name = os.path.basename(xmlpath) if xmlpath is not None else "nodeset"
+        directory = self.cache_dir or os.path.dirname(os.path.abspath(xmlpath))
+        return os.path.join(directory, f".{name}.{digest[:16]}.nodeset")
+
+    @staticmethod
+    def _load(path: str) -> _Nodeset | None:
+        try:
+            with open(path, "rb") as f:
+                content = pickle.load(f)
+            nodeset = _Nodeset(
+                content["required_models"],
+                content["used_namespaces"],
+                content["aliases"],
+            )
+            nodeset.namespaces = content["namespaces"]
+            nodeset.nodes = content["nodes"]
+            return nodeset
+        except FileNotFoundError:
+            return None
+        except Exception:
+            _logger.warning(f"Ignoring unreadable nodeset cache {path}", exc_info=True)
+            return None
+
+    @staticmethod
+    def _save(path: str, nodeset: _Nodeset) -> None:
+        try:
+            with open(f"{path}.tmp", "wb") as f:
+                pickle.dump(vars(nodeset), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            _logger.warning(f"Could not write nodeset cache {path}", exc_info=True)
+
+    async def import_xml(self, xmlpath: str = None, xmlstring: str = None) -> list:
+        """Import the nodes of an XML file or string and return their NodeIds.
+
+        :param xmlpath: Location of the XML file
+        :param xmlstring: XML nodeset as a string
+        :return: NodeIds of the added nodes
+        :raises ValueError: If not exactly one of xmlpath and xmlstring is given, or
+        the server lacks a required model
+        """
+        if (xmlpath is None and xmlstring is None) or (xmlpath and xmlstring):
+            raise ValueError(
+                "Expected either xmlpath or xmlstring, not both or neither."
+            )
+        loop = asyncio.get_running_loop()
+        if xmlpath is not None:
+            with open(xmlpath, "rb") as f:
+                data = await loop.run_in_executor(None, f.read)
+        else:
+            data = xmlstring.encode("utf-8")
+        cache_path = self._cache_path(xmlpath, data)
+        nodeset = None
+        if cache_path is not None:
+            nodeset = await loop.run_in_executor(None, self._load, cache_path)
+        parser = None
+        if nodeset is None:
+            parser = XMLParser()
+            await parser.parse(xmlpath, xmlstring)
+            # like XMLParser.list_required_models, without parsing the XML again
+            required_models = [
+                dict(element.attrib)
+                for element in parser.root.iter()
+                if element.tag.endswith("RequiredModel")
+            ]
+            nodeset = _Nodeset(
+                required_models, parser.get_used_namespaces(), parser.get_aliases()
+            )
+        self.parser = nodeset
+        await self._check_required_models(xmlpath, xmlstring)
+        self.namespaces = await self._map_namespaces()
+        self._unmigrated_aliases = nodeset.get_aliases()
+        self.aliases = self._map_aliases(self._unmigrated_aliases)
+        self.refs = []
+        self.cache_hit = nodeset.namespaces == self.namespaces
+        if not self.cache_hit:
+            if parser is None:
+                # cached for another namespace mapping
+                parser = XMLParser()
+                await parser.parse(xmlpath, xmlstring)
+            dnodes = self.make_objects(parser.get_node_datas())
+            self._add_missing_parents(dnodes)
+            nodeset.nodes = self._sort_nodes_by_parentid(dnodes)
+            nodeset.namespaces = self.namespaces
+            if cache_path is not None:
+                await loop.run_in_executor(None, self._save, cache_path, nodeset)
+        _logger.info(
+            f"Importing {len(nodeset.nodes)} nodes of {xmlpath or 'XML string'}"
+            f"{' from cache' if self.cache_hit else ''}"
+        )
+        nodes = await self._add_node_datas(nodeset.nodes)
+        self.refs, remaining_refs = [], self.refs
+        await self._add_references(remaining_refs)
+        missing_nodes = await self._add_missing_reverse_references(nodes)
+        if missing_nodes:
+            _logger.warning(
+                f"The following references exist, but the Nodes are missing: "
+                f"{missing_nodes}"
+            )
+        if self.refs:
+            _logger.warning(
+                f"The following references could not be imported and are probably "
+                f"broken: {self.refs}"
+            )
+        return nodes
+
+    async def _add_node_datas(self, node_datas: list) -> list:
+        """Add the nodes and their references in batches."""
+        nodes = []
+        self._batch = _Batch()
+        try:
+            for nodedata in node_datas:
+                if self._reads_address_space(nodedata):
+                    await self._flush()
+                try:
+                    node = await self._add_node_data(
+                        nodedata, no_namespace_migration=True
+                    )
+                except Exception:
+                    _logger.warning(f"failure adding node {nodedata}")
+                    raise
+                nodes.append(node)
+            await self._flush()
+        finally:
+            self._batch = None
+        return nodes
+
+    def _reads_address_space(self, nodedata) -> bool:
+        """Return if importing the node reads nodes imported before it."""
+        if nodedata.nodetype == "UADataType":
+            return bool(nodedata.definitions)
+        return nodedata.nodetype == "UAVariable" and "ExtensionObject" in str(
+            nodedata.valuetype
+        )
+
+    async def _flush(self) -> None:
+        """Add the collected nodes, then the collected references."""
+        batch, self._batch = self._batch, None
+        try:
+            session = self._get_server()
+            if batch.nodes:
+                for result in await session.add_nodes(batch.nodes):
+                    result.StatusCode.check()
+            if batch.refs:
+                await self._add_references(batch.refs)
+        finally:
+            self._batch = _Batch()
+
+    def _get_server(self):
+        if self._batch is not None:
+            return self._batch
+        return super()._get_server()
+
+    def _sort_nodes_by_parentid(self, ndatas: list) -> list:
+        """Sort the nodes so that every node follows its parent, in one pass.
+
+        Like XmlImporter, nodes outside the imported namespaces and nodes whose parent
+        isn't imported stay in place.
+        """
+        imported = set(self.namespaces.values())
+        by_nodeid = {ndata.nodeid: ndata for ndata in ndatas}
+        sorted_ndatas = []
+        done: set[int] = set()
+        for ndata in ndatas:
+            ancestors = []
+            while ndata is not None and id(ndata) not in done:
+                done.add(id(ndata))
+                ancestors.append(ndata)
+                if ndata.nodeid.NamespaceIndex not in imported or ndata.parent is None:
+                    break
+                ndata = by_nodeid.get(ndata.parent)
+            sorted_ndatas.extend(reversed(ancestors))
+        return sorted_ndatas
+
+    async def _add_missing_reverse_references(self, new_nodes: list) -> set:
+        # AddressSpace._add_unique_reference() scans all references of the target for
+        # every reverse reference, quadratic for type definitions of many variables, so
+        # the existing (node id, reference type) pairs of each target are indexed once
+        aspace = self.server.iserver.aspace
+        dangling_refs_to_missing_nodes = set()
+        known: dict[ua.NodeId, set] = {}
+        for new_node_id in new_nodes:
+            new_ndata = aspace.get(new_node_id)
+            if new_ndata is None or not new_ndata.references:
+                _logger.warning(
+                    f"Node {new_node_id} has no references, so it does not exist in "
+                    "Server!"
+                )
+                continue
+            attrs = new_ndata.attributes
+            for ref in list(new_ndata.references):
+                if ref.ReferenceTypeId in UNIDIRECTIONAL_TYPES:
+                    continue
+                ndata = aspace.get(ref.NodeId)
+                if ndata is None or not ndata.references:
+                    _logger.warning(
+                        f"Node {ref.NodeId} has no references, so it does not exist "
+                        "in Server!"
+                    )
+                    dangling_refs_to_missing_nodes.add(ref.NodeId)
+                    continue
+                pairs = known.get(ref.NodeId)
+                if pairs is None:
+                    pairs = known[ref.NodeId] = {
+                        (n_ref.NodeId, n_ref.ReferenceTypeId)
+                        for n_ref in ndata.references
+                    }
+                if (new_node_id, ref.ReferenceTypeId) in pairs:
+                    continue
+                pairs.add((new_node_id, ref.ReferenceTypeId))
+                # the ReferenceDescription AddressSpace._add_reference_no_check() makes
+                ndata.references.append(
+                    ua.ReferenceDescription(
+                        ReferenceTypeId=ref.ReferenceTypeId,
+                        IsForward=not ref.IsForward,
+                        NodeId=new_node_id,
+                        BrowseName=attrs[ua.AttributeIds.BrowseName].value.Value.Value,
+                        DisplayName=attrs[
+                            ua.AttributeIds.DisplayName
+                        ].value.Value.Value,
+                        NodeClass_=attrs[ua.AttributeIds.NodeClass].value.Value.Value,
+                    )
+                )
+        return dangling_refs_to_missing_nodes
+
+
+async def import_xml(
+    server: Server, xmlpath: str = None, xmlstring: str = None, cache_dir: str = None
+) -> list:
+    """Import a nodeset XML file into a server with CachedXmlImporter.
+
+    Replaces Server.import_xml(xmlpath, xmlstring).
+
+    :param server: Initialized server
+    :param xmlpath: Location of the XML file
+    :param xmlstring: XML nodeset as a string
+    :param cache_dir: Directory of the cache files, defaults to the directory of the
+    XML file
+    :return: NodeIds of the added nodes
+    """
+    importer = CachedXmlImporter(server, cache_dir)
+    return await importer.import_xml(xmlpath, xmlstring)
+
+
+async def benchmark(xmlpath: str) -> dict[str, float]:
+    """Measure importing a nodeset with asyncua and with CachedXmlImporter.
+
+    Every import goes into a new server. The cached imports use a temporary cache
+    directory, the first one fills it.
+
+    :param xmlpath: Location of the XML file
+    :return: Seconds per import variant
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name in ("Server.import_xml", "cold cache", "warm cache"):
+            server = Server()
+            await server.init()
+            start = time.perf_counter()
+            if name == "Server.import_xml":
+                nodes = await server.import_xml(xmlpath)
+            else:
+                nodes = await import_xml(server, xmlpath, cache_dir=cache_dir)
+            results[name] = time.perf_counter() - start
+            _logger.info(f"{name}: {len(nodes)} nodes in {results[name]:.3f} s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cached XML nodeset import")
+    parser.add_argument(
+        "--benchmark",
+        metavar="FILE",
+        help="Compare importing the nodeset FILE with asyncua and with the cache",
+    )
+    args = parser.parse_args()
+    if args.benchmark:
+        logging.basicConfig(level=logging.WARNING)
+        _logger.setLevel(logging.INFO)
+        asyncio.run(benchmark(args.benchmark))
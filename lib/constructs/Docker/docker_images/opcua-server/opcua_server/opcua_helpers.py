@@ -19,8 +19,16 @@ handle_disconnect
 handle_writing
     Queries the IO-Link master OPC UA server for updated values and writes them to the
     correct value nodes in the NNE MI OPC UA server.
+load_connections
+    Loads the connection state saved by save_connections.
+reconcile_connection
+    Reuses the nodes of a sensor that was already connected before a restart.
+save_connections
+    Saves which sensor is connected to which port and where its nodes are.
 """
+import json
 import logging
+import os
 
 from asyncua import Client, Node
 from asyncua.ua import NodeId
@@ -29,7 +37,9 @@ import requests
 
 from iolink.iodd_collection_helpers import IODDCollection
 from iolink.information_node import InformationNode
+from opcua_server.ingest_client import BulkIngestClient
 from opcua_server.method_node import MethodNode
+from opcua_server.pdi_archive import PDIArchive
 
 
 async def check_for_existing_children(
@@ -182,7 +192,7 @@ async def handle_connect(
     connection: dict,
     name: str,
     port_idx: int,
-) -> dict, IODDCollection:
+) -> tuple[dict, IODDCollection]:
     """Handle new connection to IoT box.
 
     This function creates the relevant nodes within the NNE MI OPC UA server and fills
@@ -199,6 +209,7 @@ async def handle_connect(
     """
     _logger = logging.getLogger("OPC UA Server Bridge")
     connection["name"] = name
+    connection["port_idx"] = port_idx
     iodd = iodd_collection.lookup_sensor(name)
     if iodd is not None:
         connection["IODD"] = iodd
@@ -245,17 +256,29 @@ async def handle_disconnect(
 
 
 async def handle_writing(
-    iotbox_value_node: Node, connection: dict, method: MethodNode
+    iotbox_value_node: Node,
+    connection: dict,
+    method: MethodNode,
+    archive: PDIArchive = None,
+    ingest: BulkIngestClient = None,
 ) -> None:
     """Write updated values to the nodes.
 
     :param iotbox_value_node: Node of the IO-Link master OPC UA server that contains the
     raw byte values
-    :param connection: Dictionary used to keep track of connected sensors
+    :param connection: Dictionary used to keep track of connected sensors, with the
+    port index set by handle_connect or reconcile_connection
     :param method: MethodNode to call the write function
+    :param archive: Archive to append the raw byte values to, defaults to None
+    :param ingest: Client to queue the readings for the local database API with,
+    without one every reading is posted separately, defaults to None
     """
     _logger = logging.getLogger("OPC UA Server Bridge")
     byte_values = await iotbox_value_node.read_value()
+    if archive is not None:
+        archive.append(
+            connection["port_idx"], byte_values, connection["IODD"].content_hash()
+        )
     for idx, inode in enumerate(connection["IODD"].information_nodes):
         nodeid = connection["value_nodeids"][idx].to_string()
         inode: InformationNode
@@ -265,7 +288,112 @@ async def handle_writing(
             f"Wrote {real_values} to {inode.name}/Values @"
             f"{nodeid}"
         )
+        if ingest is not None:
+            ingest.add(
+                connection["port_idx"] + 1,
+                connection["name"],
+                inode.name,
+                real_values,
+                inode.low_bounds,
+                inode.up_bounds,
+                inode.units,
+            )
+            continue
         data = {"sensorname": connection["name"], "informationnode": inode.name, "values": real_values, "lowerbounds": inode.low_bounds, "upperbounds": inode.up_bounds, "units": inode.units}
         print(inode.units)
         resp = requests.post(f"http://localhost:360/insert/{str(nodeid[8:10]).lstrip('0')}", json=data)
         print(resp.status_code)
+
+
+def load_connections(path: str) -> dict[int, dict]:
+    """Load the connection state saved by save_connections.
+
+    :param path: Location of the state file
+    :return: Dictionary of port indices and their saved connection, empty if there is
+    no state file
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return {int(port_idx): saved for port_idx, saved in json.load(f).items()}
+
+
+async def reconcile_connection(
+    nnemi_client: Client,
+    iodd_collection: IODDCollection,
+    connection: dict,
+    saved: dict | None,
+    name: str,
+    port_idx: int,
+) -> bool:
+    """Reuse the nodes of a sensor that was already connected before a restart.
+
+    The saved connection is only reused if the same sensor is still connected, its IODD
+    hasn't changed and the NNE MI OPC UA server still has the information nodes. If this
+    returns False, the port has to be set up from scratch with
+    check_for_existing_children and handle_connect.
+
+    :param nnemi_client: OPC UA Client connected to the NNE MI OPC UA server
+    :param iodd_collection: IODDCollection to pick the sensor from
+    :param connection: Dictionary describing the connection, used for keeping track
+    :param saved: Connection of the port as saved by save_connections, or None
+    :param name: Name of the sensor that is connected
+    :param port_idx: Port index
+    :return: True if the existing nodes were reused, False otherwise
+    """
+    _logger = logging.getLogger("OPC UA Server Bridge")
+    if saved is None or saved["name"] != name:
+        return False
+    iodd = iodd_collection.lookup_sensor(name)
+    if iodd is None or iodd.content_hash() != saved["iodd_hash"]:
+        _logger.warning(f"IODD of {name} changed, Port {port_idx+1} will be rebuilt")
+        return False
+    inode_names = [inode.name for inode in iodd.information_nodes]
+    if inode_names != saved["information_nodes"]:
+        return False
+
+    node_to_check = nnemi_client.get_node(f"ns=6;i=1{(port_idx+1):0>2}200")
+    children: list[Node] = await node_to_check.get_children()
+    existing = {child.nodeid.to_string() for child in children}
+    expected = {
+        f"ns=6;i=1{(port_idx+1):0>2}2{idx+1}0" for idx, _ in enumerate(inode_names)
+    }
+    if existing != expected:
+        return False
+
+    connection["name"] = name
+    connection["port_idx"] = port_idx
+    connection["IODD"] = iodd
+    connection["value_nodeids"] = [
+        NodeId.from_string(nodeid) for nodeid in saved["value_nodeids"]
+    ]
+    _logger.warning(f"Reusing existing nodes of {name} on Port {port_idx+1}")
+    return True
+
+
+def save_connections(connections: list[dict], path: str) -> None:
+    """Save which sensor is connected to which port and where its nodes are.
+
+    Only connected ports are saved. The file is replaced atomically, so a crash while
+    saving never leaves a broken file behind.
+
+    :param connections: List of connection dictionaries, indexed by port index
+    :param path: Location of the state file
+    """
+    state = {
+        port_idx: {
+            "name": connection["name"],
+            "iodd_hash": connection["IODD"].content_hash(),
+            "information_nodes": [
+                inode.name for inode in connection["IODD"].information_nodes
+            ],
+            "value_nodeids": [
+                nodeid.to_string() for nodeid in connection["value_nodeids"]
+            ],
+        }
+        for port_idx, connection in enumerate(connections)
+        if connection["name"] is not None
+    }
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
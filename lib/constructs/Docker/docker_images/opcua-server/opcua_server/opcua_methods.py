@@ -16,21 +16,33 @@ add_variable_
     Handles the creation of a variable node, regardless of variable type.
 delete_node_
     Handles the deletion of a given node.
+historize_node_
+    Starts historizing the data changes of a variable node.
 validate_nodeid
     Validates a nodeid against the provided pattern.
 write_value_to_node_
     Writes a new value to the given node.
 """
+from datetime import timedelta
 from itertools import compress
 import logging
 import re
 
-from asyncua import Server, ua
+from asyncua import Node, Server, ua
 
+from opcua_server.bulk_builder import AddressSpaceBuilder
 from opcua_server.opcua_errors import NodeIdInvalidError, InconsistentArrayError
+from opcua_server.write_handle import WriteHandle
 
 _logger = logging.getLogger("NNE-OPC-UA Server")
 
+# Nodes whose data changes are historized, they need to be dehistorized on deletion so
+# that they can be historized again when the sensor is reconnected
+_historized: set[ua.NodeId] = set()
+
+# Write handles of the nodes written by write_value_to_node_, by node id string
+_write_handles: dict[str, WriteHandle] = {}
+
 
 async def add_folder_(
     server: Server, parent_nodeid: str, nodeid: str, bname: str, descr: str
@@ -44,12 +56,9 @@ async def add_folder_(
     :param descr: Description of the node
     """
     validate_nodeid(nodeid)
-    parent_node = server.get_node(parent_nodeid)
-    node = await parent_node.add_folder(nodeid, bname=bname)
-    await node.write_attribute(
-        ua.AttributeIds.Description,
-        ua.DataValue(ua.Variant(ua.LocalizedText(descr, "en"))),
-    )
+    builder = AddressSpaceBuilder(server)
+    builder.add_folder(parent_nodeid, nodeid, bname, descr)
+    builder.build()
     _logger.debug(f"Successfully created folder {bname} @ {nodeid}")
 
 
@@ -65,12 +74,9 @@ async def add_object_(
     :param descr: Description of the node
     """
     validate_nodeid(parent_nodeid, nodeid)
-    parent_node = server.get_node(parent_nodeid)
-    node = await parent_node.add_object(nodeid, bname=bname)
-    await node.write_attribute(
-        ua.AttributeIds.Description,
-        ua.DataValue(ua.Variant(ua.LocalizedText(descr, "en"))),
-    )
+    builder = AddressSpaceBuilder(server)
+    builder.add_object(parent_nodeid, nodeid, bname, descr)
+    builder.build()
     _logger.debug(f"Successfully created object {bname} @ {nodeid}")
 
 
@@ -81,6 +87,9 @@ async def add_variable_(
     bname: str,
     descr: str,
     val: str | int | float | list = None,
+    historize: bool = False,
+    period: timedelta = timedelta(days=7),
+    count: int = 0,
 ) -> None:
     """Add a variable as a child to specified parent node.
 
@@ -90,18 +99,21 @@ async def add_variable_(
     :param bname: Browse name of the node to be created
     :param descr: Description of the node
     :param val: Initial value for the new variable node
+    :param historize: Whether to historize the data changes of the node, defaults to
+    False
+    :param period: How long the history is kept, defaults to 7 days
+    :param count: Maximum number of data changes kept, defaults to 0 (no limit)
     """
     if isinstance(val, list):
         if any([False if isinstance(li, type(val[0])) else True for li in val]):
             raise InconsistentArrayError(nodeid=nodeid, ls=val)
     validate_nodeid(parent_nodeid, nodeid)
-    parent_node = server.get_node(parent_nodeid)
-    node = await parent_node.add_variable(nodeid, bname=bname, val=val)
-    await node.write_attribute(
-        ua.AttributeIds.Description,
-        ua.DataValue(ua.Variant(ua.LocalizedText(descr, "en"))),
-    )
-    await node.set_writable()
+    builder = AddressSpaceBuilder(server)
+    builder.add_variable(parent_nodeid, nodeid, bname, val, descr, writable=True)
+    builder.build()
+    if historize:
+        node = server.get_node(nodeid)
+        await historize_node_(server, node, period=period, count=count)
     _logger.debug(f"Successfully created variable {bname} with value {val} @ {nodeid}")
 
 
@@ -114,10 +126,48 @@ async def delete_node_(server: Server, nodeid: str) -> None:
     validate_nodeid(nodeid)
     node_to_delete = server.get_node(nodeid)
     browse_name = await node_to_delete.read_browse_name()
+    await _dehistorize_subtree(server, node_to_delete)
     await server.delete_nodes([node_to_delete], recursive=True)
+    for handle_nodeid, handle in list(_write_handles.items()):
+        if not handle.is_valid():
+            del _write_handles[handle_nodeid]
     _logger.debug(f"Successfully deleted node {browse_name} @ {nodeid}")
 
 
+async def _dehistorize_subtree(server: Server, node: Node) -> None:
+    """Stop historizing the given node and all nodes below it.
+
+    :param server: OPC-UA server that contains the nodes
+    :param node: Top node of the subtree
+    """
+    if not _historized:
+        return
+    to_visit = [node]
+    while to_visit:
+        current = to_visit.pop()
+        if current.nodeid in _historized:
+            await server.dehistorize_node_data_change(current)
+            _historized.discard(current.nodeid)
+        to_visit.extend(await current.get_children())
+
+
+async def historize_node_(
+    server: Server, node: Node, period: timedelta = timedelta(days=7), count: int = 0
+) -> None:
+    """Start historizing the data changes of a variable node.
+
+    Nodes historized with this function are dehistorized by delete_node_().
+
+    :param server: OPC-UA server with a history storage
+    :param node: Variable node to historize
+    :param period: How long the history is kept, defaults to 7 days
+    :param count: Maximum number of data changes kept, defaults to 0 (no limit)
+    """
+    await server.historize_node_data_change(node, period=period, count=count)
+    _historized.add(node.nodeid)
+    _logger.debug(f"Historizing {node.nodeid.to_string()}")
+
+
 def validate_nodeid(*nodeid: str | ua.NodeId) -> bool:
     """Check if provided node id matches required pattern.
 
@@ -145,6 +195,8 @@ async def write_value_to_node_(
     :param nodeid: Node id as a string in form of "ns=XX;i=XX"
     :param val: value to write
     """
-    validate_nodeid(nodeid)
-    node_to_write_to = server.get_node(nodeid)
-    await node_to_write_to.write_value(val)
+    handle = _write_handles.get(nodeid)
+    if handle is None or handle.server is not server or not handle.is_valid():
+        validate_nodeid(nodeid)
+        handle = _write_handles[nodeid] = WriteHandle(server, nodeid)
+    await handle.write(val)
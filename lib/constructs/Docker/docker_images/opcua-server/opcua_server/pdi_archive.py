@@ -0,0 +1,252 @@
+"""Archive of the raw process data (PDI) frames read from the IO-Link master.
+
+The NNE MI server only keeps the decoded values of the information nodes, once per
+unit. When an IODD is fixed (e.g. a wrong gradient or offset), the values that were
+already decoded can't be recomputed. The archive keeps the raw PDI Data Byte Array
+frames of every port instead, together with the content hash of the IODD that was used
+while they were recorded, and decodes them on demand.
+
+Every port has its own directory with one append-only log file per (UTC) day. A log is
+a sequence of records, each starting with a kind byte, the timestamp in microseconds
+since the unix epoch and the payload length. An IODD record holds the SHA-256 digest
+of the IODD and applies to all frame records that follow it in the same file. A frame
+record holds the raw bytes, so a sample takes 11 bytes plus the PDI length.
+
+Classes
+-------
+PDIArchive
+    Appends raw PDI frames of the ports to the logs and reads/decodes them again.
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+import struct
+from typing import BinaryIO, Iterator
+
+from iolink.iodd import IODD
+from iolink.iodd_collection_helpers import IODDCollection
+from iolink.information_node import InformationNode
+from opcua_server.history_sqlite import datetime_to_us, us_to_datetime
+
+_logger = logging.getLogger("OPC UA Server Bridge")
+
+RECORD_HEADER = struct.Struct("<BqH")
+RECORD_IODD = 0
+RECORD_FRAME = 1
+
+
+class PDIArchive:
+    """Append-only archive of raw PDI frames per port.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the archive
+    flush_every : int
+        Number of appended frames after which the logs are flushed to disk
+
+    Methods
+    -------
+    append:
+        Appends a raw frame of a port to the archive
+    flush:
+        Writes the buffered frames of all ports to disk
+    close:
+        Flushes and closes all open logs
+    read:
+        Reads the raw frames of a port in a time range
+    decode:
+        Reads the frames of a port in a time range and decodes them with an IODD
+    """
+
+    def __init__(self, path: str = "pdi_archive", flush_every: int = 100) -> None:
+        """Create PDIArchive object.
+
+        :param path: Directory of the archive, defaults to "pdi_archive"
+        :param flush_every: Number of appended frames after which the logs are flushed
+        to disk, defaults to 100
+        """
+        self.path = path
+        self.flush_every = flush_every
+        # port index -> (day of the open log, open log, digest of the last IODD record)
+        self._logs: dict[int, tuple[str, BinaryIO, bytes]] = {}
+        self._unflushed = 0
+        os.makedirs(path, exist_ok=True)
+
+    def append(
+        self,
+        port_idx: int,
+        byte_values: list[int] | bytes,
+        iodd_hash: str,
+        timestamp: datetime = None,
+    ) -> None:
+        """Append a raw PDI frame of a port to the archive.
+
+        An IODD record is written before the frame whenever a new log is started or the
+        IODD of the port has changed.
+
+        :param port_idx: Index of the port the frame was read from
+        :param byte_values: Raw PDI Data Byte Array of the port
+        :param iodd_hash: Content hash of the IODD of the connected sensor
+        :param timestamp: UTC time the frame was read, defaults to now
+        """
+        timestamp = timestamp or datetime.utcnow()
+        timestamp_us = datetime_to_us(timestamp)
+        day = timestamp.strftime("%Y%m%d")
+        digest = bytes.fromhex(iodd_hash)
+        log_day, log, last_digest = self._logs.get(port_idx, (None, None, None))
+        if log_day != day:
+            if log is not None:
+                log.close()
+            port_dir = os.path.join(self.path, f"port{port_idx:0>2}")
+            os.makedirs(port_dir, exist_ok=True)
+            log = _open_log(os.path.join(port_dir, f"{day}.pdi"))
+            last_digest = None
+        if digest != last_digest:
+            log.write(RECORD_HEADER.pack(RECORD_IODD, timestamp_us, len(digest)))
+            log.write(digest)
+        frame = bytes(byte_values)
+        log.write(RECORD_HEADER.pack(RECORD_FRAME, timestamp_us, len(frame)))
+        log.write(frame)
+        self._logs[port_idx] = day, log, digest
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered frames of all ports to disk."""
+        for _, log, _ in self._logs.values():
+            log.flush()
+        self._unflushed = 0
+
+    def close(self) -> None:
+        """Flush and close all open logs."""
+        for _, log, _ in self._logs.values():
+            log.close()
+        self._logs = {}
+        self._unflushed = 0
+
+    def read(
+        self, port_idx: int, start: datetime, end: datetime
+    ) -> Iterator[tuple[datetime, str, bytes]]:
+        """Read the raw frames of a port in a time range, oldest first.
+
+        Only the logs of the days in the time range are opened.
+
+        :param port_idx: Index of the port
+        :param start: UTC start of the time range
+        :param end: UTC end of the time range
+        :return: Iterator of the timestamp, IODD content hash and raw bytes of every
+        frame
+        """
+        if port_idx in self._logs:
+            self._logs[port_idx][1].flush()
+        start_us, end_us = datetime_to_us(start), datetime_to_us(end)
+        port_dir = os.path.join(self.path, f"port{port_idx:0>2}")
+        day = start.date()
+        while day <= end.date():
+            log_path = os.path.join(port_dir, f"{day:%Y%m%d}.pdi")
+            day += timedelta(days=1)
+            if not os.path.exists(log_path):
+                continue
+            with open(log_path, "rb") as f:
+                data = f.read()
+            for kind, timestamp_us, iodd_hash, payload, _ in _iter_records(data):
+                if kind == RECORD_FRAME and start_us <= timestamp_us <= end_us:
+                    yield us_to_datetime(timestamp_us), iodd_hash, payload
+
+    def decode(
+        self,
+        port_idx: int,
+        start: datetime,
+        end: datetime,
+        iodd_collection: IODDCollection = None,
+        iodd: IODD = None,
+    ) -> list[tuple[datetime, dict[str, list[float]]]]:
+        """Decode the frames of a port in a time range.
+
+        The frames are decoded with the given IODD, e.g. a corrected version of the
+        IODD they were recorded with. Without one, every frame is decoded with the IODD
+        of the collection that has the recorded content hash. Frames whose IODD can't be
+        found are skipped.
+
+        :param port_idx: Index of the port
+        :param start: UTC start of the time range
+        :param end: UTC end of the time range
+        :param iodd_collection: Collection to look up the recorded IODDs in
+        :param iodd: IODD to decode all frames with
+        :return: List of timestamps and the real values of every information node
+        """
+        iodds = {}
+        if iodd_collection is not None:
+            iodds = {i.content_hash(): i for i in iodd_collection.iodds}
+        decoded = []
+        missing = set()
+        for timestamp, iodd_hash, frame in self.read(port_idx, start, end):
+            frame_iodd = iodd or iodds.get(iodd_hash)
+            if frame_iodd is None:
+                missing.add(iodd_hash)
+                continue
+            byte_values = list(frame)
+            inode: InformationNode
+            decoded.append(
+                (
+                    timestamp,
+                    {
+                        inode.name: inode.byte_to_real_value(byte_values)
+                        for inode in frame_iodd.information_nodes
+                    },
+                )
+            )
+        for iodd_hash in missing:
+            _logger.warning(
+                f"Skipped frames of port {port_idx}, no IODD with hash {iodd_hash}"
+            )
+        return decoded
+
+
+def _open_log(log_path: str) -> BinaryIO:
+    """Open a log for appending, truncating a torn record at its end.
+
+    Records appended after a torn record (e.g. after a power loss) would otherwise be
+    read as part of it.
+
+    :param log_path: Location of the log
+    :return: Log opened in append mode
+    """
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            data = f.read()
+        valid = 0
+        for *_, valid in _iter_records(data):
+            pass
+        if valid != len(data):
+            _logger.warning(
+                f"Truncating {len(data) - valid} bytes of a torn record in {log_path}"
+            )
+            os.truncate(log_path, valid)
+    return open(log_path, "ab")
+
+
+def _iter_records(data: bytes) -> Iterator[tuple[int, int, str | None, bytes, int]]:
+    """Iterate over the records of a log.
+
+    A truncated record at the end (e.g. after a power loss) is ignored.
+
+    :param data: Content of the log
+    :return: Iterator of the kind, timestamp, IODD content hash in effect, payload and
+    end offset of every record
+    """
+    view = memoryview(data)
+    offset = 0
+    iodd_hash = None
+    while offset + RECORD_HEADER.size <= len(view):
+        kind, timestamp_us, length = RECORD_HEADER.unpack_from(view, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(view):
+            break
+        payload = bytes(view[offset : offset + length])
+        offset += length
+        if kind == RECORD_IODD:
+            iodd_hash = payload.hex()
+        yield kind, timestamp_us, iodd_hash, payload, offset
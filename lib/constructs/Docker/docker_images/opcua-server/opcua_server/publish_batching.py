@@ -0,0 +1,312 @@
+"""Monitored item queues and size-bounded publishing for asyncua subscriptions.
+
+asyncua queues every data change of a monitored item until the next publish and treats
+a QueueSize of 0 as unlimited, so a node that changes several times within a
+publishing interval sends all intermediate values, and DiscardOldest is ignored. Every
+publish sends all queued notifications in one PublishResponse, however large it gets.
+
+After install():
+* Data change items get a revised QueueSize of 1 to max_queue_size (0 means 1, the
+  latest value only). A full queue discards its oldest value, or replaces its newest
+  one if DiscardOldest is false, and sets the Overflow bit of the value after the gap,
+  like OPC UA Part 4 describes for queues larger than 1.
+* A publish takes notifications in queue order until MaxNotificationsPerPublish of
+  the subscription or max_message_size bytes (estimated from the encoded size of the
+  values) are reached. The rest is sent right after it in further PublishResults with
+  MoreNotifications set, each with its own sequence number.
+Event items and the subscriptions of the server itself (history) keep the unlimited
+queues and single PublishResults of asyncua, so no value is lost for historizing.
+
+Classes
+-------
+QueueingMonitoredItemService
+    SharedMonitoredItemService that revises the queue of data change items.
+BatchingInternalSubscription
+    InternalSubscription with bounded queues and size-limited PublishResults.
+BatchingSubscriptionService
+    SubscriptionService that keeps the MaxNotificationsPerPublish of a subscription.
+
+Functions
+---------
+install
+    Makes asyncua servers use the classes of this module.
+"""
+from array import array
+from collections import deque
+import dataclasses
+
+from asyncua import ua
+from asyncua.server import internal_server, internal_subscription, subscription_service
+from asyncua.server.internal_subscription import InternalSubscription
+from asyncua.server.subscription_service import SubscriptionService
+from asyncua.ua.ua_binary import Primitives1, struct_to_binary, variant_to_binary
+
+from opcua_server.shared_monitoring import SharedMonitoredItemService
+
+MAX_QUEUE_SIZE = 1000
+MAX_MESSAGE_SIZE = 1024 * 1024
+# InfoType DataValue and Overflow bits of a StatusCode
+OVERFLOW_BITS = 0x0480
+# client handle, encoding mask, status code, timestamps and array length of a
+# MonitoredItemNotification, without the value
+NOTIFICATION_OVERHEAD = 40
+# response header, subscription id and the fixed fields of the NotificationMessage
+RESULT_OVERHEAD = 256
+
+_max_queue_size = MAX_QUEUE_SIZE
+_max_message_size = MAX_MESSAGE_SIZE
+
+
+def _with_overflow(notification: ua.MonitoredItemNotification):
+    """Return a copy of a notification with the Overflow bit set in its value."""
+    value = notification.Value
+    status = ua.StatusCode(value.StatusCode.value | OVERFLOW_BITS)
+    return dataclasses.replace(
+        notification, Value=dataclasses.replace(value, StatusCode_=status)
+    )
+
+
+def _notification_size(notification: ua.MonitoredItemNotification) -> int:
+    """Estimate the encoded size of a data change notification in bytes."""
+    variant = notification.Value.Value
+    value = variant.Value
+    primitive = getattr(Primitives1, variant.VariantType.name, None)
+    if isinstance(value, str):
+        size = len(value.encode("utf-8"))
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+    elif primitive is not None and isinstance(value, (list, tuple, array)):
+        size = len(value) * primitive.size
+    elif primitive is not None:
+        size = primitive.size
+    else:
+        size = len(variant_to_binary(variant))
+    return NOTIFICATION_OVERHEAD + size
+
+
+def _revise_queue_size(requested: int) -> int:
+    return min(max(requested, 1), _max_queue_size)
+
+
+class QueueingMonitoredItemService(SharedMonitoredItemService):
+    """SharedMonitoredItemService that revises the queue of data change items.
+
+    The DiscardOldest flag of a data change item is kept in its MonitoredItemData.
+    """
+
+    def _make_monitored_item_common(self, params: ua.MonitoredItemCreateRequest):
+        result, mdata = super()._make_monitored_item_common(params)
+        mdata.discard_oldest = params.RequestedParameters.DiscardOldest
+        if self._revises(
+            params.ItemToMonitor.AttributeId == ua.AttributeIds.EventNotifier
+        ):
+            mdata.queue_size = _revise_queue_size(mdata.queue_size)
+            result.RevisedQueueSize = mdata.queue_size
+        return result, mdata
+
+    def _revises(self, is_event: bool) -> bool:
+        # data change items of client subscriptions
+        return not is_event and not self.isub.no_acks
+
+    def _modify_monitored_item(self, params: ua.MonitoredItemModifyRequest):
+        result = super()._modify_monitored_item(params)
+        mdata = self._monitored_items.get(params.MonitoredItemId)
+        if mdata is not None and self._revises(
+            mdata.where_clause_evaluator is not None
+        ):
+            mdata.queue_size = _revise_queue_size(mdata.queue_size)
+            mdata.discard_oldest = params.RequestedParameters.DiscardOldest
+            result.RevisedQueueSize = mdata.queue_size
+            self.isub.resize_datachange_queue(
+                mdata.monitored_item_id, mdata.queue_size, mdata.discard_oldest
+            )
+        return result
+
+    async def enqueue_datachange(self, mid: int, value: ua.DataValue) -> None:
+        mdata = self._monitored_items.get(mid)
+        if mdata is None:
+            return
+        event = ua.MonitoredItemNotification(
+            ClientHandle=mdata.client_handle, Value=value
+        )
+        await self.isub.enqueue_datachange_event(
+            mid, event, mdata.queue_size, mdata.discard_oldest
+        )
+
+
+class BatchingInternalSubscription(InternalSubscription):
+    """InternalSubscription with bounded queues and size-limited PublishResults.
+
+    Attributes
+    ----------
+    max_notifications : int
+        MaxNotificationsPerPublish of the subscription, 0 for no limit
+
+    Methods
+    -------
+    enqueue_datachange_event:
+        Enqueues a data change, discarding a value if the queue is full
+    resize_datachange_queue:
+        Shortens the queue of a monitored item to a new size
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_notifications = 0
+        self._triggered_datachanges: dict[int, deque] = {}
+        # taken and remaining notifications and bytes of the PublishResult being built
+        self._notifications_taken = 0
+        self._notifications_left = 0
+        self._bytes_left = 0
+
+    async def enqueue_datachange_event(
+        self,
+        mid: int,
+        eventdata: ua.MonitoredItemNotification,
+        maxsize: int,
+        discard_oldest: bool = True,
+    ) -> None:
+        """Enqueue a data change, discarding a value if the queue is full.
+
+        :param mid: Monitored item id
+        :param eventdata: Monitored item notification
+        :param maxsize: Revised queue size, 0 for no limit
+        :param discard_oldest: Discard the oldest value of a full queue instead of
+        replacing the newest one, defaults to True
+        """
+        queue = self._triggered_datachanges.get(mid)
+        if queue is None:
+            self._triggered_datachanges[mid] = deque([eventdata])
+            await self._trigger_publish()
+            return
+        if not maxsize or len(queue) < maxsize:
+            queue.append(eventdata)
+        elif maxsize == 1:
+            queue[0] = eventdata
+        elif discard_oldest:
+            queue.popleft()
+            queue[0] = _with_overflow(queue[0])
+            queue.append(eventdata)
+        else:
+            queue[-1] = _with_overflow(eventdata)
+
+    def resize_datachange_queue(
+        self, mid: int, maxsize: int, discard_oldest: bool = True
+    ) -> None:
+        """Shorten the queue of a monitored item to a new size.
+
+        :param mid: Monitored item id
+        :param maxsize: New queue size
+        :param discard_oldest: Discard the oldest values instead of the newest ones,
+        defaults to True
+        """
+        queue = self._triggered_datachanges.get(mid)
+        while queue is not None and len(queue) > maxsize:
+            if discard_oldest:
+                queue.popleft()
+            else:
+                queue.pop()
+
+    def _has_pending_notifications(self) -> bool:
+        return bool(self._triggered_datachanges or self._triggered_events)
+
+    def _take(self, queues: dict, size) -> list:
+        """Remove notifications from the queues in order while the budget lasts."""
+        taken = []
+        for mid in list(queues):
+            queue = queues[mid]
+            while queue and self._notifications_left:
+                item_size = size(queue[0])
+                # a notification larger than the budget is sent alone
+                if self._notifications_taken and item_size > self._bytes_left:
+                    self._notifications_left = 0
+                    break
+                taken.append(queue.popleft())
+                self._notifications_taken += 1
+                self._notifications_left -= 1
+                self._bytes_left -= item_size
+            if queue:
+                break
+            del queues[mid]
+        return taken
+
+    def _pop_publish_result(self) -> ua.PublishResult:
+        self._notifications_taken = 0
+        # negative for no limit
+        self._notifications_left = self.max_notifications or -1
+        if self.no_acks:
+            self._bytes_left = float("inf")
+        else:
+            self._bytes_left = (
+                _max_message_size
+                - RESULT_OVERHEAD
+                - 4 * (len(self._not_acknowledged_results) + 1)
+            )
+        result = super()._pop_publish_result()
+        result.MoreNotifications = self._has_pending_notifications()
+        return result
+
+    def _pop_triggered_datachanges(self, result: ua.PublishResult) -> None:
+        if self._triggered_datachanges:
+            notif = ua.DataChangeNotification()
+            notif.MonitoredItems = self._take(
+                self._triggered_datachanges, _notification_size
+            )
+            if notif.MonitoredItems:
+                result.NotificationMessage.NotificationData.append(notif)
+
+    def _pop_triggered_events(self, result: ua.PublishResult) -> None:
+        if self._triggered_events and self._notifications_left:
+            events = {
+                mid: deque(queue) for mid, queue in self._triggered_events.items()
+            }
+            notif = ua.EventNotificationList()
+            notif.Events = self._take(
+                events, lambda event: len(struct_to_binary(event))
+            )
+            self._triggered_events = {mid: list(queue) for mid, queue in events.items()}
+            if notif.Events:
+                result.NotificationMessage.NotificationData.append(notif)
+
+    async def publish_results(self) -> None:
+        await super().publish_results()
+        # the notifications that didn't fit follow in further PublishResults
+        while self._has_pending_notifications():
+            await self.pub_result_callback(self._pop_publish_result())
+
+
+class BatchingSubscriptionService(SubscriptionService):
+    """SubscriptionService that keeps the MaxNotificationsPerPublish of a
+    subscription."""
+
+    async def create_subscription(self, params, callback=None, external=False):
+        result = await super().create_subscription(params, callback, external)
+        subscription = self.subscriptions[result.SubscriptionId]
+        subscription.max_notifications = params.MaxNotificationsPerPublish
+        return result
+
+    def modify_subscription(self, params, callback):
+        result = super().modify_subscription(params, callback)
+        subscription = self.subscriptions[params.SubscriptionId]
+        subscription.max_notifications = params.MaxNotificationsPerPublish
+        return result
+
+
+def install(
+    max_message_size: int = MAX_MESSAGE_SIZE, max_queue_size: int = MAX_QUEUE_SIZE
+) -> None:
+    """Make asyncua servers use the classes of this module.
+
+    Affects servers created after the call.
+
+    :param max_message_size: Size in bytes a PublishResult is kept below, defaults to
+    MAX_MESSAGE_SIZE
+    :param max_queue_size: Largest queue size of a data change item, defaults to
+    MAX_QUEUE_SIZE
+    """
+    global _max_message_size, _max_queue_size
+    _max_message_size = max_message_size
+    _max_queue_size = max_queue_size
+    internal_subscription.MonitoredItemService = QueueingMonitoredItemService
+    subscription_service.InternalSubscription = BatchingInternalSubscription
+    internal_server.SubscriptionService = BatchingSubscriptionService
@@ -0,0 +1,277 @@
+"""Shared data change monitoring of identical monitored items across subscriptions.
+
+asyncua registers a data change callback in the address space for every monitored
+item (MonitoredItemService._create_data_change_monitored_item), so when many HMI
+clients monitor the same Values nodes, every write calls one callback per client, each
+of which keeps its own copy of the last values and runs the deadband check again.
+
+After install(), the subscriptions use SharedMonitoredItemService. Data change items
+with the same node, attribute and filter share one SharedItem: one callback in the
+address space, one copy of the values and one deadband check per write, whose
+notification is fanned out to the queues of all subscribed items. The item of a
+subscription keeps its own id, client handle and queue size, and gets the current value
+when it is created, as before. Event items are not affected.
+
+Classes
+-------
+SharedItem
+    Data change callback and filter state shared by identical monitored items.
+SharedSampler
+    Shared items of an address space.
+SharedMonitoredItemService
+    MonitoredItemService whose data change items use shared items.
+
+Functions
+---------
+install
+    Makes asyncua subscriptions use SharedMonitoredItemService.
+"""
+from weakref import WeakKeyDictionary
+
+from asyncua import ua
+from asyncua.server import internal_subscription
+from asyncua.server.address_space import AddressSpace
+from asyncua.server.monitored_item_service import (
+    MonitoredItemService,
+    MonitoredItemValues,
+)
+from asyncua.ua.ua_binary import struct_to_binary
+
+
+class SharedItem:
+    """Data change callback and filter state shared by identical monitored items.
+
+    Attributes
+    ----------
+    key : tuple
+        Node id, attribute id and encoded filter of the items
+    handle : int
+        Handle of the data change callback in the address space
+    subscribers : dict
+        (service, monitored item id) of the subscribed items, in subscription order
+
+    Methods
+    -------
+    datachange_callback:
+        Runs the filter once and enqueues the notification for every subscribed item
+    """
+
+    def __init__(self, key: tuple, flt) -> None:
+        """Create SharedItem object.
+
+        :param key: Node id, attribute id and encoded filter of the items
+        :param flt: Filter of the items, None for no filter
+        """
+        self.key = key
+        self.filter = flt
+        self.handle = None
+        self.mvalue = MonitoredItemValues()
+        self.subscribers: dict[tuple[MonitoredItemService, int], None] = {}
+
+    async def datachange_callback(self, handle: int, value, error=None) -> None:
+        """Run the filter once and enqueue the notification for every subscribed item.
+
+        :param handle: Handle of the callback in the address space
+        :param value: New DataValue, None if there is an error
+        :param error: StatusCode if the node was deleted, defaults to None
+        """
+        subscribers = list(self.subscribers)
+        if error:
+            for service in dict.fromkeys(service for service, _ in subscribers):
+                await service.trigger_statuschange(error)
+            return
+        self.mvalue.set_current_value(value.Value.Value)
+        if self.filter and subscribers:
+            if not subscribers[0][0].deadband_callback(self.mvalue, self.filter):
+                return
+        for service, mid in subscribers:
+            await service.enqueue_datachange(mid, value)
+
+
+class SharedSampler:
+    """Shared items of an address space.
+
+    Methods
+    -------
+    for_aspace:
+        Returns the SharedSampler of an address space
+    subscribe:
+        Adds a monitored item to the shared item of its node, attribute and filter
+    unsubscribe:
+        Removes a monitored item from its shared item
+    """
+
+    _samplers: "WeakKeyDictionary[AddressSpace, SharedSampler]" = WeakKeyDictionary()
+
+    def __init__(self, aspace: AddressSpace) -> None:
+        """Create SharedSampler object.
+
+        :param aspace: Address space the shared items register their callbacks in
+        """
+        self.aspace = aspace
+        self._items: dict[tuple, SharedItem] = {}
+
+    @classmethod
+    def for_aspace(cls, aspace: AddressSpace) -> "SharedSampler":
+        """Return the SharedSampler of an address space, creating it if needed.
+
+        :param aspace: Address space of the server
+        """
+        sampler = cls._samplers.get(aspace)
+        if sampler is None:
+            sampler = cls._samplers[aspace] = cls(aspace)
+        return sampler
+
+    def subscribe(
+        self,
+        service: MonitoredItemService,
+        mid: int,
+        nodeid: ua.NodeId,
+        attr: ua.AttributeIds,
+        flt,
+    ) -> tuple[ua.StatusCode, SharedItem | None]:
+        """Add a monitored item to the shared item of its node, attribute and filter.
+
+        :param service: MonitoredItemService of the item
+        :param mid: Id of the monitored item
+        :param nodeid: Monitored node
+        :param attr: Monitored attribute
+        :param flt: Filter of the item, None for no filter
+        :return: Status of registering the callback and the shared item, None if the
+        status is bad
+        """
+        key = (nodeid, attr, None if flt is None else struct_to_binary(flt))
+        item = self._items.get(key)
+        if item is not None and not self._is_registered(item):
+            # the node was deleted, and maybe added again with the same node id
+            del self._items[key]
+            item = None
+        if item is None:
+            item = SharedItem(key, flt)
+            status, item.handle = self.aspace.add_datachange_callback(
+                nodeid, attr, item.datachange_callback
+            )
+            if not status.is_good():
+                return status, None
+            # the deadband compares the first write with the value at creation
+            value = self.aspace.read_attribute_value(nodeid, attr)
+            item.mvalue.set_current_value(value.Value.Value)
+            self._items[key] = item
+        item.subscribers[(service, mid)] = None
+        return ua.StatusCode(), item
+
+    def _is_registered(self, item: SharedItem) -> bool:
+        """Return if the callback of a shared item is still registered at its node.
+
+        Deleting a node drops its callbacks. AddressSpace calls them with an error
+        status without awaiting them, so SharedItem.datachange_callback doesn't run.
+        """
+        nodeid, attr, _ = item.key
+        node = self.aspace.get(nodeid)
+        if node is None or attr not in node.attributes:
+            return False
+        return item.handle in node.attributes[attr].datachange_callbacks
+
+    def unsubscribe(self, item: SharedItem, service: MonitoredItemService, mid: int):
+        """Remove a monitored item from its shared item.
+
+        The callback of the shared item is deleted with its last item.
+
+        :param item: Shared item the monitored item is subscribed to
+        :param service: MonitoredItemService of the item
+        :param mid: Id of the monitored item
+        """
+        item.subscribers.pop((service, mid), None)
+        if not item.subscribers and self._items.get(item.key) is item:
+            del self._items[item.key]
+            self.aspace.delete_datachange_callback(item.handle)
+
+
+class SharedMonitoredItemService(MonitoredItemService):
+    """MonitoredItemService whose data change items use shared items.
+
+    Methods
+    -------
+    enqueue_datachange:
+        Enqueues a data change notification for a monitored item
+    """
+
+    def __init__(self, isub, aspace: AddressSpace) -> None:
+        super().__init__(isub, aspace)
+        self._sampler = SharedSampler.for_aspace(aspace)
+        self._shared: dict[int, SharedItem] = {}
+
+    async def _create_data_change_monitored_item(
+        self, params: ua.MonitoredItemCreateRequest
+    ):
+        self.logger.info(
+            "request to subscribe to datachange for node %s and attribute %s",
+            params.ItemToMonitor.NodeId,
+            params.ItemToMonitor.AttributeId,
+        )
+        result, mdata = self._make_monitored_item_common(params)
+        result.FilterResult = params.RequestedParameters.Filter
+        result.StatusCode, item = self._sampler.subscribe(
+            self,
+            result.MonitoredItemId,
+            params.ItemToMonitor.NodeId,
+            params.ItemToMonitor.AttributeId,
+            mdata.filter,
+        )
+        self._commit_monitored_item(result, mdata)
+        if item is not None:
+            mdata.callback_handle = item.handle
+            self._shared[result.MonitoredItemId] = item
+            # the initial value goes to the new item only
+            value = self.aspace.read_attribute_value(
+                params.ItemToMonitor.NodeId, params.ItemToMonitor.AttributeId
+            )
+            await self.enqueue_datachange(result.MonitoredItemId, value)
+        return result
+
+    def _modify_monitored_item(self, params: ua.MonitoredItemModifyRequest):
+        item = self._shared.get(params.MonitoredItemId)
+        result = super()._modify_monitored_item(params)
+        mdata = self._monitored_items.get(params.MonitoredItemId)
+        if item is not None and mdata.filter is not item.filter:
+            # move the item to the shared item of its new filter
+            nodeid, attr, _ = item.key
+            _, new_item = self._sampler.subscribe(
+                self, params.MonitoredItemId, nodeid, attr, mdata.filter
+            )
+            if new_item is not item:
+                self._sampler.unsubscribe(item, self, params.MonitoredItemId)
+            if new_item is None:
+                del self._shared[params.MonitoredItemId]
+            else:
+                self._shared[params.MonitoredItemId] = new_item
+                mdata.callback_handle = new_item.handle
+        return result
+
+    def _delete_monitored_items(self, mid: int):
+        item = self._shared.pop(mid, None)
+        if item is not None:
+            self._sampler.unsubscribe(item, self, mid)
+        return super()._delete_monitored_items(mid)
+
+    async def enqueue_datachange(self, mid: int, value: ua.DataValue) -> None:
+        """Enqueue a data change notification for a monitored item.
+
+        :param mid: Id of the monitored item
+        :param value: DataValue to notify
+        """
+        mdata = self._monitored_items.get(mid)
+        if mdata is None:
+            return
+        event = ua.MonitoredItemNotification(
+            ClientHandle=mdata.client_handle, Value=value
+        )
+        await self.isub.enqueue_datachange_event(mid, event, mdata.queue_size)
+
+
+def install() -> None:
+    """Make asyncua subscriptions use SharedMonitoredItemService.
+
+    Affects subscriptions created after the call.
+    """
+    internal_subscription.MonitoredItemService = SharedMonitoredItemService
@@ -0,0 +1,487 @@
+"""Pre-generated binary encoders and decoders of the standard OPC UA structures.
+
+asyncua encodes and decodes the structures of uaprotocol_auto and uaprotocol_hand (all
+requests, responses and the structures in them) with closures that
+create_dataclass_serializer and _create_dataclass_deserializer build from
+dataclasses.fields and typing.get_type_hints on the first use of a type, in every new
+process. The closures loop over the fields
+and look up the serializer of every field for every message.
+
+generate_source() emits a module with one flat function per structure and direction
+instead. The fields are encoded and decoded by a fixed sequence of calls, and runs of
+consecutive fixed-size fields (integers, floats, booleans and enumerations) are packed
+and unpacked with a single precompiled struct.Struct. Like the address space snapshot,
+the module is written when the Docker image is built (python -m
+opcua_server.static_codec). install() makes asyncua use its functions and generates
+them in memory if the module is missing or was generated for another asyncua version.
+
+Unions, structures that are not in the ua namespace and the types defined at runtime
+(e.g. by load_data_type_definitions) keep the asyncua closures.
+
+Functions
+---------
+generate_source
+    Returns the source of a module with the encoders and decoders of the structures.
+write_module
+    Writes the generated module to a file.
+install
+    Makes asyncua use the generated encoders and decoders.
+"""
+import argparse
+from dataclasses import fields, is_dataclass
+from enum import Enum, IntFlag
+import functools
+import importlib
+import logging
+import os
+import py_compile
+import types
+import typing
+
+import asyncua
+from asyncua import ua
+from asyncua.ua import ua_binary, uaprotocol_auto, uaprotocol_hand
+from asyncua.ua.ua_binary import Primitives, Primitives1
+from asyncua.ua.uatypes import (
+    type_allow_subclass,
+    type_from_list,
+    type_is_list,
+    type_is_union,
+    types_from_union,
+)
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+GENERATED_MODULE = "opcua_server.ua_codec_generated"
+GENERATED_PATH = os.path.join(os.path.dirname(__file__), "ua_codec_generated.py")
+
+_original_serializer = ua_binary.create_dataclass_serializer
+_original_deserializer = ua_binary._create_dataclass_deserializer
+
+_HEADER = '''"""Encoders and decoders of the OPC UA structures.
+
+Generated by opcua_server.static_codec for asyncua {version}, do not edit.
+"""
+import struct
+
+from asyncua import ua
+from asyncua.ua import ua_binary as _b, uaprotocol_auto as _auto
+from asyncua.ua.ua_binary import Primitives as _P, Primitives1 as _P1
+
+ASYNCUA_VERSION = "{version}"
+_VT = ua.VariantType
+_INT32 = struct.Struct("<i")
+{structs}
+
+
+def _encode_list(encode, values):
+    if values is None:
+        return b"\\xff\\xff\\xff\\xff"
+    return _INT32.pack(len(values)) + b"".join([encode(value) for value in values])
+
+
+def _decode_list(decode, data):
+    return [decode(data) for _ in range(_INT32.unpack(data.read(4))[0])]
+'''
+
+
+class _Unsupported(Exception):
+    """Raised for types whose encoding the generator can't express."""
+
+
+class _Generator:
+    """Generates the encoder and decoder functions of structures.
+
+    The field types are resolved in the same order as create_type_serializer and
+    _create_type_deserializer of asyncua do, so the generated functions produce and
+    accept the same bytes.
+    """
+
+    def __init__(self, unsupported: set) -> None:
+        self.unsupported = set(unsupported)
+        # structure: (name of the encoder, name of the decoder, name of the type)
+        self.names: dict[type, tuple[str, str, str]] = {}
+        self.structs: dict[str, str] = {}
+        # key: (name, source with a {name} placeholder)
+        self.helpers: dict[str, tuple[str, str]] = {}
+        self.functions: list[str] = []
+
+    def generate(self, cls: type) -> tuple[str, str, str]:
+        """Generate the encoder and decoder of a structure.
+
+        :param cls: Dataclass of the structure
+        :return: Names of the encoder, the decoder and the type in the module
+        :raises _Unsupported: If the structure or one of its fields can't be generated
+        """
+        if cls in self.names:
+            return self.names[cls]
+        if (
+            cls in self.unsupported
+            or not is_dataclass(cls)
+            or issubclass(cls, ua.UaUnion)
+        ):
+            raise _Unsupported(cls)
+        reference = _reference(cls)
+        suffix = reference.replace("ua.", "").replace(".", "_").lstrip("_")
+        names = self.names[cls] = (f"_e_{suffix}", f"_d_{suffix}", reference)
+        try:
+            hints = typing.get_type_hints(cls, {"ua": ua})
+            members = [(f.name, hints[f.name]) for f in fields(cls)]
+            encoder = self._encoder_source(names[0], members)
+            decoder = self._decoder_source(names[1], reference, members)
+        except Exception:
+            del self.names[cls]
+            self.unsupported.add(cls)
+            raise _Unsupported(cls)
+        self.functions += [encoder, decoder]
+        return names
+
+    def _struct(self, fmt: str) -> str:
+        if fmt not in self.structs:
+            self.structs[fmt] = f"_S{len(self.structs)}"
+        return self.structs[fmt]
+
+    def _helper(self, key: str, source: str) -> str:
+        if key not in self.helpers:
+            self.helpers[key] = (f"_h{len(self.helpers)}", source)
+        return self.helpers[key][0]
+
+    def _encoder(self, uatype) -> tuple[str, str]:
+        """Return the encoding function of a type and its struct format character if
+        it has a fixed size (create_type_serializer)."""
+        if type_allow_subclass(uatype):
+            return "_b.extensionobject_to_binary", None
+        if type_is_list(uatype):
+            return self._list_encoder(type_from_list(uatype)), None
+        name = uatype.__name__
+        if hasattr(Primitives1, name):
+            return f"_P.{name}.pack", getattr(Primitives1, name).format[1:]
+        if hasattr(Primitives, name):
+            return f"_P.{name}.pack", None
+        if issubclass(uatype, Enum):
+            primitive = _enum_primitive(uatype)
+            return f"_P.{primitive}.pack", getattr(Primitives1, primitive).format[1:]
+        if hasattr(ua.VariantType, name):
+            vtype = getattr(ua.VariantType, name)
+            if vtype.value > 25:
+                return "_P.Bytes.pack", None
+            if vtype == ua.VariantType.ExtensionObject:
+                return "_b.extensionobject_to_binary", None
+            if vtype in (ua.VariantType.NodeId, ua.VariantType.ExpandedNodeId):
+                return "_b.nodeid_to_binary", None
+            if vtype == ua.VariantType.Variant:
+                return "_b.variant_to_binary", None
+            try:
+                return self.generate(getattr(ua, vtype.name))[0], None
+            except _Unsupported:
+                return "_b.struct_to_binary", None
+        if issubclass(uatype, ua.NodeId):
+            return "_b.nodeid_to_binary", None
+        if issubclass(uatype, ua.Variant):
+            return "_b.variant_to_binary", None
+        return self.generate(uatype)[0], None
+
+    def _list_encoder(self, uatype) -> str:
+        """Return the encoding function of a list (create_list_serializer)."""
+        if hasattr(Primitives1, uatype.__name__):
+            return f"_P1.{uatype.__name__}.pack_array"
+        encode, _ = self._encoder(uatype)
+        # the element encoder is looked up on every call, so that replacing an
+        # asyncua function (e.g. by array_codec) also affects the lists
+        return self._helper(
+            f"encode list {encode}",
+            "def {name}(values):\n" f"    return _encode_list({encode}, values)\n",
+        )
+
+    def _decoder(self, uatype) -> tuple[str, str, str]:
+        """Return the decoding function of a type, its struct format character if it
+        has a fixed size and the type to convert the unpacked value to
+        (_create_type_deserializer)."""
+        if type_is_union(uatype):
+            return self._decoder(types_from_union(uatype)[0])
+        if type_is_list(uatype):
+            element = type_from_list(uatype)
+            if hasattr(ua.VariantType, element.__name__):
+                return (
+                    f"_b._create_uatype_array_deserializer(_VT.{element.__name__})",
+                    None,
+                    None,
+                )
+            decode, _, _ = self._decoder(element)
+            return (
+                self._helper(
+                    f"decode list {decode}",
+                    "def {name}(data):\n" f"    return _decode_list({decode}, data)\n",
+                ),
+                None,
+                None,
+            )
+        name = uatype.__name__
+        if hasattr(ua.VariantType, name):
+            vtype = getattr(ua.VariantType, name)
+            if hasattr(Primitives1, name):
+                return f"_P.{name}.unpack", getattr(Primitives1, name).format[1:], None
+            if hasattr(Primitives, name):
+                return f"_P.{name}.unpack", None, None
+            if vtype.value > 25:
+                return "_P.Bytes.unpack", None, None
+            if vtype == ua.VariantType.ExtensionObject:
+                return "_b.extensionobject_from_binary", None, None
+            if vtype in (ua.VariantType.NodeId, ua.VariantType.ExpandedNodeId):
+                return "_b.nodeid_from_binary", None, None
+            if vtype == ua.VariantType.Variant:
+                return "_b.variant_from_binary", None, None
+            uatype = getattr(ua, vtype.name)
+        elif hasattr(Primitives1, name):
+            return f"_P.{name}.unpack", getattr(Primitives1, name).format[1:], None
+        elif hasattr(Primitives, name):
+            return f"_P.{name}.unpack", None, None
+        if issubclass(uatype, Enum):
+            primitive = _enum_primitive(uatype)
+            enum = _reference(uatype)
+            decode = self._helper(
+                f"decode {enum}",
+                "def {name}(data):\n"
+                f"    return {enum}(_P.{primitive}.unpack(data))\n",
+            )
+            return decode, getattr(Primitives1, primitive).format[1:], enum
+        try:
+            return self.generate(uatype)[1], None, None
+        except _Unsupported:
+            if not hasattr(ua.VariantType, name):
+                raise
+            return f"_b._create_dataclass_deserializer(ua.{name})", None, None
+
+    def _encoder_source(self, name: str, members: list) -> str:
+        """Return the source of the encoder of a structure
+        (create_dataclass_serializer)."""
+        optional = [field for field, ftype in members if type_is_union(ftype)]
+        encoding = (
+            " | ".join(
+                f"({1 << bit} if o.{field} is not None else 0)"
+                for bit, field in enumerate(optional)
+            )
+            or "0"
+        )
+        parts = []
+        run: list[tuple[str, str]] = []
+
+        def flush():
+            if run:
+                fmt = "<" + "".join(char for char, _ in run)
+                values = ", ".join(value for _, value in run)
+                parts.append(f"{self._struct(fmt)}.pack({values})")
+                run.clear()
+
+        for field, ftype in members:
+            uatype = types_from_union(ftype)[0] if type_is_union(ftype) else ftype
+            encode, char = self._encoder(uatype)
+            if field == "Encoding":
+                value = encoding
+            else:
+                value = f"o.{field}"
+            if field in optional:
+                flush()
+                parts.append(f'b"" if {value} is None else {encode}({value})')
+            elif char is not None:
+                run.append((char, value))
+            else:
+                flush()
+                parts.append(f"{encode}({value})")
+        flush()
+        if not parts:
+            body = '    return b""\n'
+        elif len(parts) == 1:
+            body = f"    return {parts[0]}\n"
+        else:
+            body = (
+                '    return b"".join((\n'
+                + "".join(f"        {part},\n" for part in parts)
+                + "    ))\n"
+            )
+        return f"def {name}(o):\n{body}"
+
+    def _decoder_source(self, name: str, reference: str, members: list) -> str:
+        """Return the source of the decoder of a structure
+        (_create_dataclass_deserializer)."""
+        lines = []
+        arguments = []
+        run: list[tuple[str, str]] = []
+        has_optional = any(type_is_union(ftype) for _, ftype in members)
+        if has_optional:
+            lines.append("enc = 0")
+            lines.append("kw = {}")
+
+        def assign(field, value):
+            if field == "Encoding":
+                lines.append(f"enc = {value}")
+            elif has_optional:
+                lines.append(f'kw["{field}"] = {value}')
+            else:
+                arguments.append(f"{field}={value}")
+
+        def flush():
+            if run:
+                fmt = "<" + "".join(char for _, char, _ in run)
+                struct_name = self._struct(fmt)
+                variables = [f"v{len(lines)}_{i}" for i in range(len(run))]
+                size = f"{struct_name}.size"
+                lines.append(
+                    f"{', '.join(variables)}, = {struct_name}.unpack(d.read({size}))"
+                )
+                for variable, (field, _, convert) in zip(variables, run):
+                    assign(field, f"{convert}({variable})" if convert else variable)
+                run.clear()
+
+        bit = 0
+        for field, ftype in members:
+            if type_allow_subclass(ftype):
+                decode, char, convert = "_b.extensionobject_from_binary", None, None
+            else:
+                decode, char, convert = self._decoder(ftype)
+            if type_is_union(ftype):
+                flush()
+                lines.append(f"if enc & {1 << bit}:")
+                lines.append(f'    kw["{field}"] = {decode}(d)')
+                bit += 1
+            elif char is not None:
+                run.append((field, char, convert))
+            else:
+                flush()
+                if field == "Encoding" or has_optional:
+                    assign(field, f"{decode}(d)")
+                else:
+                    variable = f"v{len(lines)}"
+                    lines.append(f"{variable} = {decode}(d)")
+                    assign(field, variable)
+        flush()
+        if has_optional:
+            lines.append(f"return {reference}(**kw)")
+        else:
+            lines.append(f"return {reference}({', '.join(arguments)})")
+        return f"def {name}(d):\n" + "".join(f"    {line}\n" for line in lines)
+
+
+def _reference(uatype: type) -> str:
+    """Return the expression referring to a type in the generated module."""
+    if getattr(ua, uatype.__name__, None) is uatype:
+        return f"ua.{uatype.__name__}"
+    # shadowed by a type of uaprotocol_hand
+    if getattr(uaprotocol_auto, uatype.__name__, None) is uatype:
+        return f"_auto.{uatype.__name__}"
+    raise _Unsupported(uatype)
+
+
+def _enum_primitive(uatype: type) -> str:
+    """Return the name of the primitive an enumeration is encoded as
+    (create_enum_serializer)."""
+    name = "Int32"
+    if issubclass(uatype, IntFlag):
+        name = uatype.datatype() if hasattr(uatype, "datatype") else "UInt32"
+    if not hasattr(Primitives1, name):
+        raise _Unsupported(uatype)
+    return name
+
+
+def generate_source() -> str:
+    """Return the source of a module with the encoders and decoders of the structures.
+
+    The module has one encoder and one decoder function for every structure of
+    uaprotocol_auto and uaprotocol_hand and the structures of uatypes they contain,
+    and the dictionaries ENCODERS and DECODERS mapping the structures to them.
+
+    :return: Python source of the module
+    """
+    roots = [
+        cls
+        for module in (uaprotocol_auto, uaprotocol_hand)
+        for cls in vars(module).values()
+        if isinstance(cls, type)
+        and is_dataclass(cls)
+        and cls.__module__ == module.__name__
+    ]
+    unsupported: set = set()
+    while True:
+        # structures that fail make the structures containing them fail as well, so
+        # repeat until every referenced function is generated
+        generator = _Generator(unsupported)
+        for cls in roots:
+            try:
+                generator.generate(cls)
+            except _Unsupported:
+                pass
+        if generator.unsupported == unsupported:
+            break
+        unsupported = generator.unsupported
+    structs = "\n".join(
+        f'{name} = struct.Struct("{fmt}")' for fmt, name in generator.structs.items()
+    )
+    sections = [_HEADER.format(version=asyncua.__version__, structs=structs)]
+    sections += [
+        source.format(name=name) for name, source in generator.helpers.values()
+    ]
+    sections += generator.functions
+    for mapping, index in (("ENCODERS", 0), ("DECODERS", 1)):
+        entries = "".join(
+            f"    {names[2]}: {names[index]},\n" for names in generator.names.values()
+        )
+        sections.append(f"{mapping} = {{\n{entries}}}\n")
+    return "\n\n".join(sections)
+
+
+def write_module(path: str = GENERATED_PATH) -> None:
+    """Write the generated module to a file and compile it.
+
+    :param path: Location of the module, defaults to GENERATED_PATH
+    """
+    with open(f"{path}.tmp", "w") as f:
+        f.write(generate_source())
+    os.replace(f"{path}.tmp", path)
+    py_compile.compile(path, doraise=True)
+
+
+def install(module: str = GENERATED_MODULE) -> None:
+    """Make asyncua use the generated encoders and decoders.
+
+    :param module: Name of the generated module, defaults to GENERATED_MODULE
+    """
+    try:
+        generated = importlib.import_module(module)
+    except ImportError:
+        generated = None
+    if getattr(generated, "ASYNCUA_VERSION", None) != asyncua.__version__:
+        _logger.info(f"{module} is missing or outdated, generating the codec in memory")
+        generated = types.ModuleType(module)
+        exec(compile(generate_source(), module, "exec"), vars(generated))
+    encoders, decoders = generated.ENCODERS, generated.DECODERS
+
+    @functools.lru_cache(maxsize=None)
+    def create_dataclass_serializer(dataclazz):
+        encoder = encoders.get(dataclazz)
+        return encoder if encoder is not None else _original_serializer(dataclazz)
+
+    @functools.lru_cache(maxsize=None)
+    def _create_dataclass_deserializer(objtype):
+        if isinstance(objtype, str):
+            objtype = getattr(ua, objtype)
+        decoder = decoders.get(objtype)
+        return decoder if decoder is not None else _original_deserializer(objtype)
+
+    ua_binary.create_dataclass_serializer = create_dataclass_serializer
+    ua_binary._create_dataclass_deserializer = _create_dataclass_deserializer
+    for value in list(vars(ua_binary).values()):
+        if hasattr(value, "cache_clear"):
+            value.cache_clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate the encoders and decoders of the OPC UA structures"
+    )
+    parser.add_argument(
+        "path",
+        nargs="?",
+        default=GENERATED_PATH,
+        help="Location of the generated module, defaults to the opcua_server package",
+    )
+    write_module(parser.parse_args().path)
@@ -0,0 +1,230 @@
+"""Pre-validated writes to the value of a variable node.
+
+Node.write_value() on the server builds a WriteValue and WriteParameters, dispatches
+the PreWrite/PostWrite server callbacks, checks the user and the node id, guesses the
+variant type of the value from its Python type and lets
+AddressSpace.write_attribute_value() look up the node and compare the variant type with
+the type of the current value, on every write. The bridge writes the same float arrays
+to the same Values nodes many times per second.
+
+A WriteHandle looks up the node and its variant type once. A write only checks the
+Python type of the (first element of the) value, which gives the same variant type
+asyncua would guess, swaps the DataValue in and calls the data change callbacks if the
+value changed, as write_attribute_value() does. An array.array whose typecode matches
+the variant type is written as it is, other array.array and NumPy values are converted
+to lists first. The server callbacks are not dispatched, the NNE MI server registers
+none.
+
+python -m opcua_server.write_handle --benchmark compares the writes per second of
+Node.write_value() and WriteHandle.write().
+
+Classes
+-------
+WriteHandle
+    Writer of the Value attribute of one variable node.
+
+Functions
+---------
+benchmark
+    Measures writing a float array with Node.write_value() and a WriteHandle.
+"""
+import argparse
+from array import array
+import asyncio
+from datetime import datetime
+import logging
+import time
+
+from asyncua import Server, ua
+
+from opcua_server.array_codec import NUMERIC_TYPES, to_list
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+# variant types asyncua guesses for Python types (Variant._guess_type)
+GUESSED_TYPES = {
+    bool: ua.VariantType.Boolean,
+    int: ua.VariantType.Int64,
+    float: ua.VariantType.Double,
+    str: ua.VariantType.String,
+    bytes: ua.VariantType.ByteString,
+    datetime: ua.VariantType.DateTime,
+}
+# variant types of the array.array typecodes
+ARRAY_TYPES = {
+    typecode: getattr(ua.VariantType, name)
+    for name, (_, typecode, _) in NUMERIC_TYPES.items()
+}
+
+
+def _variant_type(node, attval) -> ua.VariantType | None:
+    """Return the variant type writes must have, like _is_expected_variant_type()."""
+    vtype = attval.value.Value.VariantType
+    if vtype != ua.VariantType.Null:
+        return vtype
+    dtype = node.attributes[ua.AttributeIds.DataType].value.Value.Value
+    if dtype.NamespaceIndex == 0 and dtype.Identifier <= 25:
+        return ua.VariantType(dtype.Identifier)
+    # asyncua trusts the first write
+    return None
+
+
+class WriteHandle:
+    """Writer of the Value attribute of one variable node.
+
+    The handle becomes invalid if the node is deleted, a node added again with the same
+    node id needs a new handle.
+
+    Attributes
+    ----------
+    server : Server
+        Server the node belongs to
+    nodeid : ua.NodeId
+        Node id of the variable
+    variant_type : ua.VariantType
+        Variant type of the written values, None until the first write if the node has
+        no value and no built-in data type
+
+    Methods
+    -------
+    is_valid:
+        Returns if the node of the handle is still in the address space
+    write:
+        Writes a value to the node
+    """
+
+    def __init__(self, server: Server, nodeid: ua.NodeId | str) -> None:
+        """Create WriteHandle object.
+
+        :param server: Server the node belongs to
+        :param nodeid: Node id of the variable, e.g. "ns=6;i=1234"
+        :raises ua.uaerrors.BadNodeIdUnknown: If the node doesn't exist
+        :raises ua.uaerrors.BadAttributeIdInvalid: If the node is no variable
+        """
+        self.server = server
+        self.nodeid = (
+            ua.NodeId.from_string(nodeid) if isinstance(nodeid, str) else nodeid
+        )
+        self._aspace = server.iserver.aspace
+        self._node = self._aspace.get(self.nodeid)
+        if self._node is None:
+            raise ua.uaerrors.BadNodeIdUnknown()
+        self._attval = self._node.attributes.get(ua.AttributeIds.Value)
+        if self._attval is None:
+            raise ua.uaerrors.BadAttributeIdInvalid()
+        self.variant_type = _variant_type(self._node, self._attval)
+
+    def is_valid(self) -> bool:
+        """Return if the node of the handle is still in the address space."""
+        return self._aspace.get(self.nodeid) is self._node
+
+    def _variant(self, value) -> ua.Variant:
+        if isinstance(value, ua.Variant):
+            variant = value
+        elif (
+            isinstance(value, array)
+            and ARRAY_TYPES.get(value.typecode) == self.variant_type
+        ):
+            variant = ua.Variant(value, self.variant_type, None, True)
+        else:
+            # NumPy values can't be compared with the current value
+            value = to_list(value)
+            sample, is_array = value, False
+            while isinstance(sample, (list, tuple)) and sample:
+                sample, is_array = sample[0], True
+            vtype = GUESSED_TYPES.get(type(sample))
+            if vtype is None or vtype != self.variant_type:
+                # let asyncua guess unusual or mismatching values
+                variant = ua.Variant(value)
+            else:
+                variant = ua.Variant(value, vtype, None, is_array)
+        if self.variant_type is None:
+            self.variant_type = variant.VariantType
+        elif variant.VariantType != self.variant_type:
+            _logger.critical(
+                "Write refused: Variant: %s with type %s does not have expected type: %s",
+                variant,
+                variant.VariantType,
+                self.variant_type,
+            )
+            raise ua.uaerrors.BadTypeMismatch()
+        return variant
+
+    async def write(self, value, source_timestamp: datetime = None) -> None:
+        """Write a value to the node.
+
+        :param value: Python value, array.array, NumPy array or ua.Variant of the
+        variant type of the node
+        :param source_timestamp: Source timestamp of the value, defaults to now
+        :raises ua.uaerrors.BadTypeMismatch: If the value has another variant type
+        """
+        datavalue = ua.DataValue(
+            self._variant(value),
+            SourceTimestamp=source_timestamp or datetime.utcnow(),
+        )
+        attval = self._attval
+        old = attval.value
+        attval.value = datavalue
+        callbacks = attval.datachange_callbacks
+        if not callbacks or old.Value == datavalue.Value:
+            return
+        for handle, callback in list(callbacks.items()):
+            try:
+                await callback(handle, datavalue)
+            except Exception as ex:
+                _logger.exception(
+                    "Error calling datachange callback %s, %s, %s", handle, callback, ex
+                )
+
+
+class _Handler:
+    def datachange_notification(self, node, val, data) -> None:
+        pass
+
+
+async def benchmark(writes: int = 20000, size: int = 64) -> dict[str, float]:
+    """Measure writing a float array with Node.write_value() and a WriteHandle.
+
+    The variable is monitored by one subscription, like a historized Values node.
+
+    :param writes: Number of writes per variant, defaults to 20000
+    :param size: Number of floats in the array, defaults to 64
+    :return: Writes per second per variant
+    """
+    server = Server()
+    await server.init()
+    idx = await server.register_namespace("urn:nne:benchmark")
+    node = await server.nodes.objects.add_variable(idx, "Values", [0.0] * size)
+    subscription = await server.create_subscription(100, _Handler())
+    await subscription.subscribe_data_change(node)
+    handle = WriteHandle(server, node.nodeid)
+    values = [[float(i + j) for j in range(size)] for i in range(2)]
+    results = {}
+    for name, write in (
+        ("write_value", node.write_value),
+        ("WriteHandle", handle.write),
+    ):
+        start = time.perf_counter()
+        for i in range(writes):
+            await write(values[i % 2])
+        results[name] = writes / (time.perf_counter() - start)
+        _logger.info("%s: %.0f writes/s", name, results[name])
+    await subscription.delete()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-validated node writes")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare the writes per second of Node.write_value() and WriteHandle",
+    )
+    parser.add_argument(
+        "--size", type=int, default=64, help="Number of floats per write"
+    )
+    args = parser.parse_args()
+    if args.benchmark:
+        logging.basicConfig(level=logging.WARNING)
+        _logger.setLevel(logging.INFO)
+        asyncio.run(benchmark(size=args.size))
@@ -0,0 +1,217 @@
+"""Receive path of the OPC UA TCP transports without repeated copies.
+
+The asyncua transports append every received chunk of data to the bytes of the
+incomplete message (OPCUAProtocol: self._buffer += data, UASocketProtocol:
+receive_buffer + data) and slice the rest off after every message, so a large message
+(history reads, browse results, big arrays) that arrives in many chunks is copied
+again with every chunk, in quadratic time.
+
+The protocols below are asyncio.BufferedProtocol subclasses of the asyncua ones. The
+socket is read directly into a growable bytearray (FrameBuffer), messages are framed
+with struct.unpack_from on it, and every complete message is copied once into the
+bytes object the decoder gets. The buffer doubles in size when a message doesn't fit,
+so a large message is received with a linear number of copies. It grows with the
+bytes actually received, not with the size announced in a message header: asyncua
+doesn't limit the message size, so a peer could make the server allocate gigabytes
+before it is authenticated. Headers announcing more than max_message_size bytes close
+the connection.
+
+install() makes asyncua create them for every server connection and every client
+(asyncua has no factory argument for the protocols, so the module globals are
+replaced).
+
+Classes
+-------
+FrameBuffer
+    Growable receive buffer that splits the stream into OPC UA TCP messages.
+ZeroCopyOPCUAProtocol
+    Server connection protocol reading into a FrameBuffer.
+ZeroCopyUASocketProtocol
+    Client protocol reading into a FrameBuffer.
+
+Functions
+---------
+install
+    Makes asyncua use the protocols of this module.
+"""
+import asyncio
+import logging
+import struct
+
+from asyncua.client import ua_client
+from asyncua.client.ua_client import UASocketProtocol
+from asyncua.common.utils import Buffer
+from asyncua.server import binary_server_asyncio
+from asyncua.server.binary_server_asyncio import OPCUAProtocol
+from asyncua.ua.ua_binary import header_from_binary
+
+_logger = logging.getLogger("NNE-OPC-UA Server")
+
+# message type, chunk type and size of the OPC UA TCP message header
+MESSAGE_HEADER = struct.Struct("<3scI")
+MIN_READ_SIZE = 64 * 1024
+# largest accepted message (chunk), far above any message of the NNE MI server
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class FrameBuffer:
+    """Growable receive buffer that splits the stream into OPC UA TCP messages.
+
+    Attributes
+    ----------
+    max_message_size : int
+        Largest accepted message in bytes, including its header
+
+    Methods
+    -------
+    get_buffer:
+        Returns the free space to receive into
+    buffer_updated:
+        Marks received bytes as used
+    take_frames:
+        Returns the complete messages and removes them from the buffer
+    """
+
+    def __init__(
+        self, size: int = MIN_READ_SIZE, max_message_size: int = MAX_MESSAGE_SIZE
+    ) -> None:
+        """Create FrameBuffer object.
+
+        :param size: Initial size of the buffer in bytes, defaults to MIN_READ_SIZE
+        :param max_message_size: Largest accepted message in bytes, defaults to
+        MAX_MESSAGE_SIZE
+        """
+        self.max_message_size = max_message_size
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        """Return the free space to receive into.
+
+        If less than half of MIN_READ_SIZE bytes are free, the incomplete message is
+        moved to the front of the buffer, or to a buffer of twice the size if it fills
+        more than half of it.
+
+        :param sizehint: Minimum number of bytes the caller wants to write, defaults
+        to any number
+        :return: Writable view of the free space
+        """
+        pending = self._end - self._start
+        wanted = max(sizehint, MIN_READ_SIZE // 2)
+        if len(self._data) - self._end < wanted:
+            if pending + wanted <= len(self._data) and 2 * pending <= len(self._data):
+                self._data[:pending] = self._data[self._start : self._end]
+            else:
+                data = bytearray(max(pending + wanted, 2 * len(self._data)))
+                data[:pending] = self._data[self._start : self._end]
+                self._data = data
+            self._start, self._end = 0, pending
+        return memoryview(self._data)[self._end :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        """Mark received bytes as used.
+
+        :param nbytes: Number of bytes written into the view of get_buffer()
+        """
+        self._end += nbytes
+
+    def take_frames(self) -> list[bytes]:
+        """Return the complete messages and remove them from the buffer.
+
+        :return: Complete messages, including their headers
+        :raises ValueError: If a header has an invalid message size or one above
+        max_message_size
+        """
+        frames = []
+        with memoryview(self._data) as view:
+            while self._end - self._start >= MESSAGE_HEADER.size:
+                _, _, size = MESSAGE_HEADER.unpack_from(view, self._start)
+                if size < MESSAGE_HEADER.size:
+                    raise ValueError(f"Invalid message size {size}")
+                if size > self.max_message_size:
+                    raise ValueError(
+                        f"Message size {size} exceeds the limit of"
+                        f" {self.max_message_size}"
+                    )
+                if self._end - self._start < size:
+                    break
+                frames.append(bytes(view[self._start : self._start + size]))
+                self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+
+class ZeroCopyOPCUAProtocol(OPCUAProtocol, asyncio.BufferedProtocol):
+    """Server connection protocol reading into a FrameBuffer."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._frames = FrameBuffer()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._frames.buffer_updated(nbytes)
+        try:
+            frames = self._frames.take_frames()
+        except ValueError:
+            _logger.exception("Invalid message from client, closing connection")
+            self.transport.close()
+            return
+        for frame in frames:
+            try:
+                buf = Buffer(frame)
+                header = header_from_binary(buf)
+                self.messages.put_nowait((header, buf))
+            except Exception:
+                _logger.exception("Exception raised while parsing message from client")
+
+    def data_received(self, data: bytes) -> None:
+        # only called by transports without BufferedProtocol support
+        self.get_buffer(len(data))[: len(data)] = data
+        self.buffer_updated(len(data))
+
+
+class ZeroCopyUASocketProtocol(UASocketProtocol, asyncio.BufferedProtocol):
+    """Client protocol reading into a FrameBuffer."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._frames = FrameBuffer()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._frames.buffer_updated(nbytes)
+        try:
+            frames = self._frames.take_frames()
+        except ValueError:
+            self.logger.exception("Invalid message from server")
+            self.disconnect_socket()
+            return
+        for frame in frames:
+            # a single complete message, parsed without further copies
+            self._process_received_data(frame)
+            if self.transport is None or self.transport.is_closing():
+                return
+
+    def data_received(self, data: bytes) -> None:
+        # only called by transports without BufferedProtocol support
+        self.get_buffer(len(data))[: len(data)] = data
+        self.buffer_updated(len(data))
+
+
+def install() -> None:
+    """Make asyncua use the protocols of this module.
+
+    Affects servers started and clients connected after the call.
+    """
+    binary_server_asyncio.OPCUAProtocol = ZeroCopyOPCUAProtocol
+    ua_client.UASocketProtocol = ZeroCopyUASocketProtocol
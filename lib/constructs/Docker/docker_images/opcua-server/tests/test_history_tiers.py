@@ -0,0 +1,68 @@
+"""Aggregated reads of tiered history whose raw values were already deleted.
+
+Run from the opcua-server directory with python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncua import ua  # noqa: E402
+
+from opcua_server.history_columnar import ColumnarHistory  # noqa: E402
+from opcua_server.history_sqlite import datetime_to_us  # noqa: E402
+from opcua_server.history_tiers import TieredHistory  # noqa: E402
+
+NODEID = ua.NodeId(1012111, 6)
+MINUTE = 60 * 10**6
+
+
+class TieredHistoryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = os.path.join(self.path, "history_tiers.db")
+        # one value every 10 seconds for 30 minutes, 3 hours ago
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self.base = hour - timedelta(hours=3)
+        history = await self._history("raw")
+        for i in range(180):
+            await history.save_node_value(
+                NODEID,
+                ua.DataValue(
+                    ua.Variant(float(i)),
+                    SourceTimestamp=self.base + timedelta(seconds=10 * i),
+                ),
+            )
+        await history.stop()
+
+    async def asyncTearDown(self):
+        shutil.rmtree(self.path)
+
+    async def _history(self, raw_dir: str) -> TieredHistory:
+        raw = ColumnarHistory(os.path.join(self.path, raw_dir))
+        history = TieredHistory(raw, self.db, raw_period=timedelta(hours=1))
+        await history.init()
+        await history.new_historized_node(NODEID, timedelta(days=1))
+        return history
+
+    async def test_unaligned_start_older_than_raw_period(self):
+        # the raw values have expired, only the rollups are left
+        history = await self._history("expired")
+        start = datetime_to_us(self.base) + 30 * 10**6
+        buckets = await history.read_node_buckets(
+            NODEID, start, start + 30 * MINUTE, 10 * MINUTE
+        )
+        await history.stop()
+        # the minute buckets are added to the interval their start is in
+        self.assertEqual([bucket.count for bucket in buckets], [66, 60, 54])
+        self.assertEqual(sum(bucket.sums[0] for bucket in buckets), sum(range(180)))
+        self.assertEqual(buckets[0].minimums, [0.0])
+        self.assertEqual(buckets[2].maximums, [179.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
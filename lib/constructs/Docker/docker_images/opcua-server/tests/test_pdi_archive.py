@@ -0,0 +1,62 @@
+"""Appending to PDI archive logs that end with a torn record.
+
+A power loss while a frame is written leaves a partial record at the end of the log
+of the day, which is opened again when the server is restarted.
+
+Run from the opcua-server directory with python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IOLINK = os.path.join(SERVER, *[os.pardir] * 5, "opcua")
+sys.path[:0] = [SERVER, IOLINK, os.path.join(IOLINK, "iolink")]
+
+from opcua_server.pdi_archive import PDIArchive  # noqa: E402
+
+IODD_HASH = "ab" * 32
+START = datetime(2026, 10, 19, 8)
+
+
+class PDIArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, "port01", "20261019.pdi")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _append(self, frames: list[bytes], first: int) -> None:
+        archive = PDIArchive(self.path)
+        for i, frame in enumerate(frames, first):
+            archive.append(1, frame, IODD_HASH, START + timedelta(seconds=i))
+        archive.close()
+
+    def _read(self) -> list[bytes]:
+        archive = PDIArchive(self.path)
+        frames = archive.read(1, START, START + timedelta(hours=1))
+        return [frame for _, iodd_hash, frame in frames if iodd_hash == IODD_HASH]
+
+    def test_append_after_truncated_tail(self):
+        self._append([b"\x00\x01\x00\xc8", b"\x00\x02\x00\xc9"], 0)
+        os.truncate(self.log, os.path.getsize(self.log) - 3)
+        self._append([b"\x00\x03\x00\xca", b"\x00\x04\x00\xcb"], 2)
+        self.assertEqual(
+            self._read(),
+            [b"\x00\x01\x00\xc8", b"\x00\x03\x00\xca", b"\x00\x04\x00\xcb"],
+        )
+
+    def test_append_after_truncated_header(self):
+        self._append([b"\x00\x01\x00\xc8"], 0)
+        with open(self.log, "ab") as f:
+            f.write(b"\x01\x02")
+        self._append([b"\x00\x02\x00\xc9"], 1)
+        self.assertEqual(self._read(), [b"\x00\x01\x00\xc8", b"\x00\x02\x00\xc9"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Shared monitored items of nodes that are deleted and added again.
+
+The bridge deletes the nodes of a port when its sensor is disconnected and adds them
+again with the same NodeIds when a sensor is connected.
+
+Run from the opcua-server directory with python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncua import Server, ua  # noqa: E402
+
+from opcua_server import shared_monitoring  # noqa: E402
+
+NODEID = ua.NodeId(1012111, 6)
+
+
+class _Handler:
+    def __init__(self) -> None:
+        self.values = []
+
+    def datachange_notification(self, node, val, data) -> None:
+        self.values.append(val)
+
+
+class SharedMonitoringTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        shared_monitoring.install()
+        self.server = Server()
+        await self.server.init()
+
+    async def _add_variable(self):
+        return await self.server.nodes.objects.add_variable(NODEID, "Values", 0.0)
+
+    async def _subscribe(self, node):
+        handler = _Handler()
+        subscription = await self.server.create_subscription(10, handler)
+        await subscription.subscribe_data_change(node)
+        return handler
+
+    async def _write_values(self, node):
+        for value in (1.0, 2.0, 3.0):
+            await node.write_value(value)
+            await asyncio.sleep(0.05)
+
+    async def test_items_share_one_callback(self):
+        node = await self._add_variable()
+        first = await self._subscribe(node)
+        second = await self._subscribe(node)
+        attval = self.server.iserver.aspace.get(NODEID).attributes[
+            ua.AttributeIds.Value
+        ]
+        self.assertEqual(len(attval.datachange_callbacks), 1)
+        await self._write_values(node)
+        self.assertEqual(first.values, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(second.values, [0.0, 1.0, 2.0, 3.0])
+
+    async def test_delete_and_add_again(self):
+        node = await self._add_variable()
+        stale = await self._subscribe(node)
+        await self.server.delete_nodes([node])
+        node = await self._add_variable()
+        handler = await self._subscribe(node)
+        await self._write_values(node)
+        self.assertEqual(handler.values, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(stale.values, [0.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from pipelined_publisher import PipelinedPublisher
+from segment_queue import SegmentQueue
+from store_and_forward import StoreAndForward, ipc_sender
+from window_aggregation import WindowAggregator
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+TOPIC = "cloud-gg-topic/readings"
+# messages per second when catching up after an outage
+CATCHUP_RATE = 20
+
+if os.environ.get("LOCAL_IPC"):
+    # run without a Greengrass nucleus, e.g. LOCAL_IPC=1 python index.py
+    from local_ipc import LocalIPCClient
+
+    ipc_client = LocalIPCClient()
+else:
+    import awsiot.greengrasscoreipc
+
+    ipc_client = awsiot.greengrasscoreipc.connect()
+
+if os.environ.get("SPOOL_PATH"):
+    # keep the messages on disk until IoT Core acknowledged them
+    forwarder = StoreAndForward(
+        SegmentQueue(os.environ["SPOOL_PATH"]),
+        ipc_sender(ipc_client),
+        rate=CATCHUP_RATE,
+    )
+    forwarder.start()
+else:
+    forwarder = None
+
+publisher = PipelinedPublisher(ipc_client, TOPIC, forwarder=forwarder)
+
+if os.environ.get("AGGREGATE_WINDOW"):
+    # publish per-window statistics and threshold events instead of raw readings,
+    # e.g. AGGREGATE_WINDOW=60 for per-minute statistics
+    aggregator = WindowAggregator(
+        float(os.environ["AGGREGATE_WINDOW"]),
+        float(os.environ.get("AGGREGATE_HOP", 0)) or None,
+    )
+else:
+    aggregator = None
+
+
+def publish_json(topic, messages):
+    """Publish a list of summaries or events as one JSON message."""
+    if messages:
+        publisher.publish_message(topic, json.dumps(messages).encode("utf-8"))
+
+
+def publish_completed_windows():
+    """Publish the windows that ended while no readings arrived."""
+    while True:
+        time.sleep(1)
+        publish_json(f"{TOPIC}/summary", aggregator.advance())
+
+
+if aggregator is not None:
+    threading.Thread(target=publish_completed_windows, daemon=True).start()
+
+
+def lambda_handler(event, context):
+    """Publish the readings of a local-data event.
+
+    The event is a reading or a list of readings as sent to the local database API
+    (port, sensorname, informationnode, values, lowerbounds, upperbounds, units). The
+    readings are only queued, the handler returns without waiting for IoT Core.
+    """
+    readings = event if isinstance(event, list) else [event]
+    summaries, events = [], []
+    for reading in readings:
+        try:
+            args = (
+                reading["port"],
+                reading["sensorname"],
+                reading["informationnode"],
+                reading["values"],
+                reading.get("lowerbounds", []),
+                reading.get("upperbounds", []),
+                reading.get("units", []),
+            )
+            if aggregator is None:
+                publisher.publish(*args)
+            else:
+                completed, crossed = aggregator.add(*args)
+                summaries.extend(completed)
+                events.extend(crossed)
+        except (KeyError, TypeError):
+            logger.warning(f"Ignoring malformed reading {json.dumps(reading)}")
+    publish_json(f"{TOPIC}/summary", summaries)
+    publish_json(f"{TOPIC}/events", events)
+    return True
+
+
+if __name__ == "__main__":
+    # publish test readings of 16 ports with 6 information nodes each at 100 Hz
+    start = time.monotonic()
+    count = 0
+    while time.monotonic() - start < 10:
+        for port in range(1, 17):
+            for node in range(6):
+                publisher.publish(
+                    port,
+                    f"Sensor{port:0>2}",
+                    f"Node{node}",
+                    [float(count), 0.0, 1.0],
+                    [0.0, 0.0, 0.0],
+                    [100.0, 100.0, 100.0],
+                    ["m/s", "mm/s", "in/s"],
+                )
+                count += 1
+        time.sleep(0.01)
+    publisher.close()
+    if forwarder is not None:
+        forwarder.stop()
+    logger.info(
+        f"Queued {count} readings, published {publisher.published} messages,"
+        f" {publisher.failed} failed"
+    )
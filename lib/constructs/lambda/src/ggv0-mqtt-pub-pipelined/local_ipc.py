@@ -0,0 +1,122 @@
+"""Local stand-in for the Greengrass IPC client.
+
+Implements the publish part of the GreengrassCoreIPCClient interface without a
+Greengrass nucleus, so publishers can be run and measured on a development machine.
+Every operation completes on a worker thread after a fixed latency, like the response
+of the nucleus would.
+
+Classes
+-------
+LocalIPCClient
+    Records published messages and completes publish operations after a latency.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import threading
+import time
+
+
+class _LocalPublishOperation:
+    """Publish operation of LocalIPCClient."""
+
+    def __init__(self, client: "LocalIPCClient", to_iot_core: bool) -> None:
+        self._client = client
+        self._to_iot_core = to_iot_core
+        self._response = concurrent.futures.Future()
+
+    def activate(self, request) -> concurrent.futures.Future:
+        if self._to_iot_core:
+            topic, payload = request.topic_name, request.payload
+        else:
+            message = request.publish_message
+            topic = request.topic
+            payload = (
+                message.binary_message.message
+                if message.binary_message is not None
+                else message.json_message.message
+            )
+        self._client._started(self, topic, payload)
+        sent = concurrent.futures.Future()
+        sent.set_result(None)
+        return sent
+
+    def get_response(self) -> concurrent.futures.Future:
+        return self._response
+
+    def close(self) -> concurrent.futures.Future:
+        if not self._response.done():
+            self._response.set_exception(ConnectionError("Operation closed"))
+        closed = concurrent.futures.Future()
+        closed.set_result(None)
+        return closed
+
+
+class LocalIPCClient:
+    """Stand-in for the Greengrass IPC client that only supports publishing.
+
+    Attributes
+    ----------
+    latency : float
+        Seconds until an operation completes
+    online : bool
+        Whether operations succeed, operations fail with a ConnectionError otherwise
+    messages : list[tuple[str, bytes]]
+        Topic and payload of every completed message, in completion order
+    in_flight : int
+        Number of operations that have not completed yet
+    max_in_flight : int
+        Highest number of operations that were in flight at the same time
+
+    Methods
+    -------
+    new_publish_to_iot_core:
+        Creates a PublishToIoTCore operation
+    new_publish_to_topic:
+        Creates a PublishToTopic operation
+    """
+
+    def __init__(self, latency: float = 0.01, workers: int = 64) -> None:
+        """Create LocalIPCClient object.
+
+        :param latency: Seconds until an operation completes, defaults to 0.01
+        :param workers: Number of threads completing operations, defaults to 64
+        """
+        self.latency = latency
+        self.online = True
+        self.messages: list[tuple[str, bytes]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def new_publish_to_iot_core(self) -> _LocalPublishOperation:
+        """Create a PublishToIoTCore operation."""
+        return _LocalPublishOperation(self, to_iot_core=True)
+
+    def new_publish_to_topic(self) -> _LocalPublishOperation:
+        """Create a PublishToTopic operation."""
+        return _LocalPublishOperation(self, to_iot_core=False)
+
+    def _started(
+        self, operation: _LocalPublishOperation, topic: str, payload: bytes
+    ) -> None:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self._executor.submit(self._complete, operation, topic, payload)
+
+    def _complete(
+        self, operation: _LocalPublishOperation, topic: str, payload: bytes
+    ) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+            if self.online:
+                self.messages.append((topic, payload))
+        if operation._response.done():
+            return
+        if self.online:
+            operation._response.set_result(None)
+        else:
+            operation._response.set_exception(ConnectionError("Uplink down"))
@@ -0,0 +1,310 @@
+"""Pipelined publishing of sensor readings over Greengrass IPC.
+
+The other publisher components create one operation per message and block on
+future.result(TIMEOUT) before sending the next one, so they can send at most one
+message per IPC round trip. PipelinedPublisher instead:
+
+* coalesces readings into binary frames (see ingest_frames) until a frame reaches
+  max_payload bytes or has waited linger seconds
+* keeps up to window publish operations in flight and completes them in callbacks,
+  publish() only blocks when the window is full
+* publishes the stream schemas as JSON on <topic>/schema before the first frame that
+  uses them, and again every schema_interval seconds for late subscribers
+
+It works with PublishToIoTCore (local=False) and PublishToTopic (local=True) and with
+any client that has the new_publish_to_iot_core/new_publish_to_topic interface of the
+Greengrass IPC client, e.g. local_ipc.LocalIPCClient for testing. With a
+store_and_forward.StoreAndForward the messages are appended to its durable queue
+instead and published by the forwarder, so they survive an outage of the uplink.
+
+Classes
+-------
+PipelinedPublisher
+    Batches readings and publishes them with a bounded window of in-flight operations.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+import time
+
+from awsiot.greengrasscoreipc.model import (
+    QOS,
+    BinaryMessage,
+    PublishMessage,
+    PublishToIoTCoreRequest,
+    PublishToTopicRequest,
+)
+
+from ingest_frames import (
+    FRAME_HEADER,
+    MAX_FRAME_SPAN,
+    RECORD_HEADER,
+    StreamRegistry,
+    encode_frame,
+)
+from store_and_forward import StoreAndForward
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 10
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class PipelinedPublisher:
+    """Publisher that batches readings and pipelines the publish operations.
+
+    Attributes
+    ----------
+    topic : str
+        Topic the frames are published to, schemas go to <topic>/schema
+    local : bool
+        Whether to publish to the local pub/sub (PublishToTopic) instead of IoT Core
+    window : int
+        Maximum number of publish operations in flight
+    max_payload : int
+        Size in bytes at which a frame is published
+    linger : float
+        Maximum number of seconds a reading waits for its frame to fill up
+    forwarder : StoreAndForward
+        Store-and-forward queue the messages are appended to, None to publish directly
+    published : int
+        Number of messages that completed successfully
+    failed : int
+        Number of messages that failed or timed out
+
+    Methods
+    -------
+    publish:
+        Adds a reading to the current frame
+    publish_message:
+        Publishes a single message
+    flush:
+        Publishes the current frame
+    close:
+        Publishes the current frame and waits for all operations in flight
+    """
+
+    def __init__(
+        self,
+        ipc_client,
+        topic: str,
+        local: bool = False,
+        window: int = 32,
+        max_payload: int = 64 * 1024,
+        linger: float = 0.1,
+        timeout: float = TIMEOUT,
+        schema_interval: float = 60.0,
+        forwarder: StoreAndForward = None,
+    ) -> None:
+        """Create PipelinedPublisher object and start its background thread.
+
+        :param ipc_client: Greengrass IPC client (or a stand-in with the same
+        interface)
+        :param topic: Topic the frames are published to
+        :param local: Whether to publish to the local pub/sub instead of IoT Core,
+        defaults to False
+        :param window: Maximum number of publish operations in flight, defaults to 32
+        :param max_payload: Size in bytes at which a frame is published, defaults to
+        64 KiB (IoT Core allows 128 KiB per message)
+        :param linger: Maximum number of seconds a reading waits for its frame to
+        fill up, defaults to 0.1
+        :param timeout: Number of seconds after which an operation in flight is given
+        up, defaults to TIMEOUT
+        :param schema_interval: Number of seconds between two publications of all
+        schemas, defaults to 60.0
+        :param forwarder: Store-and-forward queue to append the messages to instead
+        of publishing them directly, defaults to None
+        """
+        self.ipc_client = ipc_client
+        self.topic = topic
+        self.local = local
+        self.window = window
+        self.max_payload = max_payload
+        self.linger = linger
+        self.timeout = timeout
+        self.schema_interval = schema_interval
+        self.forwarder = forwarder
+        self.published = 0
+        self.failed = 0
+        self._registry = StreamRegistry()
+        self._records: list[tuple[int, int, list[float]]] = []
+        self._size = FRAME_HEADER.size
+        self._first_added = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(window)
+        # operation -> (response future, deadline)
+        self._in_flight: dict = {}
+        self._last_schemas = time.monotonic()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._linger_loop, daemon=True)
+        self._thread.start()
+
+    def publish(
+        self,
+        port: int,
+        sensorname: str,
+        informationnode: str,
+        values: list[float],
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        units: list[str],
+        timestamp: datetime = None,
+    ) -> None:
+        """Add a reading to the current frame, publishing the frame once it is full.
+
+        :param port: Port of the sensor
+        :param sensorname: Name of the sensor
+        :param informationnode: Name of the information node
+        :param values: Real values of the information node
+        :param lowerbounds: Lower bounds of the values
+        :param upperbounds: Upper bounds of the values
+        :param units: Units of the values
+        :param timestamp: UTC time of the reading, defaults to now
+        """
+        timestamp_us = ((timestamp or datetime.utcnow()) - EPOCH) // MICROSECOND
+        record_size = RECORD_HEADER.size + 8 * len(values)
+        with self._lock:
+            index = self._registry.stream(
+                port, sensorname, informationnode, lowerbounds, upperbounds, units
+            )
+            if self._records and (
+                self._size + record_size > self.max_payload
+                or abs(timestamp_us - self._records[0][1]) > MAX_FRAME_SPAN // 2
+            ):
+                frame = self._take_frame()
+            else:
+                frame = None
+            if not self._records:
+                self._first_added = time.monotonic()
+            self._records.append((index, timestamp_us, values))
+            self._size += record_size
+        if frame is not None:
+            self._send_frame(*frame)
+
+    def publish_message(self, topic: str, payload: bytes) -> None:
+        """Publish a single message, e.g. a summary, outside of the frames.
+
+        :param topic: Topic of the message
+        :param payload: Payload of the message
+        """
+        self._send(topic, payload)
+
+    def flush(self) -> None:
+        """Publish the current frame, even if it is not full."""
+        with self._lock:
+            frame = self._take_frame() if self._records else None
+        if frame is not None:
+            self._send_frame(*frame)
+
+    def close(self, timeout: float = None) -> None:
+        """Publish the current frame and wait for all operations in flight.
+
+        :param timeout: Maximum number of seconds to wait, defaults to the operation
+        timeout
+        """
+        self.flush()
+        self._closed.set()
+        self._thread.join()
+        with self._lock:
+            futures = [future for future, _ in self._in_flight.values()]
+        concurrent.futures.wait(futures, timeout=timeout or self.timeout)
+
+    def _take_frame(self) -> tuple[list, bytes]:
+        """Take the records of the current frame and the schemas they need.
+
+        Must be called with the lock held.
+        """
+        if time.monotonic() - self._last_schemas >= self.schema_interval:
+            self._registry.resend_all()
+            self._last_schemas = time.monotonic()
+        schemas = self._registry.pending()
+        self._registry.mark_sent(schemas)
+        frame = encode_frame(self._records)
+        self._records = []
+        self._size = FRAME_HEADER.size
+        return schemas, frame
+
+    def _send_frame(self, schemas: list, frame: bytes) -> None:
+        """Publish the schemas a frame needs and then the frame."""
+        if schemas:
+            payload = json.dumps([schema.to_dict() for schema in schemas])
+            self._send(f"{self.topic}/schema", payload.encode("utf-8"))
+        self._send(self.topic, frame)
+
+    def _send(self, topic: str, payload: bytes) -> None:
+        """Start a publish operation, waiting for a free slot in the window."""
+        if self.forwarder is not None:
+            self.forwarder.put(topic, payload)
+            return
+        self._slots.acquire()
+        try:
+            if self.local:
+                request = PublishToTopicRequest(
+                    topic=topic,
+                    publish_message=PublishMessage(
+                        binary_message=BinaryMessage(message=payload)
+                    ),
+                )
+                operation = self.ipc_client.new_publish_to_topic()
+            else:
+                request = PublishToIoTCoreRequest(
+                    topic_name=topic, qos=QOS.AT_LEAST_ONCE, payload=payload
+                )
+                operation = self.ipc_client.new_publish_to_iot_core()
+            operation.activate(request)
+            future = operation.get_response()
+        except Exception:
+            self._slots.release()
+            self.failed += 1
+            logger.exception(f"Publishing to {topic} failed")
+            return
+        with self._lock:
+            self._in_flight[operation] = future, time.monotonic() + self.timeout
+        future.add_done_callback(lambda f: self._on_done(operation, topic, f))
+
+    def _on_done(self, operation, topic: str, future: concurrent.futures.Future):
+        """Free the slot of a completed operation and count the result."""
+        with self._lock:
+            if self._in_flight.pop(operation, None) is None:
+                return
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+                error = "cancelled" if future.cancelled() else future.exception()
+                logger.error(f"Publishing to {topic} failed: {error}")
+            else:
+                self.published += 1
+        self._slots.release()
+
+    def _linger_loop(self) -> None:
+        """Publish frames that waited linger seconds and give up timed out
+        operations."""
+        while not self._closed.wait(min(self.linger, 1.0)):
+            now = time.monotonic()
+            with self._lock:
+                frame = None
+                if self._records and now - self._first_added >= self.linger:
+                    frame = self._take_frame()
+                expired = [
+                    operation
+                    for operation, (_, deadline) in self._in_flight.items()
+                    if deadline < now
+                ]
+            if frame is not None:
+                self._send_frame(*frame)
+            for operation in expired:
+                self._expire(operation)
+
+    def _expire(self, operation) -> None:
+        """Give up an operation that did not complete within the timeout."""
+        with self._lock:
+            if self._in_flight.pop(operation, None) is None:
+                return
+            self.failed += 1
+        logger.error(f"Publish operation timed out after {self.timeout} s")
+        self._slots.release()
+        operation.close()
@@ -0,0 +1,321 @@
+"""Durable append-only queue of messages on disk.
+
+The queue is a directory of segment files named after the sequence number of their
+first entry (e.g. 00000000000000004096.seg) and a cursor file with the sequence number
+of the first entry that has not been delivered yet. Every entry is the length and the
+CRC32 of the payload followed by the payload.
+
+* Appends go to the last segment and are fsynced in batches, after fsync_every entries
+  or fsync_interval seconds, so a power loss loses at most one batch.
+* Entries are read back from memory-mapped segments, so the backlog is streamed from
+  the page cache and never loaded into memory as a whole.
+* Segments are deleted once all their entries are committed, and the oldest segments
+  are dropped when the queue grows beyond max_bytes.
+* A torn entry at the end of the last segment (e.g. after a crash) is truncated when
+  the queue is opened.
+
+Delivery is at least once: entries after the last commit are read again after a
+restart.
+
+Classes
+-------
+SegmentQueue
+    Append-only queue of byte messages stored in segment files.
+"""
+from __future__ import annotations
+
+from bisect import bisect_right
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Iterator
+import zlib
+
+logger = logging.getLogger(__name__)
+
+ENTRY_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+def _iter_entries(data, start: int = 0) -> Iterator[tuple[int, int, int]]:
+    """Iterate over the valid entries of a segment.
+
+    :param data: Content of the segment (bytes or mmap)
+    :param start: Offset of the first entry, defaults to 0
+    :return: Iterator of the start offset of the payload, its end offset and the end
+    offset of the last valid entry so far
+    """
+    offset = start
+    while offset + ENTRY_HEADER.size <= len(data):
+        length, crc = ENTRY_HEADER.unpack_from(data, offset)
+        begin = offset + ENTRY_HEADER.size
+        end = begin + length
+        if end > len(data) or zlib.crc32(data[begin:end]) != crc:
+            return
+        offset = end
+        yield begin, end, offset
+
+
+class SegmentQueue:
+    """Append-only queue of byte messages stored in segment files.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the segment files
+    segment_size : int
+        Size in bytes at which a new segment is started
+    max_bytes : int
+        Maximum size of all segments, the oldest segments are dropped beyond that
+    fsync_every : int
+        Number of appended entries after which the segment is fsynced
+    fsync_interval : float
+        Number of seconds after which appended entries are fsynced
+    dropped : int
+        Number of entries dropped because the queue was full
+
+    Methods
+    -------
+    append:
+        Appends a message
+    read:
+        Reads the messages that have not been committed yet
+    commit:
+        Marks messages as delivered
+    sync:
+        Flushes and fsyncs the last segment
+    close:
+        Syncs and closes the queue
+    """
+
+    def __init__(
+        self,
+        path: str = "queue",
+        segment_size: int = 16 * 2**20,
+        max_bytes: int = 2**30,
+        fsync_every: int = 100,
+        fsync_interval: float = 1.0,
+    ) -> None:
+        """Open (or create) the queue in a directory.
+
+        :param path: Directory of the segment files, defaults to "queue"
+        :param segment_size: Size in bytes at which a new segment is started, defaults
+        to 16 MiB
+        :param max_bytes: Maximum size of all segments, defaults to 1 GiB
+        :param fsync_every: Number of appended entries after which the segment is
+        fsynced, defaults to 100
+        :param fsync_interval: Number of seconds after which appended entries are
+        fsynced, defaults to 1.0
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(path)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._sizes = {
+            first: os.path.getsize(self._segment_path(first))
+            for first in self._segments
+        }
+        self._cursor = self._read_cursor()
+        self._next_seq = self._recover()
+        if self._segments:
+            self._cursor = min(max(self._cursor, self._segments[0]), self._next_seq)
+        else:
+            self._cursor = self._next_seq
+            self._start_segment()
+        self._file = open(self._segment_path(self._segments[-1]), "ab")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @property
+    def backlog(self) -> int:
+        """Number of entries that have not been committed yet."""
+        return self._next_seq - self._cursor
+
+    def append(self, payload: bytes) -> int:
+        """Append a message to the queue.
+
+        :param payload: Message
+        :return: Sequence number of the message
+        """
+        entry_size = ENTRY_HEADER.size + len(payload)
+        with self._lock:
+            last = self._segments[-1]
+            if self._sizes[last] and self._sizes[last] + entry_size > self.segment_size:
+                self._sync()
+                self._file.close()
+                self._start_segment()
+                self._file = open(self._segment_path(self._segments[-1]), "ab")
+                self._drop_oldest()
+            self._file.write(ENTRY_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._sizes[self._segments[-1]] += entry_size
+            seq = self._next_seq
+            self._next_seq += 1
+            self._unsynced += 1
+            self._maybe_sync()
+        return seq
+
+    def read(self, max_entries: int = None) -> Iterator[tuple[int, bytes]]:
+        """Read the messages that have not been committed yet, oldest first.
+
+        Messages appended while reading are not included.
+
+        :param max_entries: Maximum number of messages, defaults to all
+        :return: Iterator of the sequence number and the message
+        """
+        with self._lock:
+            self._file.flush()
+            self._maybe_sync()
+            seq = self._cursor
+            end_seq = self._next_seq
+            segments = self._segments[max(bisect_right(self._segments, seq) - 1, 0) :]
+            sizes = [self._sizes[first] for first in segments]
+        count = 0
+        for first, size in zip(segments, sizes):
+            if seq >= end_seq or (max_entries is not None and count >= max_entries):
+                return
+            if size == 0:
+                continue
+            try:
+                with open(self._segment_path(first), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                # dropped because the queue was full
+                continue
+            with mapped:
+                entry_seq = first
+                for begin, end, _ in _iter_entries(mapped):
+                    if entry_seq >= seq:
+                        yield entry_seq, mapped[begin:end]
+                        count += 1
+                        seq = entry_seq + 1
+                        if seq >= end_seq or (
+                            max_entries is not None and count >= max_entries
+                        ):
+                            return
+                    entry_seq += 1
+            if seq < end_seq and first != segments[-1]:
+                # skip the rest of a corrupt segment
+                seq = max(seq, segments[segments.index(first) + 1])
+
+    def commit(self, seq: int) -> None:
+        """Mark all messages up to and including a sequence number as delivered.
+
+        :param seq: Sequence number of the last delivered message
+        """
+        with self._lock:
+            if seq < self._cursor:
+                return
+            self._cursor = min(seq + 1, self._next_seq)
+            while len(self._segments) > 1 and self._segments[1] <= self._cursor:
+                self._remove_segment(self._segments[0])
+            self._write_cursor()
+
+    def sync(self) -> None:
+        """Flush and fsync the last segment."""
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        """Sync and close the queue."""
+        with self._lock:
+            self._sync()
+            self._file.close()
+            self._write_cursor()
+
+    def _segment_path(self, first: int) -> str:
+        return os.path.join(self.path, f"{first:020d}{SEGMENT_SUFFIX}")
+
+    def _start_segment(self) -> None:
+        """Start a new, empty segment."""
+        first = self._next_seq
+        open(self._segment_path(first), "wb").close()
+        self._segments.append(first)
+        self._sizes[first] = 0
+
+    def _remove_segment(self, first: int) -> None:
+        os.remove(self._segment_path(first))
+        self._segments.remove(first)
+        del self._sizes[first]
+
+    def _drop_oldest(self) -> None:
+        """Drop the oldest segments while the queue is larger than max_bytes."""
+        while len(self._segments) > 1 and sum(self._sizes.values()) > self.max_bytes:
+            first = self._segments[0]
+            next_first = self._segments[1]
+            dropped = max(next_first - max(self._cursor, first), 0)
+            self._remove_segment(first)
+            self._cursor = max(self._cursor, next_first)
+            self.dropped += dropped
+            logger.warning(f"Queue full, dropped {dropped} entries")
+            self._write_cursor()
+
+    def _recover(self) -> int:
+        """Truncate a torn entry at the end of the last segment.
+
+        :return: Sequence number of the next entry
+        """
+        if not self._segments:
+            return self._cursor
+        last = self._segments[-1]
+        path = self._segment_path(last)
+        count = 0
+        valid = 0
+        if self._sizes[last]:
+            with open(path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                for _, _, valid in _iter_entries(mapped):
+                    count += 1
+        if valid != self._sizes[last]:
+            logger.warning(
+                f"Truncating {self._sizes[last] - valid} bytes of a torn entry"
+                f" in {path}"
+            )
+            os.truncate(path, valid)
+            self._sizes[last] = valid
+        return last + count
+
+    def _read_cursor(self) -> int:
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return self._segments[0] if self._segments else 0
+
+    def _write_cursor(self) -> None:
+        """Write the cursor file, atomically replacing the old one.
+
+        The cursor is not fsynced, after a power loss some messages are delivered
+        again.
+        """
+        path = os.path.join(self.path, CURSOR_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(self._cursor))
+        os.replace(path + ".tmp", path)
+
+    def _maybe_sync(self) -> None:
+        if self._unsynced and (
+            self._unsynced >= self.fsync_every
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self._sync()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
@@ -0,0 +1,316 @@
+"""Store-and-forward publishing of messages through a durable queue.
+
+Messages are appended to a SegmentQueue and forwarded by a background thread, so the
+producer never waits for the uplink and nothing is lost while it is down. The
+forwarder keeps up to window messages in flight, commits the queue up to the last
+message that was acknowledged in order, and backs off exponentially while publishing
+fails. After a reconnect (or a restart with messages left in the queue) the backlog is
+streamed from the queue at a limited rate, so the catch-up does not saturate the uplink
+or exceed the IoT Core quotas. Once the backlog is drained, messages are forwarded
+without the limit again.
+
+Classes
+-------
+StoreAndForward
+    Forwards the messages of a durable queue to a publish function.
+
+Functions
+---------
+pack_message
+    Packs a topic and a payload into one queue entry.
+unpack_message
+    Unpacks a queue entry into the topic and the payload.
+ipc_sender
+    Creates a publish function for the Greengrass IPC client.
+"""
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import logging
+import struct
+import threading
+import time
+from typing import Callable
+
+from awsiot.greengrasscoreipc.model import (
+    QOS,
+    BinaryMessage,
+    PublishMessage,
+    PublishToIoTCoreRequest,
+    PublishToTopicRequest,
+)
+
+from segment_queue import SegmentQueue
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 10
+TOPIC_LENGTH = struct.Struct("<H")
+
+
+def pack_message(topic: str, payload: bytes) -> bytes:
+    """Pack a topic and a payload into one queue entry.
+
+    :param topic: Topic of the message
+    :param payload: Payload of the message
+    :return: Queue entry
+    """
+    topic = topic.encode("utf-8")
+    return TOPIC_LENGTH.pack(len(topic)) + topic + payload
+
+
+def unpack_message(entry: bytes) -> tuple[str, bytes]:
+    """Unpack a queue entry into the topic and the payload.
+
+    :param entry: Queue entry
+    :return: Topic and payload of the message
+    """
+    (length,) = TOPIC_LENGTH.unpack_from(entry)
+    end = TOPIC_LENGTH.size + length
+    return entry[TOPIC_LENGTH.size : end].decode("utf-8"), entry[end:]
+
+
+def ipc_sender(
+    ipc_client, local: bool = False
+) -> Callable[[str, bytes], concurrent.futures.Future]:
+    """Create a publish function for the Greengrass IPC client.
+
+    :param ipc_client: Greengrass IPC client (or a stand-in with the same interface)
+    :param local: Whether to publish to the local pub/sub instead of IoT Core,
+    defaults to False
+    :return: Function that starts publishing a payload to a topic and returns the
+    future of the response
+    """
+
+    def send(topic: str, payload: bytes) -> concurrent.futures.Future:
+        if local:
+            request = PublishToTopicRequest(
+                topic=topic,
+                publish_message=PublishMessage(
+                    binary_message=BinaryMessage(message=payload)
+                ),
+            )
+            operation = ipc_client.new_publish_to_topic()
+        else:
+            request = PublishToIoTCoreRequest(
+                topic_name=topic, qos=QOS.AT_LEAST_ONCE, payload=payload
+            )
+            operation = ipc_client.new_publish_to_iot_core()
+        operation.activate(request)
+        return operation.get_response()
+
+    return send
+
+
+class StoreAndForward:
+    """Forwards the messages of a durable queue to a publish function.
+
+    Attributes
+    ----------
+    queue : SegmentQueue
+        Queue of the messages (see pack_message)
+    send : Callable[[str, bytes], concurrent.futures.Future]
+        Function that starts publishing a payload to a topic
+    window : int
+        Maximum number of messages in flight
+    rate : float
+        Maximum number of messages per second while catching up, None for no limit
+    catching_up : bool
+        Whether the backlog of an outage or of the last run is being forwarded
+    forwarded : int
+        Number of messages that were acknowledged
+    failures : int
+        Number of failed publish attempts
+    online : bool
+        Whether the last publish attempt succeeded
+
+    Methods
+    -------
+    put:
+        Appends a message to the queue
+    start:
+        Starts forwarding in a background thread
+    stop:
+        Stops forwarding and closes the queue
+    forward:
+        Forwards the next messages of the queue
+    """
+
+    def __init__(
+        self,
+        queue: SegmentQueue,
+        send: Callable[[str, bytes], concurrent.futures.Future],
+        window: int = 16,
+        rate: float = None,
+        burst: int = None,
+        batch: int = 1000,
+        timeout: float = TIMEOUT,
+        retry_interval: float = 1.0,
+        max_retry_interval: float = 60.0,
+        idle_interval: float = 0.1,
+    ) -> None:
+        """Create StoreAndForward object.
+
+        :param queue: Queue of the messages
+        :param send: Function that starts publishing a payload to a topic and returns
+        the future of the response, e.g. from ipc_sender
+        :param window: Maximum number of messages in flight, defaults to 16
+        :param rate: Maximum number of messages per second while catching up,
+        defaults to no limit
+        :param burst: Number of messages that may be sent at once before the rate
+        applies, defaults to one second worth of messages
+        :param batch: Maximum number of messages read from the queue at once,
+        defaults to 1000
+        :param timeout: Number of seconds to wait for an acknowledgement, defaults to
+        TIMEOUT
+        :param retry_interval: Number of seconds to wait after the first failure,
+        doubled with every further failure, defaults to 1.0
+        :param max_retry_interval: Maximum number of seconds between two attempts,
+        defaults to 60.0
+        :param idle_interval: Number of seconds to wait when the queue is empty,
+        defaults to 0.1
+        """
+        self.queue = queue
+        self.send = send
+        self.window = window
+        self.rate = rate
+        self.burst = burst or max(int(rate or 1), 1)
+        self.batch = batch
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.idle_interval = idle_interval
+        self.forwarded = 0
+        self.failures = 0
+        self.online = True
+        # messages left from the last run are a backlog as well
+        self.catching_up = queue.backlog > 0
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._backoff = retry_interval
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def put(self, topic: str, payload: bytes) -> None:
+        """Append a message to the queue.
+
+        :param topic: Topic of the message
+        :param payload: Payload of the message
+        """
+        self.queue.append(pack_message(topic, payload))
+
+    def start(self) -> None:
+        """Start forwarding in a background thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop forwarding and close the queue, unsent messages stay in the queue."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.queue.close()
+
+    def forward(self) -> int:
+        """Forward the next messages of the queue.
+
+        The queue is committed up to the last message that was acknowledged with all
+        messages before it. The messages after a failure are sent again by the next
+        call, so a message may be delivered more than once. While catching up, the
+        messages are sent at the rate limit; catching up ends when a call forwards
+        all messages that were in the queue when it started.
+
+        :return: Number of acknowledged messages, -1 if publishing failed
+        """
+        in_flight = collections.deque()
+        committed = None
+        forwarded = self.forwarded
+        failed = False
+        read = 0
+        for seq, entry in self.queue.read(self.batch):
+            if self._stopped.is_set() or (self.catching_up and not self._throttle()):
+                break
+            read += 1
+            while len(in_flight) >= self.window and not failed:
+                committed, failed = self._acknowledge(in_flight, committed)
+            if failed:
+                break
+            topic, payload = unpack_message(entry)
+            try:
+                in_flight.append((seq, self.send(topic, payload)))
+            except Exception as e:
+                self._failed(e)
+                failed = True
+        while in_flight and not failed:
+            committed, failed = self._acknowledge(in_flight, committed)
+        if committed is not None:
+            self.queue.commit(committed)
+        if failed:
+            return -1
+        self.online = True
+        self._backoff = self.retry_interval
+        if self.catching_up and read < self.batch and not self._stopped.is_set():
+            logger.info("Forwarded the backlog, leaving the rate limit")
+            self.catching_up = False
+        return self.forwarded - forwarded
+
+    def _acknowledge(
+        self, in_flight: collections.deque, committed: int | None
+    ) -> tuple[int | None, bool]:
+        """Wait for the acknowledgement of the oldest message in flight.
+
+        :param in_flight: Sequence numbers and response futures of the messages in
+        flight
+        :param committed: Sequence number of the last acknowledged message
+        :return: Sequence number of the last acknowledged message and whether
+        publishing failed
+        """
+        seq, future = in_flight.popleft()
+        try:
+            future.result(self.timeout)
+        except Exception as e:
+            self._failed(e)
+            return committed, True
+        self.forwarded += 1
+        return seq, False
+
+    def _failed(self, error: Exception) -> None:
+        self.failures += 1
+        if self.online:
+            logger.error(
+                f"Publishing failed ({error or type(error).__name__}), keeping"
+                f" {self.queue.backlog} messages in the queue"
+            )
+        self.online = False
+        self.catching_up = True
+
+    def _throttle(self) -> bool:
+        """Wait for a token of the rate limit.
+
+        :return: False if the forwarder was stopped while waiting
+        """
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._refilled) * self.rate, float(self.burst)
+        )
+        self._refilled = now
+        if self._tokens < 1:
+            if self._stopped.wait((1 - self._tokens) / self.rate):
+                return False
+            self._tokens = 1.0
+            self._refilled = time.monotonic()
+        self._tokens -= 1
+        return True
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            count = self.forward()
+            if count < 0:
+                self._stopped.wait(self._backoff)
+                self._backoff = min(2 * self._backoff, self.max_retry_interval)
+            elif count == 0:
+                self._stopped.wait(self.idle_interval)
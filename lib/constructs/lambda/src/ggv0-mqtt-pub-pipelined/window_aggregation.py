@@ -0,0 +1,328 @@
+"""Streaming window aggregation of sensor readings.
+
+The cloud only needs statistics of the readings, so instead of every raw reading the
+aggregator emits one summary per stream (port, sensor and information node) and window,
+with the minimum, maximum, mean, RMS, count and last value of every value of the
+information node, and an event whenever a value crosses its lower or upper bound.
+
+Windows are tumbling (hop == window) or sliding (hop < window, window a multiple of
+hop). Samples are added to panes of hop seconds in O(1), a sliding window combines the
+window / hop panes it covers when it is emitted. A window is emitted once a sample
+lateness seconds after its end arrives or advance() is called after that time, samples
+for windows that were already emitted are dropped and counted as late.
+
+Classes
+-------
+WindowStats
+    Running statistics of one value.
+WindowAggregator
+    Aggregates readings into window summaries and threshold events.
+"""
+from __future__ import annotations
+
+import collections
+from datetime import datetime, timedelta
+import math
+import threading
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class WindowStats:
+    """Running statistics of one value.
+
+    Attributes
+    ----------
+    count : int
+        Number of samples
+    total : float
+        Sum of the samples
+    squares : float
+        Sum of the squared samples
+    minimum : float
+        Smallest sample
+    maximum : float
+        Largest sample
+    last : float
+        Sample with the latest timestamp
+    last_time : float
+        Timestamp of the last sample
+
+    Methods
+    -------
+    add:
+        Adds a sample
+    merge:
+        Adds the samples of other statistics
+    """
+
+    __slots__ = ("count", "total", "squares", "minimum", "maximum", "last", "last_time")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.last = math.nan
+        self.last_time = -math.inf
+
+    def add(self, value: float, timestamp: float) -> None:
+        """Add a sample.
+
+        :param value: Value of the sample
+        :param timestamp: Timestamp of the sample in seconds
+        """
+        self.count += 1
+        self.total += value
+        self.squares += value * value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        if timestamp >= self.last_time:
+            self.last = value
+            self.last_time = timestamp
+
+    def merge(self, other: "WindowStats") -> None:
+        """Add the samples of other statistics.
+
+        :param other: Statistics to add
+        """
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        if other.last_time >= self.last_time:
+            self.last = other.last
+            self.last_time = other.last_time
+
+
+class _Stream:
+    """Panes and threshold states of one stream."""
+
+    __slots__ = ("key", "units", "panes", "emitted_until", "states")
+
+    def __init__(self, key: tuple[int, str, str]) -> None:
+        self.key = key
+        self.units: list[str] = []
+        # (pane start, statistics of every value), oldest first
+        self.panes: collections.deque = collections.deque()
+        self.emitted_until = -math.inf
+        self.states: list[int] = []
+
+
+class WindowAggregator:
+    """Aggregates readings into window summaries and threshold events.
+
+    Attributes
+    ----------
+    window : float
+        Length of the windows in seconds
+    hop : float
+        Seconds between the starts of two windows, equal to window for tumbling
+        windows
+    lateness : float
+        Seconds a window is kept open after its end for late samples
+    late : int
+        Number of samples dropped because their windows were already emitted
+
+    Methods
+    -------
+    add:
+        Adds a reading and returns the completed summaries and threshold events
+    advance:
+        Returns the summaries of all windows that ended before a time
+    """
+
+    def __init__(
+        self, window: float = 60.0, hop: float = None, lateness: float = 1.0
+    ) -> None:
+        """Create WindowAggregator object.
+
+        :param window: Length of the windows in seconds, defaults to 60.0
+        :param hop: Seconds between the starts of two windows, defaults to window
+        (tumbling windows)
+        :param lateness: Seconds a window is kept open after its end for late
+        samples, defaults to 1.0
+        """
+        hop = hop or window
+        if (
+            window <= 0
+            or hop > window
+            or not math.isclose(window / hop, round(window / hop))
+        ):
+            raise ValueError("window must be a positive multiple of hop")
+        self.window = window
+        self.hop = hop
+        self.lateness = lateness
+        self.late = 0
+        self._streams: dict[tuple[int, str, str], _Stream] = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        port: int,
+        sensorname: str,
+        informationnode: str,
+        values: list[float],
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        units: list[str],
+        timestamp: datetime = None,
+    ) -> tuple[list[dict], list[dict]]:
+        """Add a reading.
+
+        :param port: Port of the sensor
+        :param sensorname: Name of the sensor
+        :param informationnode: Name of the information node
+        :param values: Real values of the information node
+        :param lowerbounds: Lower bounds of the values
+        :param upperbounds: Upper bounds of the values
+        :param units: Units of the values
+        :param timestamp: UTC time of the reading, defaults to now
+        :return: Summaries of the windows of the stream completed by the reading and
+        threshold events of the reading
+        """
+        timestamp = timestamp or datetime.utcnow()
+        t = (timestamp - EPOCH) / timedelta(seconds=1)
+        key = port, sensorname, informationnode
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = self._streams[key] = _Stream(key)
+            if len(stream.states) != len(values):
+                # the information node changed, e.g. another sensor was connected
+                stream.panes.clear()
+                stream.states = [0] * len(values)
+            stream.units = list(units)
+            events = self._check_bounds(
+                stream, values, lowerbounds, upperbounds, timestamp
+            )
+            pane_start = math.floor(t / self.hop) * self.hop
+            if pane_start < stream.emitted_until:
+                self.late += 1
+                return [], events
+            pane = self._pane(stream, pane_start, len(values))
+            for stats, value in zip(pane, values):
+                stats.add(value, t)
+            return self._close(stream, t - self.lateness), events
+
+    def advance(self, now: datetime = None) -> list[dict]:
+        """Return the summaries of all windows that ended lateness seconds before a
+        time.
+
+        :param now: UTC time, defaults to now
+        :return: Summaries of the completed windows
+        """
+        t = ((now or datetime.utcnow()) - EPOCH) / timedelta(seconds=1)
+        summaries = []
+        with self._lock:
+            for stream in self._streams.values():
+                summaries.extend(self._close(stream, t - self.lateness))
+        return summaries
+
+    def _pane(self, stream: _Stream, start: float, size: int) -> list[WindowStats]:
+        """Return the statistics of the pane starting at a time, adding it if
+        needed."""
+        panes = stream.panes
+        if not panes or panes[-1][0] < start:
+            panes.append((start, [WindowStats() for _ in range(size)]))
+            return panes[-1][1]
+        for pane_start, stats in reversed(panes):
+            if pane_start == start:
+                return stats
+            if pane_start < start:
+                break
+        # a late sample for a pane without samples yet, keep the panes sorted
+        panes.append((start, [WindowStats() for _ in range(size)]))
+        stream.panes = collections.deque(sorted(panes, key=lambda pane: pane[0]))
+        return next(stats for pane_start, stats in stream.panes if pane_start == start)
+
+    def _close(self, stream: _Stream, until: float) -> list[dict]:
+        """Emit the windows of a stream that ended at or before a time."""
+        summaries = []
+        panes = stream.panes
+        while panes:
+            # end of the next window that contains the oldest pane
+            end = max(stream.emitted_until, panes[0][0]) + self.hop
+            end = math.floor(end / self.hop + 1e-9) * self.hop
+            if end > until:
+                break
+            start = end - self.window
+            merged = None
+            for pane_start, stats in panes:
+                if pane_start >= end:
+                    break
+                if pane_start >= start:
+                    if merged is None:
+                        merged = [WindowStats() for _ in stats]
+                    for total, pane_stats in zip(merged, stats):
+                        total.merge(pane_stats)
+            if merged is not None:
+                summaries.append(self._summary(stream, start, end, merged))
+            stream.emitted_until = end
+            # panes that no later window covers
+            while panes and panes[0][0] < end + self.hop - self.window:
+                panes.popleft()
+        return summaries
+
+    def _summary(
+        self, stream: _Stream, start: float, end: float, stats: list[WindowStats]
+    ) -> dict:
+        port, sensorname, informationnode = stream.key
+        count = stats[0].count if stats else 0
+        return {
+            "port": port,
+            "sensorname": sensorname,
+            "informationnode": informationnode,
+            "units": stream.units,
+            "start": (EPOCH + timedelta(seconds=start)).isoformat(),
+            "end": (EPOCH + timedelta(seconds=end)).isoformat(),
+            "count": count,
+            "min": [s.minimum for s in stats],
+            "max": [s.maximum for s in stats],
+            "mean": [s.total / s.count for s in stats],
+            "rms": [math.sqrt(s.squares / s.count) for s in stats],
+            "last": [s.last for s in stats],
+        }
+
+    def _check_bounds(
+        self,
+        stream: _Stream,
+        values: list[float],
+        lowerbounds: list[float],
+        upperbounds: list[float],
+        timestamp: datetime,
+    ) -> list[dict]:
+        """Return an event for every value that crossed one of its bounds."""
+        events = []
+        for i, value in enumerate(values):
+            lower = lowerbounds[i] if i < len(lowerbounds) else None
+            upper = upperbounds[i] if i < len(upperbounds) else None
+            if lower is not None and value < lower:
+                state = -1
+            elif upper is not None and value > upper:
+                state = 1
+            else:
+                state = 0
+            if state == stream.states[i]:
+                continue
+            stream.states[i] = state
+            port, sensorname, informationnode = stream.key
+            events.append(
+                {
+                    "port": port,
+                    "sensorname": sensorname,
+                    "informationnode": informationnode,
+                    "unit": stream.units[i] if i < len(stream.units) else "",
+                    "index": i,
+                    "value": value,
+                    "lowerbound": lower,
+                    "upperbound": upper,
+                    "state": ("below", "normal", "above")[state + 1],
+                    "timestamp": timestamp.isoformat(),
+                }
+            )
+        return events
@@ -4,35 +4,27 @@ import time
 import traceback
 
 import awsiot.greengrasscoreipc
-import awsiot.greengrasscoreipc.client as client
 from awsiot.greengrasscoreipc.model import (
     SubscribeToTopicRequest,
-    SubscriptionResponseMessage,
     UnauthorizedError
 )
 
+from worker_pool import BLOCK, DispatchingStreamHandler, WorkerPool
+
 topic = "local-data"
 TIMEOUT = 10
+METRICS_INTERVAL = 60
 
-                    
-class StreamHandler(client.SubscribeToTopicStreamHandler):
-    def __init__(self):
-        super().__init__()
 
-    def on_stream_event(self, event: SubscriptionResponseMessage) -> None:
-        try:
-            message = str(event.binary_message.message, "utf-8")
-            print("Received new message: " + message)
-        except:
-            traceback.print_exc()
+def process_message(topic: str, payload: bytes) -> None:
+    # runs in a worker thread, so slow processing does not stall the stream
+    message = str(payload, "utf-8")
+    print("Received new message on " + topic + ": " + message)
 
-    def on_stream_error(self, error: Exception) -> bool:
-        print("Received a stream error.", file=sys.stderr)
-        traceback.print_exc()
-        return False  # Return True to close stream, False to keep stream open.
 
-    def on_stream_closed(self) -> None:
-        print('Subscribe to topic stream closed.')
+# messages of a topic are processed in order, the stream waits when 1000 are queued
+pool = WorkerPool(process_message, workers=4, max_queued=1000, policy=BLOCK)
+pool.start()
 
 
 try:
@@ -40,7 +32,7 @@ try:
     ## change to check deployment
     request = SubscribeToTopicRequest()
     request.topic = topic
-    handler = StreamHandler()
+    handler = DispatchingStreamHandler(topic, pool)
     operation = ipc_client.new_subscribe_to_topic(handler)
     operation.activate(request)
     future_response = operation.get_response()
@@ -61,9 +53,11 @@ try:
     # Keep the main thread alive, or the process will exit.
     try:
         while True:
-            time.sleep(10)
+            time.sleep(METRICS_INTERVAL)
+            print('Subscriber metrics: ' + str(pool.metrics()))
     except InterruptedError:
         print('Subscribe interrupted.')
+        pool.stop()
 except Exception:
     print('Exception occurred when using IPC.', file=sys.stderr)
     traceback.print_exc()
@@ -0,0 +1,325 @@
+"""Processing of subscribed messages off the IPC callback thread.
+
+The IPC client calls on_stream_event on its event thread, and no further messages are
+delivered while it runs. DispatchingStreamHandler only puts the payload into a bounded
+queue of a WorkerPool, whose workers (threads or asyncio tasks) do the processing.
+
+* Ordering: messages are sharded by topic, every shard has its own queue and worker,
+  so the messages of a topic are processed in the order they were received.
+* Backpressure: when the queue of a shard is full, the message is dropped (DROP_NEWEST),
+  the oldest queued message is dropped (DROP_OLDEST), or the IPC thread blocks until
+  there is room (BLOCK), which stops the stream instead of losing messages.
+* Metrics: the pool counts received, processed, failed and dropped messages and
+  measures the lag between receiving and processing a message.
+
+Classes
+-------
+WorkerPool
+    Bounded, topic-sharded queues served by worker threads or asyncio tasks.
+DispatchingStreamHandler
+    Stream handler that hands the messages of a subscription to a WorkerPool.
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Union
+import zlib
+
+import awsiot.greengrasscoreipc.client as client
+from awsiot.greengrasscoreipc.model import SubscriptionResponseMessage
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+# weight of the latest lag in the moving average
+LAG_SMOOTHING = 0.1
+
+
+class _Shard:
+    """Queue of one worker."""
+
+    def __init__(self) -> None:
+        self.items: collections.deque = collections.deque()
+        self.condition = threading.Condition()
+        # only used by asyncio workers, created in the event loop
+        self.event: asyncio.Event = None
+
+
+class WorkerPool:
+    """Bounded, topic-sharded queues served by worker threads or asyncio tasks.
+
+    Attributes
+    ----------
+    workers : int
+        Number of workers (and queues)
+    max_queued : int
+        Maximum number of queued messages per worker
+    policy : str
+        What to do when a queue is full, one of BLOCK, DROP_NEWEST and DROP_OLDEST
+    use_asyncio : bool
+        Whether the workers are asyncio tasks (handler is a coroutine function)
+    received : int
+        Number of submitted messages
+    processed : int
+        Number of processed messages
+    failed : int
+        Number of messages whose handler raised an exception
+    dropped : int
+        Number of messages dropped because a queue was full
+    max_lag : float
+        Largest number of seconds between receiving and processing a message
+    lag : float
+        Moving average of the seconds between receiving and processing a message
+
+    Methods
+    -------
+    start:
+        Starts the workers
+    stop:
+        Processes the queued messages and stops the workers
+    submit:
+        Queues a message
+    metrics:
+        Returns the counters, the lag and the queue depths
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, bytes], Union[None, Awaitable[None]]],
+        workers: int = 4,
+        max_queued: int = 1000,
+        policy: str = BLOCK,
+        use_asyncio: bool = False,
+        block_timeout: float = None,
+    ) -> None:
+        """Create WorkerPool object.
+
+        :param handler: Function (or coroutine function if use_asyncio) processing the
+        topic and the payload of a message
+        :param workers: Number of workers, defaults to 4
+        :param max_queued: Maximum number of queued messages per worker, defaults to
+        1000
+        :param policy: What to do when a queue is full, defaults to BLOCK
+        :param use_asyncio: Whether to run the workers as asyncio tasks in an event
+        loop thread, defaults to False
+        :param block_timeout: Maximum number of seconds to block with the BLOCK policy
+        before dropping the message, defaults to no limit
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}")
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.policy = policy
+        self.use_asyncio = use_asyncio
+        self.block_timeout = block_timeout
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+        self.lag = 0.0
+        self._shards = [_Shard() for _ in range(workers)]
+        self._metrics_lock = threading.Lock()
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+        self._loop: asyncio.AbstractEventLoop = None
+
+    def start(self) -> None:
+        """Start the workers."""
+        self._stopping = False
+        if self.use_asyncio:
+            self._loop = asyncio.new_event_loop()
+            started = threading.Event()
+            thread = threading.Thread(
+                target=self._run_loop, args=(started,), daemon=True
+            )
+            thread.start()
+            started.wait()
+            self._threads = [thread]
+        else:
+            self._threads = [
+                threading.Thread(target=self._work, args=(shard,), daemon=True)
+                for shard in self._shards
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """Process the queued messages and stop the workers.
+
+        :param timeout: Maximum number of seconds to wait, defaults to no limit
+        """
+        self._stopping = True
+        for shard in self._shards:
+            with shard.condition:
+                shard.condition.notify_all()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(shard.event.set)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, topic: str, payload: bytes) -> bool:
+        """Queue a message.
+
+        :param topic: Topic of the message
+        :param payload: Payload of the message
+        :return: Whether the message was queued
+        """
+        shard = self._shards[zlib.crc32(topic.encode("utf-8")) % self.workers]
+        with self._metrics_lock:
+            self.received += 1
+        with shard.condition:
+            if len(shard.items) >= self.max_queued:
+                if self.policy == DROP_OLDEST:
+                    shard.items.popleft()
+                    self._dropped()
+                elif self.policy == DROP_NEWEST or not shard.condition.wait_for(
+                    lambda: len(shard.items) < self.max_queued or self._stopping,
+                    self.block_timeout,
+                ):
+                    self._dropped()
+                    return False
+            shard.items.append((topic, payload, time.monotonic()))
+            shard.condition.notify_all()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(shard.event.set)
+        return True
+
+    def metrics(self) -> dict:
+        """Return the counters, the lag and the queue depths.
+
+        :return: Metrics of the pool
+        """
+        with self._metrics_lock:
+            return {
+                "received": self.received,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "lag": self.lag,
+                "max_lag": self.max_lag,
+                "queued": [len(shard.items) for shard in self._shards],
+            }
+
+    def _dropped(self) -> None:
+        with self._metrics_lock:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"Worker queue full, dropped {self.dropped} messages")
+
+    def _take(self, shard: _Shard, wait: bool) -> tuple | None:
+        """Take the next message of a shard."""
+        with shard.condition:
+            if wait:
+                shard.condition.wait_for(lambda: shard.items or self._stopping)
+            if not shard.items:
+                return None
+            item = shard.items.popleft()
+            shard.condition.notify_all()
+            return item
+
+    def _done(self, enqueued: float, error: Exception = None) -> None:
+        """Count a processed message and update the lag."""
+        lag = time.monotonic() - enqueued
+        with self._metrics_lock:
+            self.processed += 1
+            if error is not None:
+                self.failed += 1
+            self.max_lag = max(self.max_lag, lag)
+            self.lag += LAG_SMOOTHING * (lag - self.lag)
+        if error is not None:
+            logger.error(f"Processing a message failed: {error!r}")
+
+    def _work(self, shard: _Shard) -> None:
+        """Process the messages of a shard in a worker thread."""
+        while True:
+            item = self._take(shard, wait=True)
+            if item is None:
+                return
+            topic, payload, enqueued = item
+            try:
+                self.handler(topic, payload)
+            except Exception as e:
+                self._done(enqueued, e)
+            else:
+                self._done(enqueued)
+
+    def _run_loop(self, started: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+
+        async def main():
+            for shard in self._shards:
+                shard.event = asyncio.Event()
+            started.set()
+            await asyncio.gather(*(self._work_async(s) for s in self._shards))
+
+        self._loop.run_until_complete(main())
+        self._loop.close()
+
+    async def _work_async(self, shard: _Shard) -> None:
+        """Process the messages of a shard in an asyncio task."""
+        while True:
+            await shard.event.wait()
+            shard.event.clear()
+            while True:
+                item = self._take(shard, wait=False)
+                if item is None:
+                    break
+                topic, payload, enqueued = item
+                try:
+                    await self.handler(topic, payload)
+                except Exception as e:
+                    self._done(enqueued, e)
+                else:
+                    self._done(enqueued)
+            if self._stopping:
+                return
+
+
+class DispatchingStreamHandler(client.SubscribeToTopicStreamHandler):
+    """Stream handler that hands the messages of a subscription to a WorkerPool.
+
+    Attributes
+    ----------
+    topic : str
+        Subscribed topic, used if a message does not name its topic
+    pool : WorkerPool
+        Pool processing the messages
+    """
+
+    def __init__(self, topic: str, pool: WorkerPool) -> None:
+        """Create DispatchingStreamHandler object.
+
+        :param topic: Subscribed topic
+        :param pool: Pool processing the messages
+        """
+        super().__init__()
+        self.topic = topic
+        self.pool = pool
+
+    def on_stream_event(self, event: SubscriptionResponseMessage) -> None:
+        message = event.binary_message or event.json_message
+        if message is None:
+            return
+        payload = message.message
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode("utf-8")
+        context = getattr(message, "context", None)
+        topic = getattr(context, "topic", None) or self.topic
+        self.pool.submit(topic, payload)
+
+    def on_stream_error(self, error: Exception) -> bool:
+        logger.error(f"Received a stream error: {error!r}")
+        return False  # Return True to close stream, False to keep stream open.
+
+    def on_stream_closed(self) -> None:
+        logger.info("Subscribe to topic stream closed.")
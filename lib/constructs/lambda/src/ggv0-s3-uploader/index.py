@@ -7,18 +7,30 @@ from awsiot.greengrasscoreipc.model import (
     QOS,
     PublishToIoTCoreRequest
 )
-import boto3 
+import os
+from spool_uploader import RollingSpool, SpoolUploader
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 TIMEOUT = 10
+BUCKET = 'avgz-iotbox-trials'
 
 ipc_client = awsiot.greengrasscoreipc.connect()
 
+# readings are rolled into one gzip NDJSON object per 5 minutes (or 64 MiB)
+spool = RollingSpool(os.environ.get("SPOOL_PATH", "/tmp/s3-spool"))
+uploader = SpoolUploader(
+    spool,
+    BUCKET,
+    prefix="basic/",
+    # e.g. a local MinIO for testing
+    endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+)
+uploader.start()
+
 def greengrass_mean():
     i = 1
-    s3 = boto3.client('s3')
     while True:
         id = str(i)
         #following line just for testing 
@@ -34,11 +46,7 @@ def greengrass_mean():
         future = operation.get_response()
         future.result(TIMEOUT)
         json_object = {"id": "json-to-s3 with id " + id}
-        s3.put_object(
-        Body=json.dumps(json_object),
-        Bucket='avgz-iotbox-trials',
-        Key='basic/file' + id +".json"
-        )
+        spool.add(json_object)
         i = i + 1
         id = str(i)
         time.sleep(5)
@@ -50,6 +58,7 @@ greengrass_mean()
 def lambda_handler(event, context):
   logger.info("avgz mqtt pub is ONLINE")
   logger.info(json.dumps(event))
+  spool.add(event)
     
   # Let's publish a response back to AWS IoT
   request = PublishToIoTCoreRequest()
@@ -0,0 +1,337 @@
+"""Batched, compressed upload of readings to S3 through a local spool.
+
+Uploading every reading as its own object costs one PUT per reading and an HTTP round
+trip in the publishing loop. Instead, readings are appended to a gzip compressed NDJSON
+file in a local spool directory. The file is rolled (closed and queued for upload) when
+it is max_age seconds old or max_bytes large, so an hour of readings becomes a handful
+of objects. A background thread uploads the rolled files with concurrent multipart
+transfers and deletes them once S3 has them. Files that fail to upload stay in the
+spool and are retried with exponential backoff, also after a restart.
+
+Objects are stored as <prefix><YYYY>/<MM>/<DD>/<file name>, so they can be queried by
+date (e.g. with Athena) without listing the whole bucket.
+
+Classes
+-------
+RollingSpool
+    Writes records to gzip NDJSON files that are rolled by age and size.
+SpoolUploader
+    Uploads the rolled files of a spool to S3.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+from datetime import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SUFFIX = ".ndjson.gz"
+PART_SUFFIX = ".part"
+
+
+class RollingSpool:
+    """Writes records to gzip compressed NDJSON files in a spool directory.
+
+    Attributes
+    ----------
+    path : str
+        Spool directory
+    max_age : float
+        Number of seconds after which the current file is rolled
+    max_bytes : int
+        Compressed size in bytes at which the current file is rolled
+
+    Methods
+    -------
+    add:
+        Appends a record to the current file
+    roll:
+        Closes the current file so it can be uploaded
+    roll_if_due:
+        Rolls the current file if it is too old
+    rolled_files:
+        Returns the paths of the rolled files, oldest first
+    """
+
+    def __init__(
+        self,
+        path: str = "spool",
+        max_age: float = 300.0,
+        max_bytes: int = 64 * 2**20,
+        compresslevel: int = 6,
+    ) -> None:
+        """Create RollingSpool object and recover files that were not rolled.
+
+        :param path: Spool directory, defaults to "spool"
+        :param max_age: Number of seconds after which the current file is rolled,
+        defaults to 300.0
+        :param max_bytes: Compressed size in bytes at which the current file is rolled,
+        defaults to 64 MiB
+        :param compresslevel: gzip compression level, defaults to 6
+        """
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+        self._raw = None
+        self._gzip: gzip.GzipFile = None
+        self._part_path: str = None
+        self._opened = 0.0
+        os.makedirs(path, exist_ok=True)
+        for name in sorted(os.listdir(path)):
+            if name.endswith(PART_SUFFIX):
+                self._recover(os.path.join(path, name))
+
+    def add(self, record: dict) -> None:
+        """Append a record to the current file, rolling it if it is full.
+
+        :param record: JSON serializable record
+        """
+        line = json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._lock:
+            if self._gzip is None:
+                self._open()
+            self._gzip.write(line)
+            if self._raw.tell() >= self.max_bytes:
+                self._roll()
+
+    def roll(self) -> str | None:
+        """Close the current file so it can be uploaded.
+
+        :return: Path of the rolled file, None if there was no current file
+        """
+        with self._lock:
+            return self._roll()
+
+    def roll_if_due(self) -> str | None:
+        """Roll the current file if it is older than max_age.
+
+        :return: Path of the rolled file, None if nothing was rolled
+        """
+        with self._lock:
+            if (
+                self._gzip is not None
+                and time.monotonic() - self._opened >= self.max_age
+            ):
+                return self._roll()
+        return None
+
+    def rolled_files(self) -> list[str]:
+        """Return the paths of the rolled files, oldest first."""
+        return [
+            os.path.join(self.path, name)
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(SPOOL_SUFFIX)
+        ]
+
+    def _open(self) -> None:
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%fZ}{SPOOL_SUFFIX}"
+        self._part_path = os.path.join(self.path, name + PART_SUFFIX)
+        self._raw = open(self._part_path, "wb")
+        self._gzip = gzip.GzipFile(
+            filename=name[: -len(".gz")],
+            mode="wb",
+            compresslevel=self.compresslevel,
+            fileobj=self._raw,
+        )
+        self._opened = time.monotonic()
+
+    def _roll(self) -> str | None:
+        if self._gzip is None:
+            return None
+        self._gzip.close()
+        self._raw.close()
+        path = self._part_path[: -len(PART_SUFFIX)]
+        os.replace(self._part_path, path)
+        self._gzip = self._raw = self._part_path = None
+        return path
+
+    def _recover(self, part_path: str) -> None:
+        """Roll a file that was not closed, e.g. after a crash.
+
+        The readable complete lines are compressed again into a valid gzip file.
+        """
+        lines = []
+        try:
+            with gzip.open(part_path, "rb") as f:
+                for line in f:
+                    lines.append(line)
+        except (EOFError, OSError, zlib.error):
+            pass
+        lines = [line for line in lines if line.endswith(b"\n")]
+        path = part_path[: -len(PART_SUFFIX)]
+        if lines:
+            with gzip.open(path, "wb", compresslevel=self.compresslevel) as f:
+                f.writelines(lines)
+            logger.warning(f"Recovered {len(lines)} records from {part_path}")
+        os.remove(part_path)
+
+
+class SpoolUploader:
+    """Uploads the rolled files of a spool to S3.
+
+    Attributes
+    ----------
+    spool : RollingSpool
+        Spool whose rolled files are uploaded
+    bucket : str
+        Name of the S3 bucket
+    prefix : str
+        Prefix of the object keys
+    uploaded : int
+        Number of uploaded files
+    failed : int
+        Number of failed upload attempts
+
+    Methods
+    -------
+    start:
+        Starts rolling and uploading in a background thread
+    stop:
+        Rolls the current file, uploads all files and stops the background thread
+    upload_pending:
+        Uploads all rolled files
+    object_key:
+        Returns the object key of a spool file
+    """
+
+    def __init__(
+        self,
+        spool: RollingSpool,
+        bucket: str,
+        prefix: str = "",
+        s3_client=None,
+        endpoint_url: str = None,
+        max_uploads: int = 2,
+        max_concurrency: int = 4,
+        multipart_threshold: int = 8 * 2**20,
+        multipart_chunksize: int = 8 * 2**20,
+        retry_interval: float = 1.0,
+        max_retry_interval: float = 300.0,
+        poll_interval: float = 1.0,
+    ) -> None:
+        """Create SpoolUploader object.
+
+        :param spool: Spool whose rolled files are uploaded
+        :param bucket: Name of the S3 bucket
+        :param prefix: Prefix of the object keys, defaults to ""
+        :param s3_client: boto3 S3 client, defaults to a new client
+        :param endpoint_url: Endpoint of an S3 compatible service (e.g. a local MinIO),
+        used for a new client, defaults to AWS
+        :param max_uploads: Number of files uploaded at the same time, defaults to 2
+        :param max_concurrency: Number of parts of a file uploaded at the same time,
+        defaults to 4
+        :param multipart_threshold: Size in bytes from which files are uploaded in
+        parts, defaults to 8 MiB
+        :param multipart_chunksize: Size of the parts in bytes, defaults to 8 MiB
+        :param retry_interval: Number of seconds to wait after the first failed upload,
+        doubled with every further failure, defaults to 1.0
+        :param max_retry_interval: Maximum number of seconds between two attempts,
+        defaults to 300.0
+        :param poll_interval: Number of seconds between two checks of the spool,
+        defaults to 1.0
+        """
+        self.spool = spool
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3_client or boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(retries={"max_attempts": 5, "mode": "standard"}),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+        )
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.poll_interval = poll_interval
+        self.uploaded = 0
+        self.failed = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_uploads)
+        self._backoff = retry_interval
+        self._retry_at = 0.0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def start(self) -> None:
+        """Start rolling and uploading in a background thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Roll the current file, upload all files and stop the background thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.spool.roll()
+        self.upload_pending()
+        self._executor.shutdown()
+
+    def upload_pending(self) -> int:
+        """Upload all rolled files.
+
+        :return: Number of files that could not be uploaded
+        """
+        paths = self.spool.rolled_files()
+        results = self._executor.map(self._upload, paths)
+        failed = sum(not ok for ok in results)
+        if failed:
+            self._retry_at = time.monotonic() + self._backoff
+            logger.error(
+                f"{failed} of {len(paths)} uploads failed, retrying in"
+                f" {self._backoff:g} s"
+            )
+            self._backoff = min(2 * self._backoff, self.max_retry_interval)
+        else:
+            self._backoff = self.retry_interval
+        return failed
+
+    def object_key(self, path: str) -> str:
+        """Return the object key of a spool file.
+
+        :param path: Path of the spool file
+        :return: <prefix><YYYY>/<MM>/<DD>/<file name>
+        """
+        name = os.path.basename(path)
+        return f"{self.prefix}{name[:4]}/{name[4:6]}/{name[6:8]}/{name}"
+
+    def _upload(self, path: str) -> bool:
+        try:
+            self.s3.upload_file(
+                path,
+                self.bucket,
+                self.object_key(path),
+                ExtraArgs={
+                    "ContentType": "application/x-ndjson",
+                    "ContentEncoding": "gzip",
+                },
+                Config=self.transfer_config,
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.debug(f"Uploading {path} failed: {e}")
+            return False
+        os.remove(path)
+        self.uploaded += 1
+        return True
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.poll_interval):
+            self.spool.roll_if_due()
+            if time.monotonic() >= self._retry_at:
+                self.upload_pending()
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+import hashlib
 import logging
 import os
 
@@ -33,12 +34,15 @@ class IODD:
         Parses information nodes into object
     _iodd_to_value_index:
         Converts bit information to useable value indices.
+    content_hash:
+        Hashes the IODD content to tell different revisions of an IODD apart.
     """
 
     xml: str
     family: list[str] = field(default_factory=list)
     information_nodes: list[InformationNode] = field(default_factory=list)
     total_bit_length: int = None
+    _content_hash: str = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self) -> None:
         """Parse data from the IODD file specified in the location variable."""
@@ -74,6 +78,23 @@ class IODD:
         self._parse_information_nodes()
         self._iodd_to_value_index()
 
+    def content_hash(self) -> str:
+        """Hash the content of the IODD.
+
+        The hash only depends on the xml content, not on the location of the file, so
+        it changes whenever the IODD itself is changed. It is computed once per object.
+
+        :return: SHA-256 hex digest of the IODD xml
+        """
+        if self._content_hash is None:
+            if os.path.exists(self.xml):
+                with open(self.xml, "rb") as f:
+                    content = f.read()
+            else:
+                content = self.xml.encode("utf-8")
+            self._content_hash = hashlib.sha256(content).hexdigest()
+        return self._content_hash
+
     def _get_root(self) -> ET.Element:
         """Get the root element of the IODD xml.
 
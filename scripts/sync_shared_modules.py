@@ -0,0 +1,85 @@
+"""Copy modules that are shared between images and components from their source.
+
+The binary ingest frame format is written by the OPC UA server bridge and the
+pipelined Greengrass publisher and read by the local database API. Every image and
+component is built from its own directory, so each of them ships a copy of
+ingest_frames.py. The copies are generated from the module of the OPC UA server and
+must not be edited.
+
+python scripts/sync_shared_modules.py updates the copies, with --check it only reports
+copies that differ from their source and exits with 1, for the build pipeline.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# source module and the copies generated from it, relative to the repository root
+SHARED_MODULES = {
+    "lib/constructs/Docker/docker_images/opcua-server/opcua_server/ingest_frames.py": [
+        "lib/constructs/Docker/docker_images/local_api_db/src/ingest_frames.py",
+        "lib/constructs/lambda/src/ggv0-mqtt-pub-pipelined/ingest_frames.py",
+    ],
+}
+
+HEADER = (
+    "# Generated by scripts/sync_shared_modules.py from\n"
+    "# {source}\n"
+    "# Edit the source and run the script instead of changing this copy.\n"
+)
+
+
+def expected_copy(source: str) -> str:
+    """Return the content of the copies of a source module.
+
+    :param source: Location of the source module, relative to the repository root
+    :return: Header and content of the source module
+    """
+    with open(os.path.join(ROOT, source), "r") as f:
+        return HEADER.format(source=source) + f.read()
+
+
+def outdated_copies() -> list[str]:
+    """Return the copies that differ from their source module.
+
+    :return: Locations of the outdated copies, relative to the repository root
+    """
+    outdated = []
+    for source, copies in SHARED_MODULES.items():
+        content = expected_copy(source)
+        for copy in copies:
+            path = os.path.join(ROOT, copy)
+            if not os.path.exists(path):
+                outdated.append(copy)
+                continue
+            with open(path, "r") as f:
+                if f.read() != content:
+                    outdated.append(copy)
+    return outdated
+
+
+def sync() -> None:
+    """Write the copies of all shared modules."""
+    for source, copies in SHARED_MODULES.items():
+        content = expected_copy(source)
+        for copy in copies:
+            with open(os.path.join(ROOT, copy), "w") as f:
+                f.write(content)
+            print(f"Copied {source} to {copy}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy shared modules")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only report copies that differ from their source",
+    )
+    args = parser.parse_args()
+    if args.check:
+        outdated = outdated_copies()
+        for copy in outdated:
+            print(f"{copy} differs from its source, run scripts/sync_shared_modules.py")
+        sys.exit(1 if outdated else 0)
+    sync()
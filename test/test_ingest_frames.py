@@ -0,0 +1,83 @@
+"""Round trip of binary ingest frames between the producers and the consumer.
+
+Frames are encoded by the OPC UA server bridge and the pipelined Greengrass publisher
+and decoded by the local database API, each with its own copy of ingest_frames.py.
+
+Run with python -m unittest discover -s test
+"""
+import importlib.util
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+import sync_shared_modules  # noqa: E402
+
+PRODUCERS = {
+    "opcua-server": "lib/constructs/Docker/docker_images/opcua-server/opcua_server",
+    "ggv0-mqtt-pub-pipelined": "lib/constructs/lambda/src/ggv0-mqtt-pub-pipelined",
+}
+CONSUMER = "lib/constructs/Docker/docker_images/local_api_db/src"
+
+
+def load_copy(directory: str):
+    """Import the ingest_frames.py of a directory under its own module name."""
+    path = os.path.join(ROOT, directory, "ingest_frames.py")
+    name = f"ingest_frames_{abs(hash(directory))}"
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # dataclasses look up the module of their class
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class IngestFramesTest(unittest.TestCase):
+    def setUp(self):
+        self.consumer = load_copy(CONSUMER)
+
+    def test_copies_match_source(self):
+        self.assertEqual(sync_shared_modules.outdated_copies(), [])
+
+    def test_round_trip(self):
+        for producer_name, directory in PRODUCERS.items():
+            with self.subTest(producer=producer_name):
+                producer = load_copy(directory)
+                registry = producer.StreamRegistry()
+                temperature = registry.stream(
+                    1, "TV7105", "Temperature", [-50.0], [150.0], ["degC"]
+                )
+                flow = registry.stream(
+                    2, "SM6000", "Flow", [0.0, 0.0], [25.0, 100.0], ["l/min", "%"]
+                )
+                records = [
+                    (temperature, 1_700_000_000_000_000, [21.5]),
+                    (flow, 1_700_000_000_100_000, [3.25, 13.0]),
+                    (temperature, 1_700_000_000_200_000, [-0.125]),
+                    (flow, 1_700_000_000_150_000, []),
+                ]
+
+                frame = producer.encode_frame(records)
+                self.assertEqual(list(self.consumer.decode_frame(frame)), records)
+
+                schemas = [
+                    self.consumer.StreamSchema(**schema.to_dict())
+                    for schema in registry.pending()
+                ]
+                self.assertEqual(
+                    [schema.to_dict() for schema in schemas],
+                    [schema.to_dict() for schema in registry.pending()],
+                )
+
+    def test_rejects_unknown_version(self):
+        producer = load_copy(PRODUCERS["opcua-server"])
+        frame = bytearray(producer.encode_frame([(0, 0, [1.0])]))
+        frame[4] = producer.FRAME_VERSION + 1
+        with self.assertRaises(ValueError):
+            list(self.consumer.decode_frame(bytes(frame)))
+
+
+if __name__ == "__main__":
+    unittest.main()